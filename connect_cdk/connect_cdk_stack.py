@@ -9,6 +9,8 @@ from aws_cdk.core import CustomResource, CfnOutput
 import aws_cdk.aws_logs as logs
 import aws_cdk.custom_resources as cr
 
+from connect_cdk import function_profile
+
 class ConnectCdkStack(cdk.Stack):
 
     def __init__(self, scope: cdk.Construct, construct_id: str, bot_alias_id: str, bot_id: str, bucket: str, **kwargs) -> None:
@@ -41,9 +43,8 @@ class ConnectCdkStack(cdk.Stack):
         key.add_to_resource_policy(connect_key_statement1)
         key.add_to_resource_policy(connect_key_statement2)
 
-        on_event = _lambda.Function(
+        on_event = function_profile.function(
                 self, 'ConnectOnEventHandler',
-                runtime=_lambda.Runtime.PYTHON_3_7,
                 code=_lambda.Code.asset('lambda'),
                 handler='connect_create2.on_event',
                 log_retention=logs.RetentionDays.ONE_DAY,
@@ -52,9 +53,8 @@ class ConnectCdkStack(cdk.Stack):
                 }
             )
         
-        is_complete = _lambda.Function(
+        is_complete = function_profile.function(
                 self, 'ConnectIsCompleteHandler',
-                runtime=_lambda.Runtime.PYTHON_3_7,
                 code=_lambda.Code.asset('lambda'),
                 handler='connect_create2.is_complete',
                 log_retention=logs.RetentionDays.ONE_DAY,
@@ -132,9 +132,8 @@ class ConnectCdkStack(cdk.Stack):
             value = instance_arn
         )
 
-        on_event2 = _lambda.Function(
+        on_event2 = function_profile.function(
             self, 'ConnectAttrOnEventHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='connect_attributes.on_event',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -193,9 +192,8 @@ class ConnectCdkStack(cdk.Stack):
             value = connect_attr_resource.get_att_string("DemoQueueId")
         )
 
-        connect_associate_bot = _lambda.Function(
+        connect_associate_bot = function_profile.function(
             self, 'ConnectAssociateBotOnEventHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='connect_associate_bot.on_event',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -0,0 +1,160 @@
+from aws_cdk import (
+    core as cdk,
+    aws_lambda as _lambda,
+    aws_applicationautoscaling as appscaling,
+    aws_events as events,
+    aws_events_targets as targets,
+)
+
+# Per-function performance settings, read from the "function_profiles" context
+# in cdk.json. The "default" profile applies to every function and a profile
+# named after a function's construct id is layered on top of it:
+#
+#   memory_size                        MB
+#   architecture                       "arm64" or "x86_64"
+#   runtime                            "python3.7", "python3.8" or "python3.9"
+#   reserved_concurrency               reserved concurrent executions
+#   provisioned_concurrency            provisioned concurrency on the "live" alias
+#   provisioned_concurrency_max        upper bound for auto-scaling, defaults to provisioned_concurrency
+#   provisioned_concurrency_utilization
+#                                      target utilization (0.0 - 1.0) to track between the bounds
+#   provisioned_concurrency_schedule   list of { "name", "schedule" (an Application Auto
+#                                      Scaling "cron(...)" or "rate(...)" expression), "min", "max" }
+#   warmup_minutes                     send a warm-up ping every this many minutes
+#
+# memory_size and reserved_concurrency can also be passed to function()
+# directly. They take precedence over the "default" profile, and the
+# function's own profile takes precedence over them.
+
+RUNTIMES = {
+    'python3.7': _lambda.Runtime.PYTHON_3_7,
+    'python3.8': _lambda.Runtime.PYTHON_3_8,
+    'python3.9': _lambda.Runtime.PYTHON_3_9,
+}
+
+ARCHITECTURES = {
+    'x86_64': _lambda.Architecture.X86_64,
+    'arm64': _lambda.Architecture.ARM_64,
+}
+
+PIP_PLATFORMS = {
+    'x86_64': 'manylinux2014_x86_64',
+    'arm64': 'manylinux2014_aarch64',
+}
+
+LIVE_ALIAS = 'live'
+
+def get_profile(scope, construct_id, layered=True):
+    """
+    The function's profile on top of the default one, or only its own if not
+    layered.
+    """
+    profiles = scope.node.try_get_context('function_profiles') or {}
+    if not layered:
+        return dict(profiles.get(construct_id, {}))
+    profile = dict(profiles.get('default', {}))
+    profile.update(profiles.get(construct_id, {}))
+    return profile
+
+def runtime_of(profile):
+    return RUNTIMES[profile.get('runtime', 'python3.7')]
+
+def architecture_of(profile):
+    return ARCHITECTURES[profile.get('architecture', 'x86_64')]
+
+def function(scope, construct_id, python_layers=(), **kwargs):
+    """
+    A _lambda.Function with its profile applied. python_layers are directories
+    holding a requirements.txt, installed into a layer built for the function's
+    runtime and architecture.
+    """
+    profile = get_profile(scope, construct_id)
+    own = get_profile(scope, construct_id, layered=False)
+    kwargs['runtime'] = runtime_of(profile)
+    kwargs['architecture'] = architecture_of(profile)
+    for key, argument in [('memory_size', 'memory_size'), ('reserved_concurrency', 'reserved_concurrent_executions')]:
+        if key in own or (key in profile and argument not in kwargs):
+            kwargs[argument] = profile[key]
+    if python_layers:
+        kwargs['layers'] = list(kwargs.get('layers', [])) + [
+            python_layer(scope, path, profile) for path in python_layers
+        ]
+    return _lambda.Function(scope, construct_id, **kwargs)
+
+def python_layer(scope, path, profile):
+    """
+    One layer per directory, runtime and architecture, shared by every function
+    in the stack that asks for the same combination.
+    """
+    runtime_name = profile.get('runtime', 'python3.7')
+    architecture_name = profile.get('architecture', 'x86_64')
+    name = path.rstrip('/').split('/')[-1]
+    construct_id = '%sLayer%s%s' % (
+        name.capitalize(),
+        runtime_name.replace('python', 'Python').replace('.', ''),
+        '' if architecture_name == 'x86_64' else 'Arm64'
+    )
+    layer = scope.node.try_find_child(construct_id)
+    if layer is not None:
+        return layer
+
+    runtime = RUNTIMES[runtime_name]
+    return _lambda.LayerVersion(
+        scope, construct_id,
+        code=_lambda.Code.from_asset(path,
+            bundling=cdk.BundlingOptions(
+                image=runtime.bundling_image,
+                command=[
+                    'bash', '-c',
+                    'pip install -r requirements.txt -t /asset-output/python'
+                    ' --platform %s --implementation cp --python-version %s --only-binary=:all:' % (
+                        PIP_PLATFORMS[architecture_name], runtime_name.replace('python', ''))
+                ]
+            )
+        ),
+        compatible_runtimes=[runtime],
+        compatible_architectures=[ARCHITECTURES[architecture_name]]
+    )
+
+def live_alias(scope, construct_id, fn):
+    """
+    The "live" alias for a function, with the provisioned concurrency, its
+    auto-scaling and the warm-up schedule from the function's profile.
+    Callers have to invoke the alias for provisioned concurrency to apply.
+    """
+    profile = get_profile(scope, construct_id)
+    provisioned = profile.get('provisioned_concurrency')
+    alias = _lambda.Alias(
+        scope, '%sLiveAlias' % construct_id,
+        alias_name=LIVE_ALIAS,
+        version=fn.current_version,
+        provisioned_concurrent_executions=provisioned
+    )
+
+    schedule = profile.get('provisioned_concurrency_schedule', [])
+    utilization = profile.get('provisioned_concurrency_utilization')
+    if provisioned and (schedule or utilization):
+        scaling = alias.add_auto_scaling(
+            min_capacity=provisioned,
+            max_capacity=profile.get('provisioned_concurrency_max', provisioned)
+        )
+        if utilization:
+            scaling.scale_on_utilization(utilization_target=utilization)
+        for step in schedule:
+            scaling.scale_on_schedule(
+                step['name'],
+                schedule=appscaling.Schedule.expression(step['schedule']),
+                min_capacity=step['min'],
+                max_capacity=step['max']
+            )
+
+    if profile.get('warmup_minutes'):
+        events.Rule(
+            scope, '%sWarmUp' % construct_id,
+            schedule=events.Schedule.rate(cdk.Duration.minutes(profile['warmup_minutes'])),
+            targets=[targets.LambdaFunction(
+                alias,
+                event=events.RuleTargetInput.from_object({ 'warmup': True })
+            )]
+        )
+    return alias
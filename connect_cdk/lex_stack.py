@@ -2,13 +2,21 @@ from aws_cdk import (
     core as cdk,
     aws_lambda as _lambda,
     aws_dynamodb as ddb,
+    aws_events as events,
+    aws_events_targets as targets,
     aws_iam as iam,
     aws_s3 as s3,
+    aws_s3_notifications as s3n,
+    aws_secretsmanager as secretsmanager,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
 )
 from aws_cdk.core import CustomResource, CfnOutput
 import aws_cdk.aws_logs as logs
 import aws_cdk.custom_resources as cr
 
+from connect_cdk import function_profile
+
 class LexStack(cdk.Stack):
 
     def __init__(self, scope: cdk.Construct, construct_id: str, **kwargs) -> None:
@@ -36,9 +44,8 @@ class LexStack(cdk.Stack):
             actions=["polly:SynthesizeSpeech"]
         ))
 
-        lex_on_event = _lambda.Function(
+        lex_on_event = function_profile.function(
             self, 'LexOnEventHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='lex_bot.on_event',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -47,9 +54,8 @@ class LexStack(cdk.Stack):
             }
         )
 
-        lex_is_complete = _lambda.Function(
+        lex_is_complete = function_profile.function(
             self, 'LexIsCompleteHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='lex_bot.is_complete',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -115,9 +121,8 @@ class LexStack(cdk.Stack):
             value = self.bot_id
         )
 
-        lex_bot_locale = _lambda.Function(
+        lex_bot_locale = function_profile.function(
             self, 'LexLocaleOnEventHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='lex_bot_locale.on_event',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -128,9 +133,8 @@ class LexStack(cdk.Stack):
             timeout=cdk.Duration.seconds(15)
         )
 
-        lex_bot_locale_complete = _lambda.Function(
+        lex_bot_locale_complete = function_profile.function(
             self, 'LexLocaleIsCompleteHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='lex_bot_locale.is_complete',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -173,9 +177,185 @@ class LexStack(cdk.Stack):
 
         lex_locale_id = lex_bot_locale_resource.get_att_string("LocaleId")
 
-        lex_bot_intent = _lambda.Function(
+        meter_table = ddb.Table(
+            self, 'MeterReadingTable',
+            partition_key={'name':'user_id', 'type': ddb.AttributeType.STRING},
+            sort_key={'name':'timestamp', 'type': ddb.AttributeType.NUMBER},
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+            # feeds the consumption rollups
+            stream=ddb.StreamViewType.NEW_AND_OLD_IMAGES,
+        )
+
+        meter_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY) #Used while in testing
+
+        # Daily and monthly consumption per user, see lambda/consumption_rollup.py.
+        rollup_table = ddb.Table(
+            self, 'ConsumptionRollupTable',
+            partition_key={'name':'user_id', 'type': ddb.AttributeType.STRING},
+            sort_key={'name':'period', 'type': ddb.AttributeType.STRING},
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        rollup_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY) #Used while in testing
+
+        user_table = ddb.Table(
+            self, 'UserTable',
+            partition_key={'name':'PhoneNumber', 'type': ddb.AttributeType.STRING},
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Account ID lookups. Only the profile attributes the code hooks read
+        # are projected (user_cache.ATTRIBUTES); PhoneNumber comes with the table key.
+        user_table.add_global_secondary_index(
+            index_name='user_id-index',
+            partition_key={'name':'user_id', 'type': ddb.AttributeType.STRING},
+            projection_type=ddb.ProjectionType.INCLUDE,
+            non_key_attributes=['firstName', 'email', 'vcode'],
+        )
+
+        user_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+
+        otp_table = ddb.Table(
+            self, 'OtpTable',
+            partition_key={'name':'uuid', 'type': ddb.AttributeType.STRING},
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+            # records of used one time codes expire with the codes (lambda/otp.py)
+            time_to_live_attribute='expires',
+        )
+
+        otp_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+
+        # One time codes are derived from this, see lambda/otp.py.
+        otp_secret = secretsmanager.Secret(
+            self, 'OtpSecret',
+            generate_secret_string=secretsmanager.SecretStringGenerator(
+                exclude_punctuation=True,
+                password_length=64
+            )
+        )
+
+        rate_limit_table = ddb.Table(
+            self, 'RateLimitTable',
+            partition_key={'name':'key', 'type': ddb.AttributeType.STRING},
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires',
+        )
+
+        rate_limit_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+
+        # Meters the nightly leak detection flagged, see lambda/leak_detection.py.
+        leak_flag_table = ddb.Table(
+            self, 'LeakFlagTable',
+            partition_key={'name':'user_id', 'type': ddb.AttributeType.STRING},
+            sort_key={'name':'utility_type', 'type': ddb.AttributeType.STRING},
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires_at',
+        )
+
+        leak_flag_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+
+        sms_dead_letter_queue = sqs.Queue(
+            self, 'SmsDeadLetterQueue',
+            retention_period=cdk.Duration.days(14),
+        )
+
+        sms_queue = sqs.Queue(
+            self, 'SmsQueue',
+            visibility_timeout=cdk.Duration.seconds(60),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=sms_dead_letter_queue
+            ),
+        )
+
+        sms_sender = function_profile.function(
+            self, 'SmsSender',
+            code=_lambda.Code.asset('lambda'),
+            handler='sms_sender.lambda_handler',
+            timeout=cdk.Duration.seconds(30),
+        )
+
+        sms_sender.add_to_role_policy(iam.PolicyStatement(
+            actions=["sns:Publish"],
+            resources=["*"]
+        ))
+
+        sms_sender.add_event_source(lambda_event_sources.SqsEventSource(
+            sms_queue,
+            batch_size=10,
+            max_batching_window=cdk.Duration.seconds(1),
+            report_batch_item_failures=True
+        ))
+
+        # Every Lex code hook, for every intent (lambda/fulfillment.py), so
+        # they share one pool of warm and provisioned concurrency.
+        fulfillment = function_profile.function(
+            self, 'Fulfillment',
+            code=_lambda.Code.asset('lambda'),
+            handler='fulfillment.lambda_handler',
+            environment={
+                'OTP_TABLE_NAME': otp_table.table_name,
+                'OTP_SECRET_ARN': otp_secret.secret_arn,
+                'OTP_MODE': 'hmac',
+                'USER_TABLE_NAME': user_table.table_name,
+                'RATE_LIMIT_TABLE_NAME': rate_limit_table.table_name,
+                'LEAK_FLAG_TABLE_NAME': leak_flag_table.table_name,
+                'METER_READING_TABLE_NAME': meter_table.table_name,
+                'ROLLUP_TABLE_NAME': rollup_table.table_name,
+                'SMS_QUEUE_URL': sms_queue.queue_url,
+                'SMS_DELIVERY': 'async'
+            },
+            # NumPy for the billing engine, installed for the function's runtime and architecture at synth time.
+            python_layers=['layers/numpy'],
+        )
+
+        billing_run = function_profile.function(
+            self, 'MonthlyBilling',
+            code=_lambda.Code.asset('lambda'),
+            handler='billing.lambda_handler',
+            environment={
+                'METER_READING_TABLE_NAME': meter_table.table_name,
+                'BILLING_BUCKET': bucket.bucket_name
+            },
+            python_layers=['layers/numpy'],
+            memory_size=3008,
+            timeout=cdk.Duration.minutes(15),
+        )
+
+        meter_table.grant_read_data(billing_run)
+        bucket.grant_put(billing_run, 'bills/*')
+
+        events.Rule(
+            self, 'MonthlyBillingSchedule',
+            schedule=events.Schedule.cron(day='1', hour='2', minute='0'),
+            targets=[targets.LambdaFunction(billing_run)]
+        )
+
+        fulfillment.add_to_role_policy(iam.PolicyStatement(
+            actions=["sns:Publish"],
+            resources=["*"]
+        ))
+
+        user_table.grant_read_write_data(fulfillment)
+        otp_table.grant_read_write_data(fulfillment)
+        otp_secret.grant_read(fulfillment)
+        rate_limit_table.grant_write_data(fulfillment)
+        leak_flag_table.grant_read_data(fulfillment)
+        meter_table.grant_read_write_data(fulfillment)
+        # rollups, and the latest-reading items readings are validated against
+        rollup_table.grant_read_write_data(fulfillment)
+        sms_queue.grant_send_messages(fulfillment)
+        # The code hooks take live traffic: Lex should call this alias, which
+        # carries the provisioned concurrency and warm-up from cdk.json.
+        self.fulfillment_alias = function_profile.live_alias(self, 'Fulfillment', fulfillment)
+        self.fulfillment_alias.add_permission(
+            'LexInvoke',
+            principal=iam.ServicePrincipal('lexv2.amazonaws.com'),
+            source_arn='arn:%s:lex:%s:%s:bot-alias/%s/*' % (self.partition, self.region, self.account, self.bot_id)
+        )
+
+        lex_bot_intent = function_profile.function(
             self, 'LexIntentOnEventHandler',
-            runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.asset('lambda'),
             handler='lex_bot_intent.on_event',
             log_retention=logs.RetentionDays.ONE_DAY,
@@ -192,6 +372,8 @@ class LexStack(cdk.Stack):
                 "lex:CreateSlot",
                 "lex:CreateSlotType",
                 "lex:CreateBotAlias",
+                "lex:UpdateBotAlias",
+                "lex:ListBotAliases",
                 "lex:CreateBotVersion",
                 "lex:DescribeBotVersion",
                 "lex:ListBots",
@@ -209,7 +391,11 @@ class LexStack(cdk.Stack):
         lex_bot_intent_resource = CustomResource(
             self, 
             "LexBotIntent", 
-            service_token=lex_bot_intent_provider.service_token
+            service_token=lex_bot_intent_provider.service_token,
+            # the alias's code hook, for every intent
+            properties={
+                "FulfillmentArn": self.fulfillment_alias.function_arn
+            }
         )
 
         self.bot_alias = lex_bot_intent_resource.get_att_string("BotAlias")
@@ -223,65 +409,107 @@ class LexStack(cdk.Stack):
         def bot_alias_id(self):
             return self.bot_alias_id
 
-        meter_table = ddb.Table(
-            self, 'MeterReadingTable',
-            partition_key={'name':'user_id', 'type': ddb.AttributeType.STRING},
-            sort_key={'name':'timestamp', 'type': ddb.AttributeType.NUMBER},
-            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+        meter_ingest = function_profile.function(
+            self, 'MeterReadingIngest',
+            code=_lambda.Code.asset('lambda'),
+            handler='meter_ingest.lambda_handler',
+            environment={
+                'METER_READING_TABLE_NAME': meter_table.table_name,
+                'ROLLUP_TABLE_NAME': rollup_table.table_name,
+                'INGEST_WORKERS': '8'
+            },
+            memory_size=1024,
+            timeout=cdk.Duration.minutes(15),
         )
 
-        meter_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY) #Used while in testing
-
-        user_table = ddb.Table(
-            self, 'UserTable',
-            partition_key={'name':'PhoneNumber', 'type': ddb.AttributeType.STRING},
-            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+        meter_table.grant_write_data(meter_ingest)
+        rollup_table.grant_write_data(meter_ingest)
+        bucket.grant_read(meter_ingest, 'meter-readings/*')
+        bucket.grant_read_write(meter_ingest, 'meter-readings-checkpoints/*')
+        bucket.grant_delete(meter_ingest, 'meter-readings-checkpoints/*')
+
+        for suffix in ['.csv', '.jsonl']:
+            bucket.add_event_notification(
+                s3.EventType.OBJECT_CREATED,
+                s3n.LambdaDestination(meter_ingest),
+                s3.NotificationKeyFilter(prefix='meter-readings/', suffix=suffix)
+            )
+
+        rollup = function_profile.function(
+            self, 'ConsumptionRollup',
+            code=_lambda.Code.asset('lambda'),
+            handler='consumption_rollup.lambda_handler',
+            environment={
+                'METER_READING_TABLE_NAME': meter_table.table_name,
+                'ROLLUP_TABLE_NAME': rollup_table.table_name
+            },
+            timeout=cdk.Duration.minutes(1),
         )
 
-        user_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+        meter_table.grant_read_data(rollup)
+        rollup_table.grant_read_write_data(rollup)
 
-        otp_table = ddb.Table(
-            self, 'OtpTable',
-            partition_key={'name':'uuid', 'type': ddb.AttributeType.STRING},
-            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+        # Where records the rollups gave up on are sent (as stream positions),
+        # to be replayed once whatever failed them is fixed.
+        rollup_dead_letter_queue = sqs.Queue(
+            self, 'ConsumptionRollupDeadLetterQueue',
+            retention_period=cdk.Duration.days(14),
         )
 
-        otp_table.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+        rollup.add_event_source(lambda_event_sources.DynamoEventSource(
+            meter_table,
+            starting_position=_lambda.StartingPosition.TRIM_HORIZON,
+            batch_size=500,
+            max_batching_window=cdk.Duration.seconds(5),
+            report_batch_item_failures=True,
+            bisect_batch_on_error=True,
+            retry_attempts=10,
+            on_failure=lambda_event_sources.SqsDlq(rollup_dead_letter_queue)
+        ))
 
-        meter_read = _lambda.Function(
-            self, 'MeterReading',
-            runtime=_lambda.Runtime.PYTHON_3_7,
+        leak_detection = function_profile.function(
+            self, 'LeakDetection',
             code=_lambda.Code.asset('lambda'),
-            handler='meter_reading.lambda_handler',
+            handler='leak_detection.lambda_handler',
             environment={
                 'METER_READING_TABLE_NAME': meter_table.table_name,
-                'USER_TABLE_NAME': user_table.table_name
+                'LEAK_FLAG_TABLE_NAME': leak_flag_table.table_name,
+                'LEAK_SCAN_SEGMENTS': '128',
+                'LEAK_SCAN_WORKERS': '16'
             },
+            python_layers=['layers/numpy'],
+            memory_size=3008,
+            timeout=cdk.Duration.minutes(15),
         )
 
-        meter_read.add_to_role_policy(iam.PolicyStatement(
-            actions=["sns:Publish"],
-            resources=["*"]
-        ))
+        meter_table.grant_read_data(leak_detection)
+        leak_flag_table.grant_write_data(leak_detection)
 
-        meter_table.grant_read_write_data(meter_read)
-        user_table.grant_read_write_data(meter_read)
+        # after the night's hours (leak_detection.NIGHT_HOURS) are over
+        events.Rule(
+            self, 'LeakDetectionSchedule',
+            schedule=events.Schedule.cron(hour='6', minute='0'),
+            targets=[targets.LambdaFunction(leak_detection)]
+        )
 
-        id_verification = _lambda.Function(
-            self, 'IdentityVerification',
-            runtime=_lambda.Runtime.PYTHON_3_7,
+        meter_export = function_profile.function(
+            self, 'MeterReadingExport',
             code=_lambda.Code.asset('lambda'),
-            handler='identity_verification.lambda_handler',
+            handler='meter_export.lambda_handler',
             environment={
-                'OTP_TABLE_NAME': otp_table.table_name,
-                'USER_TABLE_NAME': user_table.table_name
+                'METER_READING_TABLE_NAME': meter_table.table_name,
+                'EXPORT_BUCKET': bucket.bucket_name,
+                'EXPORT_SEGMENTS': '8'
             },
+            memory_size=1024,
+            timeout=cdk.Duration.minutes(15),
         )
 
-        id_verification.add_to_role_policy(iam.PolicyStatement(
-            actions=["sns:Publish"],
-            resources=["*"]
-        ))
+        meter_table.grant_read_data(meter_export)
+        bucket.grant_put(meter_export, 'exports/*')
 
-        user_table.grant_read_write_data(id_verification)
-        otp_table.grant_read_write_data(id_verification)
\ No newline at end of file
+        events.Rule(
+            self, 'MeterReadingExportSchedule',
+            schedule=events.Schedule.cron(hour='1', minute='0'),
+            targets=[targets.LambdaFunction(meter_export)]
+        )
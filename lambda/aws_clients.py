@@ -0,0 +1,110 @@
+import os
+import threading
+
+# Shared boto3 clients for every handler under lambda/.
+# Clients are built the first time they are asked for and then reused for the
+# lifetime of the container, so warm invocations skip endpoint resolution and
+# keep their TLS connections open. boto3 itself is only imported then too:
+# importing it costs ~200ms, which turns that don't call AWS shouldn't pay.
+
+_lock = threading.RLock()
+_configs = {}
+_session = None
+_clients = {}
+_resources = {}
+_tables = {}
+_overrides = {}
+
+def config(timeouts=None, pool_size=None):
+    """
+    The botocore Config clients are built with. timeouts is an optional
+    (connect_timeout, read_timeout, max_attempts) tuple for callers that need
+    tighter limits than the defaults, each tuple gets its own clients.
+    pool_size raises the connection pool above AWS_MAX_POOL_CONNECTIONS for
+    callers with more threads than that sharing a client.
+    """
+    key = (timeouts, pool_size)
+    if key not in _configs:
+        from botocore.config import Config
+        kwargs = {}
+        max_attempts = int(os.environ.get('AWS_MAX_ATTEMPTS', '3'))
+        if timeouts is not None:
+            kwargs['connect_timeout'], kwargs['read_timeout'], max_attempts = timeouts
+        _configs[key] = Config(
+            tcp_keepalive=True,
+            max_pool_connections=max(int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '10')), pool_size or 0),
+            retries={
+                'mode': 'adaptive',
+                'max_attempts': max_attempts
+            },
+            **kwargs
+        )
+    return _configs[key]
+
+def session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3.session
+                import aws_metrics
+                _session = boto3.session.Session()
+                aws_metrics.install(_session)
+    return _session
+
+def client(service_name, timeouts=None, pool_size=None):
+    if service_name in _overrides:
+        return _overrides[service_name]
+    key = (service_name, timeouts, pool_size)
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                _clients[key] = session().client(service_name, config=config(timeouts, pool_size))
+    return _clients[key]
+
+def resource(service_name, timeouts=None):
+    if ('resource', service_name) in _overrides:
+        return _overrides[('resource', service_name)]
+    key = (service_name, timeouts)
+    if key not in _resources:
+        with _lock:
+            if key not in _resources:
+                _resources[key] = session().resource(service_name, config=config(timeouts))
+    return _resources[key]
+
+def table(table_name, timeouts=None):
+    # Table objects are cheap but not free, cache them by name as well.
+    key = (table_name, timeouts)
+    if key not in _tables:
+        _tables[key] = resource('dynamodb', timeouts).Table(table_name)
+    return _tables[key]
+
+def dynamodb():
+    return client('dynamodb')
+
+def sns():
+    return client('sns')
+
+def connect():
+    return client('connect')
+
+def lex_models():
+    return client('lexv2-models')
+
+def sqs():
+    return client('sqs')
+
+def s3():
+    return client('s3')
+
+def set_client(service_name, obj):
+    """
+    Replace the client for a service, e.g. with a local stub for load tests.
+    """
+    with _lock:
+        _overrides[service_name] = obj
+
+def set_resource(service_name, obj):
+    with _lock:
+        _overrides[('resource', service_name)] = obj
+        _tables.clear()
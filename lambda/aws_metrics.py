@@ -0,0 +1,227 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Per-invocation accounting of the AWS calls a handler makes.
+#
+# install() registers botocore event hooks on the shared session in
+# aws_clients, so every client built from it counts its API calls by service
+# and operation and times each one (retries included). DynamoDB calls that
+# support it are sent with ReturnConsumedCapacity, and the read and write
+# capacity units they report are added up too. structured_log.start() resets
+# the totals and structured_log.end() writes them out as a CloudWatch Embedded
+# Metric Format record, which CloudWatch turns into metrics without any
+# PutMetricData calls.
+#
+# METRICS_NAMESPACE sets the CloudWatch namespace, AWS_CALL_METRICS=off turns
+# the records off and RETURN_CONSUMED_CAPACITY=NONE stops asking DynamoDB for
+# consumed capacity.
+#
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ConnectCdk')
+ENABLED = os.environ.get('AWS_CALL_METRICS', 'on').lower() not in ('off', 'false', '0')
+RETURN_CONSUMED_CAPACITY = os.environ.get('RETURN_CONSUMED_CAPACITY', 'TOTAL').upper()
+
+# EMF takes at most this many values for one metric in a record. Beyond that
+# the latencies kept are a uniform sample of the calls (reservoir sampling),
+# so long batch runs still give CloudWatch representative percentiles.
+MAX_LATENCY_VALUES = 100
+
+READ_OPERATIONS = frozenset(['GetItem', 'BatchGetItem', 'Query', 'Scan', 'TransactGetItems'])
+WRITE_OPERATIONS = frozenset(['PutItem', 'UpdateItem', 'DeleteItem', 'BatchWriteItem', 'TransactWriteItems'])
+
+_lock = threading.Lock()
+_calls = defaultdict(int)
+_errors = defaultdict(int)
+# key -> latency samples, at most MAX_LATENCY_VALUES of them
+_latency_ms = defaultdict(list)
+_latency_total_ms = defaultdict(float)
+_capacity = defaultdict(float)
+# other per-invocation counts that go out with the handler's totals
+_counts = defaultdict(int)
+
+def reset():
+    with _lock:
+        _calls.clear()
+        _errors.clear()
+        _latency_ms.clear()
+        _latency_total_ms.clear()
+        _capacity.clear()
+        _counts.clear()
+
+def record(service_name, operation, elapsed_ms, failed=False, read_units=0.0, write_units=0.0):
+    """
+    Count one AWS call.
+    """
+    key = (service_name, operation)
+    with _lock:
+        _calls[key] += 1
+        _latency_total_ms[key] += elapsed_ms
+        samples = _latency_ms[key]
+        if len(samples) < MAX_LATENCY_VALUES:
+            samples.append(round(elapsed_ms, 3))
+        else:
+            slot = random.randrange(_calls[key])
+            if slot < MAX_LATENCY_VALUES:
+                samples[slot] = round(elapsed_ms, 3)
+        if failed:
+            _errors[key] += 1
+        if read_units:
+            _capacity[(key, 'read')] += read_units
+        if write_units:
+            _capacity[(key, 'write')] += write_units
+
+def count(name, value=1):
+    """
+    Add to a handler-level count, emitted as a metric of the same name.
+    """
+    with _lock:
+        _counts[name] += value
+
+def totals():
+    """
+    The invocation so far, as a dict for the summary log record.
+    """
+    with _lock:
+        result = {
+            'aws_calls': sum(_calls.values()),
+            'aws_call_ms': round(sum(_latency_total_ms.values()), 1),
+            'read_capacity_units': sum(v for (_, kind), v in _capacity.items() if kind == 'read'),
+            'write_capacity_units': sum(v for (_, kind), v in _capacity.items() if kind == 'write'),
+        }
+        result.update(_counts)
+        return result
+
+def _capacity_units(operation, consumed):
+    read_units = write_units = 0.0
+    # a dict for single-table operations, a list of them for batch and transaction calls
+    for entry in consumed if isinstance(consumed, list) else [consumed]:
+        if 'ReadCapacityUnits' in entry or 'WriteCapacityUnits' in entry:
+            read_units += entry.get('ReadCapacityUnits', 0.0)
+            write_units += entry.get('WriteCapacityUnits', 0.0)
+        elif operation in READ_OPERATIONS:
+            read_units += entry.get('CapacityUnits', 0.0)
+        else:
+            write_units += entry.get('CapacityUnits', 0.0)
+    return read_units, write_units
+
+def _request_consumed_capacity(params, model, **kwargs):
+    if model.name in READ_OPERATIONS or model.name in WRITE_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity', RETURN_CONSUMED_CAPACITY)
+
+def _start_call(model, context, **kwargs):
+    context['aws_metrics'] = (model.service_model.service_name, model.name, time.perf_counter())
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    if 'aws_metrics' not in context:
+        return
+    service_name, operation, start = context['aws_metrics']
+    read_units, write_units = 0.0, 0.0
+    if parsed and parsed.get('ConsumedCapacity'):
+        read_units, write_units = _capacity_units(operation, parsed['ConsumedCapacity'])
+    record(
+        service_name,
+        operation,
+        (time.perf_counter() - start) * 1000.0,
+        failed=http_response.status_code >= 300,
+        read_units=read_units,
+        write_units=write_units
+    )
+
+def _after_call_error(context, **kwargs):
+    # the request never got a response, e.g. a connection error
+    if 'aws_metrics' in context:
+        service_name, operation, start = context['aws_metrics']
+        record(service_name, operation, (time.perf_counter() - start) * 1000.0, failed=True)
+
+def install(session):
+    """
+    Register the hooks on a boto3 session. Clients copy the session's event
+    hooks when they are built, so this has to run before any client is made.
+    """
+    events = session.events
+    # the clock starts when the request is built, because a before-call hook can answer a call itself
+    events.register('before-parameter-build', _start_call, unique_id='aws_metrics.start_call')
+    events.register_last('after-call', _after_call, unique_id='aws_metrics.after_call')
+    events.register_last('after-call-error', _after_call_error, unique_id='aws_metrics.after_call_error')
+    if RETURN_CONSUMED_CAPACITY != 'NONE':
+        events.register('provide-client-params.dynamodb', _request_consumed_capacity, unique_id='aws_metrics.consumed_capacity')
+
+def _metric_record(timestamp, dimensions, metrics, values):
+    record = {
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{ 'Name': name, 'Unit': unit } for name, unit in metrics],
+            }]
+        }
+    }
+    record.update(dimensions)
+    record.update(values)
+    return record
+
+def records(handler):
+    """
+    EMF records for the invocation: one with the totals for the handler, and
+    one per service and operation called.
+    """
+    timestamp = int(time.time() * 1000)
+    with _lock:
+        calls = dict(_calls)
+        errors = dict(_errors)
+        latency_ms = {key: list(values) for key, values in _latency_ms.items()}
+        latency_total_ms = dict(_latency_total_ms)
+        capacity = dict(_capacity)
+        counts = dict(_counts)
+
+    result = [_metric_record(
+        timestamp,
+        { 'Handler': handler },
+        [
+            ('AwsCalls', 'Count'),
+            ('AwsCallErrors', 'Count'),
+            ('AwsCallTime', 'Milliseconds'),
+            ('ReadCapacityUnits', 'Count'),
+            ('WriteCapacityUnits', 'Count'),
+        ] + [(name, 'Count') for name in sorted(counts)],
+        dict(counts, **{
+            'AwsCalls': sum(calls.values()),
+            'AwsCallErrors': sum(errors.values()),
+            'AwsCallTime': round(sum(latency_total_ms.values()), 3),
+            'ReadCapacityUnits': sum(v for (_, kind), v in capacity.items() if kind == 'read'),
+            'WriteCapacityUnits': sum(v for (_, kind), v in capacity.items() if kind == 'write'),
+        })
+    )]
+    for key in sorted(calls):
+        service_name, operation = key
+        metrics = [('Calls', 'Count'), ('Errors', 'Count'), ('Latency', 'Milliseconds')]
+        values = {
+            'Calls': calls[key],
+            'Errors': errors.get(key, 0),
+            # EMF takes a list of values for one metric (see MAX_LATENCY_VALUES)
+            'Latency': latency_ms[key],
+        }
+        if service_name == 'dynamodb':
+            metrics += [('ReadCapacityUnits', 'Count'), ('WriteCapacityUnits', 'Count')]
+            values['ReadCapacityUnits'] = capacity.get((key, 'read'), 0.0)
+            values['WriteCapacityUnits'] = capacity.get((key, 'write'), 0.0)
+        result.append(_metric_record(
+            timestamp,
+            { 'Handler': handler, 'Service': service_name, 'Operation': operation },
+            metrics,
+            values
+        ))
+    return result
+
+def emit(handler):
+    if not ENABLED:
+        return
+    for record in records(handler):
+        sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
@@ -0,0 +1,323 @@
+import calendar
+import concurrent.futures
+import csv
+import io
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+import aws_clients
+import consumption_rollup
+import meter_history
+import structured_log
+
+# Bills computed from MeterReadingTable history.
+#
+# Readings are cumulative meter register values, so the consumption for an
+# interval is the difference between two consecutive readings of the same
+# meter. Each interval is priced at the unit rate of the time-of-use band its
+# end time falls in, and a daily standing charge is added per utility for the
+# length of the billing period. All of the per-interval work is done on NumPy
+# arrays, so the same code prices one account inside a Lex turn and every
+# account in the monthly billing run.
+
+SECONDS_PER_DAY = 86400
+
+# How far before a billing period readings are loaded, so the interval that
+# crosses the start of the period has its first reading. A meter read less
+# often than this is billed from its first reading in the period.
+LOOKBACK_DAYS = int(os.environ.get('BILLING_LOOKBACK_DAYS', '31'))
+SCAN_SEGMENTS = int(os.environ.get('BILLING_SCAN_SEGMENTS', '8'))
+
+# Unit rates in £/kWh per time-of-use band (hours are UTC, end exclusive) and
+# standing charges in £/day. Can be replaced wholesale with the TARIFFS
+# environment variable, which takes the same structure as JSON.
+DEFAULT_TARIFFS = {
+    'electricity': {
+        'standing_charge': 0.46,
+        'bands': [
+            { 'start_hour': 0, 'end_hour': 7, 'unit_rate': 0.15 },
+            { 'start_hour': 7, 'end_hour': 16, 'unit_rate': 0.28 },
+            { 'start_hour': 16, 'end_hour': 19, 'unit_rate': 0.35 },
+            { 'start_hour': 19, 'end_hour': 24, 'unit_rate': 0.28 },
+        ]
+    },
+    'gas': {
+        'standing_charge': 0.29,
+        'bands': [
+            { 'start_hour': 0, 'end_hour': 24, 'unit_rate': 0.07 },
+        ]
+    },
+}
+
+class Tariffs(object):
+    """
+    Tariffs flattened into lookup arrays: one row of 24 hourly unit rates and
+    one standing charge per utility type.
+    """
+
+    def __init__(self, tariffs):
+        self.utility_types = sorted(tariffs)
+        self.codes = {name: i for i, name in enumerate(self.utility_types)}
+        self.hourly_rates = np.zeros((len(self.utility_types), 24))
+        self.standing_charges = np.zeros(len(self.utility_types))
+        for name, tariff in tariffs.items():
+            code = self.codes[name]
+            self.standing_charges[code] = tariff['standing_charge']
+            for band in tariff['bands']:
+                self.hourly_rates[code, band['start_hour']:band['end_hour']] = band['unit_rate']
+
+_tariffs = None
+
+def get_tariffs():
+    global _tariffs
+    if _tariffs is None:
+        tariffs = json.loads(os.environ['TARIFFS']) if os.environ.get('TARIFFS') else DEFAULT_TARIFFS
+        _tariffs = Tariffs(tariffs)
+    return _tariffs
+
+def compute_bills(accounts, utilities, timestamps, readings, period_start, period_end, tariffs=None):
+    """
+    Price every (account, utility) meter with a reading in the period.
+
+    accounts and utilities are integer codes (utilities index into
+    tariffs.utility_types), timestamps are epoch seconds and readings are
+    register values. Rows can be in any order, and should include each
+    meter's last reading before period_start: an interval belongs to the
+    period its end time falls in, like in consumption_rollup. Returns
+    (meter_accounts, meter_utilities, consumption, energy_charge,
+    standing_charge), one entry per meter.
+    """
+    tariffs = tariffs or get_tariffs()
+    accounts = np.asarray(accounts, dtype=np.int64)
+    utilities = np.asarray(utilities, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    readings = np.asarray(readings, dtype=np.float64)
+
+    before_end = timestamps < period_end
+    accounts, utilities = accounts[before_end], utilities[before_end]
+    timestamps, readings = timestamps[before_end], readings[before_end]
+
+    order = np.lexsort((timestamps, utilities, accounts))
+    utilities = utilities[order]
+    timestamps, readings = timestamps[order], readings[order]
+    meter_keys = accounts[order] * len(tariffs.utility_types) + utilities
+    meters = np.unique(meter_keys[timestamps >= period_start])
+
+    # consumption between consecutive readings of the same meter, for the
+    # intervals ending in the period
+    ends = timestamps[1:]
+    in_period = (meter_keys[1:] == meter_keys[:-1]) & (ends >= period_start)
+    delta = register_used(readings[:-1][in_period], readings[1:][in_period])
+    interval_meters = np.searchsorted(meters, meter_keys[1:][in_period])
+
+    hours = ((ends[in_period] % SECONDS_PER_DAY) // 3600).astype(np.int64)
+    cost = delta * tariffs.hourly_rates[utilities[1:][in_period], hours]
+
+    consumption = np.bincount(interval_meters, weights=delta, minlength=len(meters))
+    energy_charge = np.bincount(interval_meters, weights=cost, minlength=len(meters))
+
+    meter_accounts = meters // len(tariffs.utility_types)
+    meter_utilities = meters % len(tariffs.utility_types)
+    days = (period_end - period_start) / float(SECONDS_PER_DAY)
+    standing_charge = tariffs.standing_charges[meter_utilities] * days
+
+    return meter_accounts, meter_utilities, consumption, energy_charge, standing_charge
+
+def register_used(previous, current):
+    """
+    consumption_rollup.used_between for arrays of register values: a drop is
+    a rollover if consumption_rollup.rolled_over says so, and otherwise counts
+    as nothing.
+    """
+    used = current - previous
+    dropped = used < 0
+    wrapped = dropped & consumption_rollup.rolled_over(previous)
+    dropped &= ~wrapped
+    if dropped.any():
+        structured_log.info('readings lower than the one before', intervals=int(dropped.sum()))
+    return np.where(wrapped, used + consumption_rollup.REGISTER_ROLLOVER, np.where(dropped, 0.0, used))
+
+def month_start(epoch):
+    t = time.gmtime(epoch)
+    return calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+
+def previous_month(epoch):
+    end = month_start(epoch)
+    return month_start(end - 1), end
+
+def rollup_bill(rollup, period_start, period_end, tariffs=None):
+    """
+    Price a consumption rollup (see consumption_rollup) covering the period.
+    """
+    tariffs = tariffs or get_tariffs()
+    total = 0.0
+    days = (period_end - period_start) / float(SECONDS_PER_DAY)
+    for utility_type, code in tariffs.codes.items():
+        if utility_type not in rollup:
+            continue
+        hourly = np.array([float(rollup.get('%s#%s' % (utility_type, hour), 0)) for hour in consumption_rollup.HOURS])
+        total += float(hourly.dot(tariffs.hourly_rates[code])) + tariffs.standing_charges[code] * days
+    return round(total, 2)
+
+def account_bill(user_id, period_start=None, period_end=None):
+    """
+    Bill to date for one account, by default from the start of the current month.
+    The current month is priced from its rollup when ROLLUP_TABLE_NAME is set,
+    with a single GetItem, and from the raw readings otherwise.
+    """
+    now = time.time()
+    if period_start is None and period_end is None and os.environ.get('ROLLUP_TABLE_NAME'):
+        rollup = consumption_rollup.get_month(user_id, now)
+        if rollup is not None:
+            return rollup_bill(rollup, month_start(now), now)
+
+    period_end = period_end or now
+    period_start = period_start or month_start(now)
+    tariffs = get_tariffs()
+
+    utilities, timestamps, readings = [], [], []
+    for item in meter_history.iter_readings(
+            user_id,
+            start=period_start - LOOKBACK_DAYS * SECONDS_PER_DAY,
+            end=period_end,
+            newest_first=False,
+            page_size=500,
+            projection=['timestamp', 'reading', 'utility_type']):
+        code = tariffs.codes.get(item['utility_type'])
+        if code is None:
+            continue
+        utilities.append(code)
+        timestamps.append(float(item['timestamp']))
+        readings.append(float(item['reading']))
+
+    if not readings:
+        return 0.0
+
+    _, _, _, energy, standing = compute_bills(
+        np.zeros(len(readings), dtype=np.int64), utilities, timestamps, readings,
+        period_start, period_end, tariffs
+    )
+    return round(float(energy.sum() + standing.sum()), 2)
+
+def scan_segment(table_name, segment, total_segments, utility_types, since, until=None):
+    user_ids, utilities, timestamps, readings = [], [], [], []
+    condition = '#t >= :since'
+    values = { ':since': { 'N': str(int(since)) } }
+    if until is not None:
+        condition += ' AND #t < :until'
+        values[':until'] = { 'N': str(int(until)) }
+    condition += ' AND #y IN (%s)' % ', '.join(':y%d' % i for i in range(len(utility_types)))
+    values.update({':y%d' % i: { 'S': name } for i, name in enumerate(utility_types)})
+    args = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': '#u, #t, #r, #y',
+        'FilterExpression': condition,
+        'ExpressionAttributeNames': {'#u': 'user_id', '#t': 'timestamp', '#r': 'reading', '#y': 'utility_type'},
+        'ExpressionAttributeValues': values,
+    }
+    client = aws_clients.dynamodb()
+    while True:
+        response = client.scan(**args)
+        for item in response['Items']:
+            user_ids.append(item['user_id']['S'])
+            utilities.append(item['utility_type']['S'])
+            timestamps.append(item['timestamp']['N'])
+            readings.append(list(item['reading'].values())[0])
+        if 'LastEvaluatedKey' not in response:
+            return user_ids, utilities, timestamps, readings
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def scan_readings(table_name, utility_types, since, until=None, segments=SCAN_SEGMENTS):
+    """
+    Readings of the given utility types from since up to until as arrays of
+    (user ids, utility types, timestamps, readings), scanned in parallel
+    segments.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as pool:
+        parts = list(pool.map(
+            lambda segment: scan_segment(table_name, segment, segments, utility_types, since, until),
+            range(segments)
+        ))
+    columns = [list(itertools.chain.from_iterable(part[i] for part in parts)) for i in range(4)]
+    return reading_arrays(*columns)
+
+def reading_arrays(user_ids, utilities, timestamps, readings):
+    """
+    The lists scan_segment returns as arrays.
+    """
+    return (
+        np.array(user_ids),
+        np.array(utilities),
+        np.array(timestamps, dtype=np.float64),
+        np.array(readings, dtype=np.float64),
+    )
+
+def encode(user_ids, utilities, tariffs):
+    """
+    Account and utility codes for compute_bills, and the account ids the
+    account codes stand for.
+    """
+    account_ids, accounts = np.unique(user_ids, return_inverse=True)
+    names, utility_codes = np.unique(utilities, return_inverse=True)
+    lookup = np.array([tariffs.codes[str(name)] for name in names], dtype=np.int64)
+    return account_ids.tolist(), accounts, lookup[utility_codes] if len(names) else utility_codes
+
+def write_bills_csv(account_ids, tariffs, bills):
+    meter_accounts, meter_utilities, consumption, energy, standing = bills
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['user_id', 'utility_type', 'consumption', 'energy_charge', 'standing_charge', 'total'])
+    for account, utility, used, energy_charge, standing_charge in zip(
+            meter_accounts.tolist(), meter_utilities.tolist(), consumption.tolist(), energy.tolist(), standing.tolist()):
+        writer.writerow([
+            account_ids[account],
+            tariffs.utility_types[utility],
+            '%.3f' % used,
+            '%.2f' % energy_charge,
+            '%.2f' % standing_charge,
+            '%.2f' % (energy_charge + standing_charge)
+        ])
+    return out.getvalue()
+
+def lambda_handler(event, context):
+    """
+    Monthly billing run. Prices the previous calendar month for every account
+    and writes the result to bills/<yyyy-mm>.csv in the stack's bucket.
+    """
+    structured_log.start('billing', context, sample_rate=1.0)
+    tariffs = get_tariffs()
+    period_start, period_end = previous_month(time.time())
+
+    started = time.time()
+    user_ids, utility_names, timestamps, readings = scan_readings(
+        os.environ['METER_READING_TABLE_NAME'],
+        tariffs.utility_types,
+        period_start - LOOKBACK_DAYS * SECONDS_PER_DAY,
+        period_end
+    )
+    account_ids, accounts, utilities = encode(user_ids, utility_names, tariffs)
+    loaded = time.time()
+    bills = compute_bills(accounts, utilities, timestamps, readings, period_start, period_end, tariffs)
+    computed = time.time()
+
+    key = 'bills/%s.csv' % time.strftime('%Y-%m', time.gmtime(period_start))
+    aws_clients.s3().put_object(
+        Bucket=os.environ['BILLING_BUCKET'],
+        Key=key,
+        Body=write_bills_csv(account_ids, tariffs, bills).encode('utf-8')
+    )
+
+    structured_log.end(
+        readings=len(readings),
+        meters=len(bills[0]),
+        key=key,
+        scan_ms=int((loaded - started) * 1000),
+        compute_ms=int((computed - loaded) * 1000)
+    )
+    return { 'Key': key, 'Meters': len(bills[0]) }
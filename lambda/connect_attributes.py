@@ -1,37 +1,41 @@
-import boto3
 import os
 import time
 
-connect = boto3.client('connect')
+import aws_clients
+import structured_log
 
 def on_event(event, context):
-    print(event)
+    structured_log.start('connect_attributes.on_event', context, sample_rate=1.0, request_type=event['RequestType'])
+    structured_log.debug('event', event=event)
     request_type = event['RequestType']
-    if request_type == 'Create': return on_create(event)
-    if request_type == 'Update': return on_update(event)
-    if request_type == 'Delete': return on_delete(event)
-    raise Exception("Invalid request type: %s" % request_type)
+    try:
+        if request_type == 'Create': return on_create(event)
+        if request_type == 'Update': return on_update(event)
+        if request_type == 'Delete': return on_delete(event)
+        raise Exception("Invalid request type: %s" % request_type)
+    finally:
+        structured_log.end()
 
 def on_create(event):
     props = event["ResourceProperties"]
-    print("create new resource with props %s" % props)
+    structured_log.info("create new resource with props %s", props)
     instance_id = os.environ['InstanceId']
     key_arn = os.environ['KeyArn']
     bucket_name = os.environ['BucketName']
     recording_prefix = os.environ['RecordingPrefix']
     transcript_prefix = os.environ['TranscriptPrefix']
 
-    list_hours = connect.list_hours_of_operations(
+    list_hours = aws_clients.connect().list_hours_of_operations(
         InstanceId=instance_id,
     )
-    print(list_hours)
+    structured_log.debug("list hours of operations", response=list_hours)
     # Assume this is a new instance and only has the default hours of operations.
     # There is no method to create a new hours of operation.
     # We need this ID later when we create a queue.
     basic_hours_id = list_hours["HoursOfOperationSummaryList"][0]["Id"]
     
     # New queue so we can reference the Id later in our contact flow.
-    create_queue = connect.create_queue(
+    create_queue = aws_clients.connect().create_queue(
         InstanceId=instance_id,
         Name="DemoQueue",
         HoursOfOperationId=basic_hours_id
@@ -39,7 +43,7 @@ def on_create(event):
 
     demo_queue_id = create_queue["QueueId"]
 
-    create_contact_flow = connect.create_contact_flow(
+    create_contact_flow = aws_clients.connect().create_contact_flow(
         InstanceId=instance_id,
         Name='1 DemoContactFlow',
         Type='CONTACT_FLOW',
@@ -77,17 +81,17 @@ def on_create(event):
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
-    print("update resource %s with props %s" % (physical_id, props))
+    structured_log.info("update resource %s with props %s", physical_id, props)
     # ...
 
 def on_delete(event):
     physical_id = event["PhysicalResourceId"]
-    print("delete resource %s" % physical_id)
+    structured_log.info("delete resource %s", physical_id)
     # ...
     return { 'PhysicalResourceId': physical_id }
 
 def s3_storage_config(instance_id, resource_type, bucket_name, bucket_prefix, key_arn):
-    storage_config = connect.associate_instance_storage_config(
+    storage_config = aws_clients.connect().associate_instance_storage_config(
         InstanceId=instance_id,
         ResourceType=resource_type,
         StorageConfig={
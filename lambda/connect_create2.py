@@ -1,22 +1,26 @@
-import boto3
 import os
 
-connect = boto3.client('connect')
+import aws_clients
+import structured_log
 
 def on_event(event, context):
-    print(event)
+    structured_log.start('connect_create2.on_event', context, sample_rate=1.0, request_type=event['RequestType'])
+    structured_log.debug('event', event=event)
     request_type = event['RequestType']
-    if request_type == 'Create': return on_create(event)
-    if request_type == 'Update': return on_update(event)
-    if request_type == 'Delete': return on_delete(event)
-    raise Exception("Invalid request type: %s" % request_type)
+    try:
+        if request_type == 'Create': return on_create(event)
+        if request_type == 'Update': return on_update(event)
+        if request_type == 'Delete': return on_delete(event)
+        raise Exception("Invalid request type: %s" % request_type)
+    finally:
+        structured_log.end()
 
 def on_create(event):
     props = event["ResourceProperties"]
-    print("create new resource with props %s" % props)
+    structured_log.info("create new resource with props %s", props)
     connect_alias = os.environ['InstanceAlias']
 
-    response = connect.create_instance(
+    response = aws_clients.connect().create_instance(
         IdentityManagementType='CONNECT_MANAGED',
         InstanceAlias=connect_alias,
         InboundCallsEnabled=True,
@@ -34,36 +38,45 @@ def on_create(event):
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
-    print("update resource %s with props %s" % (physical_id, props))
+    structured_log.info("update resource %s with props %s", physical_id, props)
     # ...
 
 def on_delete(event):
     physical_id = event["PhysicalResourceId"]
-    print("delete resource %s" % physical_id)
+    structured_log.info("delete resource %s", physical_id)
     connect_alias = os.environ['InstanceAlias']
     
-    response = connect.list_instances()
+    response = aws_clients.connect().list_instances()
     for i in response["InstanceSummaryList"]:
         if i['InstanceStatus'] == 'ACTIVE':
             if i["InstanceAlias"] == connect_alias:
-                print("Deleting Instance Id %s" % i["Id"])
-                delete_instance = connect.delete_instance(
+                structured_log.info("Deleting Instance Id %s", i["Id"])
+                delete_instance = aws_clients.connect().delete_instance(
                     InstanceId=i["Id"]
                 )
 
 def is_complete(event, context):
-    physical_id = event["PhysicalResourceId"]
     request_type = event["RequestType"]
-    print("Event object %s" % event)
+    structured_log.start('connect_create2.is_complete', context, sample_rate=1.0, request_type=request_type)
+    structured_log.debug('event', event=event)
+    is_ready = None
+    try:
+        is_ready = ready(event)
+    finally:
+        structured_log.end(is_complete=is_ready)
+    return { 'IsComplete': is_ready }
+
+def ready(event):
+    request_type = event["RequestType"]
 
     if request_type == 'Create':    
         # We want to wait for the instance to be active before marking the resource as complete. 
         # Otherwise subsequent calls will fail.
-        response = connect.describe_instance(
+        response = aws_clients.connect().describe_instance(
             InstanceId=event['Data']['InstanceId']
         )
         if response["Instance"]["InstanceStatus"] == "ACTIVE":
-            print("Is Ready!!!")
+            structured_log.info("Is Ready!!!")
             is_ready = True
         else:
             is_ready = False
@@ -73,15 +86,14 @@ def is_complete(event, context):
     if request_type == 'Delete':
         connect_alias = os.environ['InstanceAlias']
 
-        response = connect.list_instances()
+        response = aws_clients.connect().list_instances()
         if not response["InstanceSummaryList"]:
             is_ready = True
         else:
             for i in response["InstanceSummaryList"]:
-                print(i)
+                structured_log.debug("instance summary", instance=i)
                 if i["InstanceAlias"] == connect_alias:
                     is_ready = False
                 else:
                     is_ready = True
-
-    return { 'IsComplete': is_ready }
\ No newline at end of file
+    return is_ready
\ No newline at end of file
@@ -0,0 +1,401 @@
+import decimal
+import os
+import time
+
+import aws_clients
+import deadline
+import structured_log
+
+# Per-user consumption rollups kept up to date from MeterReadingTable's stream.
+#
+# ConsumptionRollupTable is keyed by user_id and a period:
+#
+#   day#<yyyy-mm-dd>, month#<yyyy-mm>   consumption per utility, in total ("gas")
+#                                       and per UTC hour of the day ("gas#07"),
+#                                       so it can be priced against time-of-use
+#                                       bands when it is read (see billing.rollup_bill)
+#   meter#<utility>                     the stream sequence number of the last record
+#                                       applied to the meter, and its latest reading
+#                                       unless every reading has been deleted
+#   latest#<utility>                    the newest reading, written by meter_reading in
+#                                       the same transaction as a reading submitted
+#                                       through Lex and moved on by meter_ingest, and
+#                                       used to validate the next one; not touched here
+#
+# Readings are cumulative register values, so the consumption of an interval
+# is the difference between two consecutive readings of the same meter, and
+# counts towards the day and month of the later one. billing.compute_bills
+# works the same way.
+#
+# A reading newer than the meter's latest one extends it: the interval is
+# added to the day and month items and the meter item moves on, in one
+# transaction. Consecutive readings of a meter within a batch go into the same
+# transaction. A reading older than the latest one (a late arrival, a
+# corrected or deleted reading) splits or changes an interval that has already
+# been counted, so the days it touches are recomputed from MeterReadingTable
+# and the difference is applied to the month.
+#
+# Records of one user_id arrive in order, and a record whose sequence number
+# is no later than the meter's is one that has been applied already, which is
+# what makes redelivered batches safe to apply again.
+
+# Meter registers have 6 digits and wrap back to zero.
+REGISTER_ROLLOVER = 1000000
+# A reading below the one before it is only taken as the register wrapping back
+# to zero when the one before was this close to the top. Any other drop (a
+# misread or a replaced meter) counts as no consumption.
+ROLLOVER_MARGIN = 10000
+SECONDS_PER_DAY = 86400
+HOURS = ['%02d' % hour for hour in range(24)]
+
+# TransactWriteItems takes at most 100 items: a meter item, and a day and a
+# month item per day a run of readings covers.
+MAX_RUN_PERIODS = 98
+
+READINGS_PAGE_SIZE = 100
+
+class Reading(object):
+    __slots__ = ('timestamp', 'reading')
+
+    def __init__(self, timestamp, reading):
+        self.timestamp = decimal.Decimal(timestamp)
+        self.reading = decimal.Decimal(reading)
+
+def day_start(timestamp):
+    return int(timestamp) // SECONDS_PER_DAY * SECONDS_PER_DAY
+
+def day_period(timestamp):
+    return 'day#' + time.strftime('%Y-%m-%d', time.gmtime(int(timestamp)))
+
+def month_period(timestamp):
+    return 'month#' + time.strftime('%Y-%m', time.gmtime(int(timestamp)))
+
+def meter_period(utility_type):
+    return 'meter#' + utility_type
+
+def rolled_over(previous):
+    """
+    Whether a drop from the register value previous is the register wrapping
+    back to zero. Works on NumPy arrays too.
+    """
+    return previous >= REGISTER_ROLLOVER - ROLLOVER_MARGIN
+
+def used_between(previous, current):
+    used = current.reading - previous.reading
+    if used >= 0:
+        return used
+    if rolled_over(previous.reading):
+        return used + REGISTER_ROLLOVER
+    structured_log.info('reading lower than the one before', timestamp=str(current.timestamp),
+        previous=str(previous.reading), reading=str(current.reading))
+    return decimal.Decimal(0)
+
+def interval_values(utility_type, current, used):
+    """
+    The attributes an interval ending with current adds to its day and month.
+    """
+    hour = HOURS[int(current.timestamp) % SECONDS_PER_DAY // 3600]
+    return { utility_type: used, '%s#%s' % (utility_type, hour): used }
+
+def utility_attributes(utility_type):
+    return [utility_type] + ['%s#%s' % (utility_type, hour) for hour in HOURS]
+
+def _number(value):
+    return { 'N': str(value) }
+
+def _add_values(total, values):
+    for name, value in values.items():
+        total[name] = total.get(name, 0) + value
+
+def _update(user_id, period, values, action='ADD'):
+    """
+    A TransactWriteItems Update adding values to (or with action='SET', setting
+    them on) one rollup item.
+    """
+    names, expression_values, clauses = {}, {}, []
+    for i, (name, value) in enumerate(sorted(values.items())):
+        names['#a%d' % i] = name
+        expression_values[':v%d' % i] = _number(value)
+        clauses.append(('#a%d :v%d' if action == 'ADD' else '#a%d = :v%d') % (i, i))
+    return { 'Update': {
+        'TableName': os.environ['ROLLUP_TABLE_NAME'],
+        'Key': { 'user_id': { 'S': user_id }, 'period': { 'S': period } },
+        'UpdateExpression': '%s %s' % (action, ', '.join(clauses)),
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': expression_values,
+    } }
+
+class Meter(object):
+    """
+    Rollup state for one user's meter of one utility type while a batch is
+    being applied.
+    """
+
+    def __init__(self, user_id, utility_type):
+        self.user_id = user_id
+        self.utility_type = utility_type
+        self.latest = None
+        self.sequence = 0
+        # the meter item's sequence as stored, which the next transaction is conditional on
+        self._stored_sequence = None
+        self._load()
+        self._run = {}
+
+    def _load(self):
+        response = aws_clients.dynamodb().get_item(
+            TableName=os.environ['ROLLUP_TABLE_NAME'],
+            Key={ 'user_id': { 'S': self.user_id }, 'period': { 'S': meter_period(self.utility_type) } },
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if item:
+            self.sequence = self._stored_sequence = int(item['sequence']['N'])
+            if 'timestamp' in item:
+                self.latest = Reading(item['timestamp']['N'], item['reading']['N'])
+
+    def applied(self, sequence):
+        return sequence <= self.sequence
+
+    def add(self, reading, sequence):
+        """
+        Apply a newly inserted reading.
+        """
+        if self.applied(sequence):
+            return 'duplicate'
+        if self.latest is not None and reading.timestamp <= self.latest.timestamp:
+            self.recompute(reading.timestamp, sequence)
+            return 'recomputed'
+
+        # the first reading seen for a meter carries on from whatever is already in the table
+        previous = self.latest or self.previous_reading(reading.timestamp)
+        if previous is not None:
+            if len(self._run) >= MAX_RUN_PERIODS:
+                self.flush()
+            values = interval_values(self.utility_type, reading, used_between(previous, reading))
+            _add_values(self._run.setdefault(day_period(reading.timestamp), {}), values)
+            _add_values(self._run.setdefault(month_period(reading.timestamp), {}), values)
+        self.latest = reading
+        self.sequence = sequence
+        return 'added'
+
+    def changed(self, timestamp, sequence):
+        """
+        Apply a reading that was modified or deleted.
+        """
+        if self.latest is None or self.applied(sequence):
+            return 'duplicate'
+        self.recompute(timestamp, sequence)
+        return 'recomputed'
+
+    def flush(self):
+        """
+        Write out the readings added since the last flush.
+        """
+        if self._stored_sequence == self.sequence and not self._run:
+            return
+        if self.latest is None:
+            # nothing but a deleted reading's record seen
+            return
+        self._transact(self.latest, self.sequence, [
+            _update(self.user_id, period, values) for period, values in sorted(self._run.items())
+        ])
+        self._run = {}
+
+    def recompute(self, timestamp, sequence):
+        """
+        Recount the days whose intervals a reading at timestamp is part of: its
+        own, and the day of the next reading.
+        """
+        self.flush()
+        # None once every reading of the meter has been deleted
+        latest = self.previous_reading(self.latest.timestamp, inclusive=True)
+        until = latest.timestamp if latest is not None else timestamp
+        days = set([day_start(timestamp)])
+        following = self.next_reading(timestamp, until)
+        if following is not None:
+            days.add(day_start(following.timestamp))
+
+        items = []
+        month_changes = {}
+        for start in sorted(days):
+            values = self.day_values(start, until)
+            stored = self.stored_day(start)
+            change = {name: values[name] - stored.get(name, 0) for name in values}
+            change = {name: value for name, value in change.items() if value}
+            if change:
+                items.append(_update(self.user_id, day_period(start), values, action='SET'))
+                _add_values(month_changes.setdefault(month_period(start), {}), change)
+        for period, values in sorted(month_changes.items()):
+            items.append(_update(self.user_id, period, values))
+
+        self._transact(latest, sequence, items)
+
+    def _transact(self, latest, sequence, items):
+        """
+        Write items together with the meter item moved on to latest and
+        sequence, and only then take those as the meter's state.
+        """
+        aws_clients.dynamodb().transact_write_items(TransactItems=[self._meter_item(latest, sequence)] + items)
+        self.latest = latest
+        self.sequence = self._stored_sequence = sequence
+
+    def _meter_item(self, latest, sequence):
+        item = { 'Put': {
+            'TableName': os.environ['ROLLUP_TABLE_NAME'],
+            'Item': {
+                'user_id': { 'S': self.user_id },
+                'period': { 'S': meter_period(self.utility_type) },
+                'sequence': _number(sequence),
+            },
+        } }
+        if latest is not None:
+            item['Put']['Item']['timestamp'] = _number(latest.timestamp)
+            item['Put']['Item']['reading'] = _number(latest.reading)
+        if self._stored_sequence is None:
+            item['Put']['ConditionExpression'] = 'attribute_not_exists(user_id)'
+        else:
+            item['Put']['ConditionExpression'] = '#s = :s'
+            item['Put']['ExpressionAttributeNames'] = { '#s': 'sequence' }
+            item['Put']['ExpressionAttributeValues'] = { ':s': _number(self._stored_sequence) }
+        return item
+
+    def stored_day(self, start):
+        response = aws_clients.dynamodb().get_item(
+            TableName=os.environ['ROLLUP_TABLE_NAME'],
+            Key={ 'user_id': { 'S': self.user_id }, 'period': { 'S': day_period(start) } },
+            ProjectionExpression=', '.join('#a%d' % i for i in range(25)),
+            ExpressionAttributeNames={ '#a%d' % i: name for i, name in enumerate(utility_attributes(self.utility_type)) },
+            ConsistentRead=True
+        )
+        return {name: decimal.Decimal(value['N']) for name, value in response.get('Item', {}).items()}
+
+    def day_values(self, start, until):
+        """
+        The day's consumption recounted from MeterReadingTable, up to and
+        including the reading at until.
+        """
+        values = dict.fromkeys(utility_attributes(self.utility_type), decimal.Decimal(0))
+        previous = self.previous_reading(start)
+        for reading in self.readings(start, newest_first=False):
+            if reading.timestamp >= start + SECONDS_PER_DAY or reading.timestamp > until:
+                break
+            if previous is not None:
+                _add_values(values, interval_values(self.utility_type, reading, used_between(previous, reading)))
+            previous = reading
+        return values
+
+    def previous_reading(self, timestamp, inclusive=False):
+        for reading in self.readings(timestamp, newest_first=True, inclusive=inclusive):
+            return reading
+        return None
+
+    def next_reading(self, timestamp, until):
+        for reading in self.readings(timestamp, newest_first=False, inclusive=False):
+            return reading if reading.timestamp <= until else None
+        return None
+
+    def readings(self, timestamp, newest_first, inclusive=True):
+        """
+        The meter's readings in MeterReadingTable from timestamp, going back in
+        time if newest_first and forward otherwise.
+        """
+        operator = ('<' if newest_first else '>') + ('=' if inclusive else '')
+        args = {
+            'TableName': os.environ['METER_READING_TABLE_NAME'],
+            'KeyConditionExpression': '#u = :u AND #t %s :t' % operator,
+            'FilterExpression': '#y = :y',
+            'ProjectionExpression': '#t, #r',
+            'ExpressionAttributeNames': { '#u': 'user_id', '#t': 'timestamp', '#r': 'reading', '#y': 'utility_type' },
+            'ExpressionAttributeValues': {
+                ':u': { 'S': self.user_id },
+                ':t': _number(timestamp),
+                ':y': { 'S': self.utility_type },
+            },
+            'ScanIndexForward': not newest_first,
+            'Limit': READINGS_PAGE_SIZE,
+        }
+        while True:
+            response = aws_clients.dynamodb().query(**args)
+            for item in response['Items']:
+                yield Reading(item['timestamp']['N'], list(item['reading'].values())[0])
+            if 'LastEvaluatedKey' not in response:
+                return
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _meter_of(image):
+    return image['user_id']['S'], image['utility_type']['S']
+
+def _reading_of(image):
+    return Reading(image['timestamp']['N'], list(image['reading'].values())[0])
+
+def apply_record(meters, record):
+    """
+    Apply one stream record. meters caches the Meter objects of the batch.
+    """
+    change = record['dynamodb']
+    sequence = int(change['SequenceNumber'])
+    old, new = change.get('OldImage'), change.get('NewImage')
+
+    def meter(image):
+        key = _meter_of(image)
+        if key not in meters:
+            meters[key] = Meter(*key)
+        return meters[key]
+
+    if record['eventName'] == 'INSERT':
+        return meter(new).add(_reading_of(new), sequence)
+    if record['eventName'] == 'REMOVE':
+        return meter(old).changed(_reading_of(old).timestamp, sequence)
+    if _meter_of(old) == _meter_of(new):
+        if _reading_of(old).reading == _reading_of(new).reading:
+            return 'duplicate'
+        return meter(new).changed(_reading_of(new).timestamp, sequence)
+    meter(old).changed(_reading_of(old).timestamp, sequence)
+    return meter(new).add(_reading_of(new), sequence)
+
+def lambda_handler(event, context):
+    """
+    DynamoDB Streams consumer for MeterReadingTable.
+
+    Readings added to a meter are only written when its run is flushed, so
+    when a record can't be applied the records before it are flushed and it is
+    reported as the batch item failure: the retry starts from it, and a record
+    that keeps failing ends up in the event source's on-failure queue. If a
+    flush fails, the batch's first record is reported instead, so the whole
+    batch is retried; records that were applied already are recognised by
+    their sequence number and skipped.
+    """
+    structured_log.start('consumption_rollup', context, batch_size=len(event['Records']))
+    meters = {}
+    outcomes = {}
+    failed_record = None
+    for record in event['Records']:
+        try:
+            outcome = apply_record(meters, record)
+        except Exception as e:
+            structured_log.error('failed to apply record %s: %s', record['dynamodb']['SequenceNumber'], e)
+            failed_record = record
+            break
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    for meter in meters.values():
+        try:
+            meter.flush()
+        except Exception as e:
+            structured_log.error('failed to write rollups for %s: %s', meter.user_id, e)
+            failed_record = event['Records'][0]
+
+    structured_log.end(meters=len(meters), failed=failed_record is not None, **outcomes)
+    if failed_record is not None:
+        return { 'batchItemFailures': [{ 'itemIdentifier': failed_record['dynamodb']['SequenceNumber'] }] }
+    return { 'batchItemFailures': [] }
+
+def get_month(user_id, timestamp=None):
+    """
+    The month's rollup for a user as a dict of Decimals, or None if there is no
+    consumption for it yet.
+    """
+    response = deadline.table(os.environ['ROLLUP_TABLE_NAME'], 'rollup_read').get_item(
+        Key={ 'user_id': str(user_id), 'period': month_period(timestamp or time.time()) }
+    )
+    return response.get('Item')
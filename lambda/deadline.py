@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+from botocore.exceptions import ConnectTimeoutError, ReadTimeoutError
+
+import aws_clients
+import aws_metrics
+import structured_log
+
+# Time budget for one Lex code hook turn.
+#
+# start() sets the turn's deadline from the Lambda context, less a reserve for
+# building a fallback response, and capped at TURN_BUDGET_MS if that is set.
+# Every downstream call is named in CALLS with its own connect timeout, read
+# timeout and attempt count, and gets clients built with exactly those. Before
+# a call is made, client()/table() check that its worst case still fits in
+# what is left of the budget and raise BudgetExceeded if not, so the handler
+# can answer Lex with a fallback instead of being killed at its timeout.
+# Botocore timeouts count as running out of budget too (see EXCEEDED).
+#
+# CALL_TIMEOUTS overrides the defaults as JSON, e.g. {"user_lookup": [0.2, 0.5, 2]}.
+
+RESERVE_MS = int(os.environ.get('DEADLINE_RESERVE_MS', '250'))
+TURN_BUDGET_MS = int(os.environ['TURN_BUDGET_MS']) if os.environ.get('TURN_BUDGET_MS') else None
+
+# Added to an attempt's timeouts for retry backoff.
+BACKOFF_MS = 100
+
+# call -> (connect timeout s, read timeout s, max attempts)
+CALLS = {
+    'user_lookup': (0.2, 0.5, 2),
+    'otp_write': (0.2, 0.5, 2),
+    'otp_read': (0.2, 0.5, 2),
+    'otp_secret': (0.2, 1.0, 2),
+    'rate_limit': (0.2, 0.5, 2),
+    'sms': (0.2, 0.5, 2),
+    'reading_write': (0.2, 0.8, 2),
+    'latest_read': (0.2, 0.5, 2),
+    'history': (0.2, 0.8, 2),
+    'rollup_read': (0.2, 0.5, 2),
+    'leak_lookup': (0.2, 0.5, 2),
+}
+CALLS.update({name: tuple(value) for name, value in json.loads(os.environ.get('CALL_TIMEOUTS') or '{}').items()})
+
+class BudgetExceeded(Exception):
+
+    def __init__(self, call, remaining_ms):
+        super(BudgetExceeded, self).__init__('%s needs up to %dms, %dms left' % (call, worst_case_ms(call), remaining_ms))
+        self.call = call
+
+# What a code hook catches to fall back instead of failing the turn.
+EXCEEDED = (BudgetExceeded, ConnectTimeoutError, ReadTimeoutError)
+
+_turn = {
+    'deadline': None,
+}
+
+def start(context):
+    """
+    Begin a turn. Without a context (local runs) there is no deadline.
+    """
+    remaining_ms = context.get_remaining_time_in_millis() if context is not None else None
+    if remaining_ms is None:
+        _turn['deadline'] = None
+        return
+    budget_ms = remaining_ms - RESERVE_MS
+    if TURN_BUDGET_MS is not None:
+        budget_ms = min(budget_ms, TURN_BUDGET_MS)
+    _turn['deadline'] = time.time() + budget_ms / 1000.0
+
+def remaining_ms():
+    if _turn['deadline'] is None:
+        return float('inf')
+    return (_turn['deadline'] - time.time()) * 1000.0
+
+def worst_case_ms(call):
+    connect_timeout, read_timeout, max_attempts = CALLS[call]
+    return max_attempts * (connect_timeout + read_timeout) * 1000.0 + (max_attempts - 1) * BACKOFF_MS
+
+def require(call):
+    left = remaining_ms()
+    if left < worst_case_ms(call):
+        raise BudgetExceeded(call, left)
+
+def client(service_name, call):
+    require(call)
+    return aws_clients.client(service_name, CALLS[call])
+
+def table(table_name, call):
+    require(call)
+    return aws_clients.table(table_name, CALLS[call])
+
+def exceeded(error):
+    """
+    Record a turn that ran out of time.
+    """
+    structured_log.error('turn out of time: %s', error)
+    structured_log.bind(deadline_exceeded=getattr(error, 'call', type(error).__name__))
+    aws_metrics.count('DeadlineExceeded')
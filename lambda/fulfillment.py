@@ -0,0 +1,69 @@
+import importlib
+import time
+
+import deadline
+import intents
+import lex_event
+import structured_log
+import user_cache
+import warmup
+
+# The one Lambda behind every Lex code hook of the bot.
+#
+# intents.INTENTS says which module handles an intent, for each invocation
+# source: identity_verification runs the authentication dialog and meter_reading
+# fulfils. A module is only imported the first time one of its intents comes
+# in, so a turn doesn't load code it doesn't run (meter_reading pulls in
+# NumPy through billing), and whatever the modules share, such as the
+# aws_clients clients and user_cache, is one warm copy per execution
+# environment. Every handler module has a dispatch(lex) that returns the Lex
+# response, and a WARM_UP.
+#
+# Adding an intent only needs an entry in intents.INTENTS, plus the module's
+# own handling.
+
+HANDLER_MODULES = sorted(set(name for sources in intents.INTENTS.values() for name in sources.values()))
+
+_loaded = {}
+
+def route(lex):
+    module_name = intents.INTENTS.get(lex.intent_name, {}).get(lex.invocation_source)
+    if module_name is None:
+        raise Exception('Intent with name %s not supported for %s' % (lex.intent_name, lex.invocation_source))
+    return module_name
+
+def load(module_name):
+    """
+    The handler module, imported on first use. The import time is logged with
+    the turn that paid for it.
+    """
+    module = _loaded.get(module_name)
+    if module is None:
+        start = time.time()
+        # waits for the module's init to finish if another thread is importing it
+        module = _loaded[module_name] = importlib.import_module(module_name)
+        structured_log.bind(handler_import_ms=int((time.time() - start) * 1000))
+    return module
+
+def warm_up():
+    start = time.time()
+    for module_name in HANDLER_MODULES:
+        warmup.warm(**load(module_name).WARM_UP)
+    return { warmup.PING: True, 'elapsed_ms': int((time.time() - start) * 1000) }
+
+def lambda_handler(event, context):
+    if warmup.is_ping(event):
+        return warm_up()
+    lex = lex_event.parse(event)
+    module_name = route(lex)
+    structured_log.start('fulfillment', context, intent=lex.intent_name, lex_version=lex.version, handler_module=module_name)
+    deadline.start(context)
+    structured_log.debug('event', event=event)
+    response = load(module_name).dispatch(lex)
+    structured_log.end(dialog_action=lex_event.dialog_action_type(response), user_cache=user_cache.stats)
+    return response
+
+if warmup.provisioned():
+    # every handler module warms itself up as it is imported (warmup.on_init)
+    for module_name in HANDLER_MODULES:
+        load(module_name)
@@ -1,359 +1,269 @@
-import json
-import boto3
-import logging
-import uuid
-import random
 import time
 import os
-from base64 import b64decode
 from botocore.exceptions import ClientError
 
-logger = logging.getLogger()
-sns_client = boto3.client('sns')
-ddb_idv = boto3.client('dynamodb')
-ddb_users = boto3.resource('dynamodb')
-user_table = ddb_users.Table(os.environ['USER_TABLE_NAME'])
-
-def close(session_attributes, fulfillment_state, message):
-    response = {
-        'sessionAttributes': session_attributes,
-        'dialogAction': {
-            'type': 'Close',
-            'fulfillmentState': fulfillment_state,
-            'message': {
-              "contentType": "PlainText",
-              "content": message
-            },
-        }
-    }
-
-    return response
-
-def elicit_slot(session_attributes, intent_name, slots, slot_to_elicit, message):
-    return {
-        'sessionAttributes': session_attributes,
-        'dialogAction': {
-            'type': 'ElicitSlot',
-            'intentName': intent_name,
-            'slots': slots,
-            'slotToElicit': slot_to_elicit,
-            'message': message
-        }
-    }
-
-
-def delegate(session_attributes, slots):
-    return {
-        'sessionAttributes': session_attributes,
-        'dialogAction': {
-            'type': 'Delegate',
-            'slots': slots
-        }
-    }
-
-def try_ex(func):
-    """
-    Call passed in function in try block. If KeyError is encountered return None.
-    This function is intended to be used to safely access dictionary.
-
-    Note that this function would have negative impact on performance.
-    """
-
-    try:
-        return func()
-    except KeyError:
-        return None
-
-def get_one_time_code():
-    #write onetime code to ddb - with this contact ID. as the primary key
-    rand_uuid = str(uuid.uuid4())
-    epoch = int(time.time())
-    OTP = ''
-    for _ in range(6):
-        OTP += str(random.randint(0,9))
-    var = ddb_idv.put_item(
-        TableName=os.environ['OTP_TABLE_NAME'],
-        Item={
-            'uuid': {'S':str(rand_uuid)},
-            'pin': {'S':str(OTP)},
-            'timeStamp': {'N':str(epoch)}
-            }
-    )
-    #return one time random 6 digit key
-    return rand_uuid, OTP
+import deadline
+import lex_event
+import otp
+import rate_limiter
+import session_codec
+import sms_queue
+import structured_log
+import user_cache
+import warmup
 
 def send_pin(phone_number, msg):
-    #query user phone number from ddb table
-    result = sns_client.publish(PhoneNumber=phone_number, Message=msg)
+    #queued for sms_sender when SMS_DELIVERY=async, otherwise published inline
+    result = sms_queue.send(phone_number, msg)
     return result
 
 
 def get_user_details(user_id):
     #ID verification section - user_id and vcode
     try:
-        response = user_table.query(
-            ExpressionAttributeValues={
-                ':user_id': user_id
-            },
-            IndexName = 'user_id-index',
-            KeyConditionExpression='user_id = :user_id',
-        )
+        item = user_cache.get_user(user_id)
     except ClientError as e:
-        print(e.response['Error']['Message'])
+        structured_log.error('user lookup failed: %s', e.response['Error']['Message'])
     else:
-        items = response['Items']
-        if not items:
+        if not item:
             return None
         else:
-            email = try_ex(lambda: items[0]["email"])
-            phone_num = try_ex(lambda: items[0]['PhoneNumber'])
-            customerName = try_ex(lambda: items[0]['firstName'])
+            email = item.get("email")
+            phone_num = item.get('PhoneNumber')
+            customerName = item.get('firstName')
 
             return email, phone_num, customerName
 
-def check_pin(pin, uuid):
-
-    epoch = int(time.time())
-    #queries DDB table for the OTP based on the uuid
-    result = ddb_idv.get_item(
-        TableName=os.environ['OTP_TABLE_NAME'],
-        Key={'uuid': {'S':str(uuid)}}
-    )
-    if result['ResponseMetadata']['HTTPStatusCode'] == 200:
-        if 'Item' in result.keys():
-            correct_pin = result['Item']['pin']['S']
-            timestamp = result['Item']['timeStamp']['N']
-            valid = epoch - int(timestamp) < 60
-            if not valid:
-                print("expired")
-            if pin == correct_pin and valid:
-                return True
-            else:
-                return False
-    else:
-        logger.debug('dynamodb request error')
-        return False
+# Prompts shared by every intent that goes through the authentication flow.
+DEFAULT_PROMPTS = {
+    'user_id': 'Before we start, what is your account ID?',
+    'unknown_user': 'Sorry, your user id is incorrect, can you provide me again your user ID?',
+    'code_sent': 'Thank you! We have just sent you a 6 digits verification code to your mobile. Do you mind providing it back to me?',
+    'code_retry': 'Sorry, your verification code is incorrect. Let us try again. We have just sent you another 6 digits verification code to your mobile. Do you mind providing the latest one back to me?',
+    'code_failed': 'Sorry, your verification code is still incorrect, please contact customer support.',
+    'lookup_failed': 'Sorry, we are having problem retrieving your information, please contact customer support.',
+    'rate_limited': 'Sorry, we have sent too many verification codes for this account recently. Please try again later.',
+    'code_delayed': 'It is taking a little longer than usual to send your verification code, we will text it to you shortly. Do you mind providing it back to me when it arrives?',
+    'out_of_time': 'Sorry, our systems are taking longer than usual to respond. Please try again in a few minutes.',
+    'caller_code_sent': 'We have recognised the number you are calling from and just sent you a 6 digits verification code to your mobile. Do you mind providing it back to me?',
+}
+
+# Session attribute the contact flow sets to the caller's number
+# ($.CustomerEndpoint.Address). When it matches a customer's PhoneNumber the
+# account ID is not asked for.
+CALLER_ID_ATTRIBUTE = os.environ.get('CALLER_ID_ATTRIBUTE', 'CallerNumber')
+
+# Intents that require the caller to be authenticated before Lex carries on
+# eliciting the remaining slots. Adding a self-service intent only needs an
+# entry here, overriding any prompts that differ from DEFAULT_PROMPTS.
+AUTHENTICATED_INTENTS = {
+    'MeterReading': {
+        'user_id': 'Thanks for submitting your meter read with us. Before we start, what is your account ID?',
+    },
+    'WaterLeak': {
+        'user_id': 'Before we start, what is your account number? This should be 7 digits',
+        'unknown_user': 'Sorry, your account number is incorrect, can you provide your account number again?',
+    },
+    'ReadingHistory': {},
+    'BillingEnquiry': {},
+}
+
+# Number of one time codes a caller gets before the flow gives up.
+MAX_CODES_SENT = 2
+
+# Session attribute set once a WaterLeak caller is verified, if the nightly
+# leak detection (leak_detection.py) has flagged their meters: a comma
+# separated list of <utility type>:<reason>, for the bot's prompts and the
+# contact flow to act on.
+LEAK_ALERT_ATTRIBUTE = 'LeakAlert'
+
+# The utility types whose leak flags are alerted on, by intent.
+LEAK_ALERT_UTILITIES = {
+    'WaterLeak': frozenset(['water']),
+}
+
+# Message dicts are built once per container and shared by every response.
+PROMPTS = {
+    intent_name: {key: lex_event.plain_text(value) for key, value in dict(DEFAULT_PROMPTS, **overrides).items()}
+    for intent_name, overrides in AUTHENTICATED_INTENTS.items()
+}
+
+ELICIT_USER_ID = 'ElicitUserId'
+SEND_CODE = 'SendCode'
+VERIFY_CODE = 'VerifyCode'
+AUTHENTICATED = 'Authenticated'
+
+def auth_state(slots, state):
+    if not slots['UserId']:
+        return ELICIT_USER_ID
+    # a different account ID from the one being verified starts again
+    if not slots['vcode'] or state.get('user_id') != str(slots['UserId']):
+        return SEND_CODE
+    if not state.get('auth'):
+        return VERIFY_CODE
+    return AUTHENTICATED
+
+# send_code() results
+CODE_SENT = 'sent'
+CODE_DELAYED = 'delayed'
+
+def send_code(state, user_id, customer_name, phone_num):
+    """
+    Generate and text a new one time code, unless the phone number or account
+    has had too many codes recently. Returns None if nothing was sent, and
+    CODE_DELAYED if the code was issued but the turn ran out of time handing
+    the text over.
+    """
+    if not rate_limiter.allow_otp(phone_num, user_id):
+        return None
+    nonce, one_time_code = otp.issue(user_id)
+    state['uuid'] = nonce
+    msg = 'Hi {}! This is your one time code: '.format(customer_name) + one_time_code
+    try:
+        send_pin(phone_num, msg)
+    except deadline.EXCEEDED as e:
+        deadline.exceeded(e)
+        return CODE_DELAYED
+    return CODE_SENT
 
-# function to perform IDV through verification code sent through email.
-def identity_verification(user_id,vcode):
-    #ID verification section - user_id and vcode
+def caller_id_user(lex, state):
+    """
+    The user_id registered to the number the caller is ringing from, if any.
+    Only tried on the first turn, so a caller who isn't recognised is asked for
+    their account ID as usual.
+    """
+    caller_number = lex.session_attributes.get(CALLER_ID_ATTRIBUTE)
+    if not caller_number or state.get('caller_id_checked'):
+        return None
+    state['caller_id_checked'] = 1
     try:
-        response = user_table.query(
-            ExpressionAttributeValues={
-                ':user_id': user_id
-            },
-            IndexName = 'user_id-index',
-            KeyConditionExpression='user_id = :user_id',
-        )
+        item = user_cache.get_user_by_phone(caller_number)
     except ClientError as e:
-        print(e.response['Error']['Message'])
-    else:
-        items = response['Items']
-        if not items:
-            return -1
-        else:
-            # print("Found user")
-            # print(items)
-            if str(vcode) == str(items[0]["vcode"]):
-                return 1
-            else:
-                return 0
-
-def meter_reading(intent_request):
-    slots = intent_request['currentIntent']['slots']
-    user_id = intent_request['currentIntent']['slots']['UserId']
-    vcode = intent_request['currentIntent']['slots']['vcode']
-    print (user_id,vcode)
-
-    print(intent_request['sessionAttributes'])
-    output_session_attributes = intent_request['sessionAttributes']
-    authenticated = 0
-    if output_session_attributes !={}:
-        if "auth" in output_session_attributes:
-            authenticated = output_session_attributes["auth"]
-
-    if not user_id:
-        return elicit_slot(
-                        output_session_attributes,
-                        'MeterReading',
-                        slots,
-                        'UserId',
-                        {'contentType': 'PlainText', 'content': 'Thanks for submitting your meter read with us. Before we start, what is your account ID?'}
-                        )
-    elif not vcode:
-        #alternatively, use OTP:
-        customerinfo = get_user_details(user_id)
-        #if not able to find user info with user_id provided
-        if not customerinfo:
-            return elicit_slot(
-                        output_session_attributes,
-                        'MeterReading',
-                        slots,
-                        'UserId',
-                        {'contentType': 'PlainText', 'content': 'Sorry, your user id is incorrect, can you provide me again your user ID?'}
-                        )
-
-        else:
-            email, phone_num, customerName = customerinfo
-            if phone_num and customerName:
-                rand_uuid, one_time_code = get_one_time_code()
-
-                output_session_attributes['uuid'] = rand_uuid
-                output_session_attributes['customer_phone'] = phone_num
-                output_session_attributes['customer_name'] = customerName
-                slots['Phone'] = phone_num
-                msg = 'Hi {}! This is your one time code: '.format(customerName) + one_time_code
-                result = send_pin(phone_num, msg)
-                output_session_attributes['count'] = 1
-                return elicit_slot(
-                            output_session_attributes,
-                            'MeterReading',
-                            slots,
-                            'vcode',
-                            {'contentType': 'PlainText', 'content': 'Thank you! We have just sent you a 6 digits verification code to your mobile. Do you mind providing it back to me?'}
-                            )
-            else:
-                return close(output_session_attributes, 'Fulfilled', 'Sorry, we are having problem retrieving your information, please contact customer support.')
-
-    elif authenticated ==0:
-        #auth = identity_verification(user_id,vcode)
-        uuid = try_ex(lambda: output_session_attributes['uuid'])
-        # count is number of OPT sent already
-        count = int(try_ex(lambda: output_session_attributes['count']))
-        auth = check_pin(vcode, uuid)
-        print (auth)
-        if auth:
-            output_session_attributes["auth"] = auth
-            return delegate(output_session_attributes, intent_request['currentIntent']['slots'])
-        else:
-            if count < 2:
-                rand_uuid, one_time_code = get_one_time_code()
-                output_session_attributes['uuid'] = rand_uuid
-                phone_num = slots['Phone']
-                customerName = output_session_attributes['customer_name']
-                msg = 'Hi {}! This is your one time code: '.format(customerName) + one_time_code
-                result = send_pin(phone_num, msg)
-                output_session_attributes['count'] = count+1
-
-                return elicit_slot(
-                            output_session_attributes,
-                            'MeterReading',
-                            slots,
-                            'vcode',
-                            {'contentType': 'PlainText', 'content': 'Sorry, your verification code is incorrect. Let us try again. We have just sent you another 6 digits verification code to your mobile. Do you mind providing the latest one back to me?'}
-                            )
-            else:
-                return close(output_session_attributes, 'Fulfilled', 'Sorry, your verification code is still incorrect, please contact customer support.')
-    # authenticated ==1 and we can delegate elicit slot to Lex
-    else:
-        return delegate(output_session_attributes, intent_request['currentIntent']['slots'])
-
-
-def water_leak(intent_request):
-    slots = intent_request['currentIntent']['slots']
-    user_id = intent_request['currentIntent']['slots']['UserId']
-    vcode = intent_request['currentIntent']['slots']['vcode']
-    print (user_id,vcode)
-
-    print(intent_request['sessionAttributes'])
-    output_session_attributes = intent_request['sessionAttributes']
-    authenticated = 0
-    if output_session_attributes !={}:
-        if "auth" in output_session_attributes:
-            authenticated = output_session_attributes["auth"]
-
-    if not user_id:
-        return elicit_slot(
-                        output_session_attributes,
-                        'WaterLeak',
-                        slots,
-                        'UserId',
-                        {'contentType': 'PlainText', 'content': 'Before we start, what is your account number? This should be 7 digits'}
-                        )
-    elif not vcode:
-        #alternatively, use OTP:
-        customerinfo = get_user_details(user_id)
-        #if not able to find user info with user_id provided
-        if not customerinfo:
-            return elicit_slot(
-                        output_session_attributes,
-                        'WaterLeak',
-                        slots,
-                        'UserId',
-                        {'contentType': 'PlainText', 'content': 'Sorry, your account number is incorrect, can you provide your account number again?'}
-                        )
-
-        else:
-            email, phone_num, customerName = customerinfo
-            if phone_num and customerName:
-                rand_uuid, one_time_code = get_one_time_code()
-
-                output_session_attributes['uuid'] = rand_uuid
-                output_session_attributes['customer_phone'] = phone_num
-                output_session_attributes['customer_name'] = customerName
-                slots['Phone'] = phone_num
-                msg = 'Hi {}! This is your one time code: '.format(customerName) + one_time_code
-                result = send_pin(phone_num, msg)
-                output_session_attributes['count'] = 1
-                return elicit_slot(
-                            output_session_attributes,
-                            'WaterLeak',
-                            slots,
-                            'vcode',
-                            {'contentType': 'PlainText', 'content': 'Thank you! We have just sent you a 6 digits verification code to your mobile. Do you mind providing it back to me?'}
-                            )
-            else:
-                return close(output_session_attributes, 'Fulfilled', 'Sorry, we are having problem retrieving your information, please contact customer support.')
-
-    elif authenticated ==0:
-        #auth = identity_verification(user_id,vcode)
-        uuid = try_ex(lambda: output_session_attributes['uuid'])
-        # count is number of OPT sent already
-        count = int(try_ex(lambda: output_session_attributes['count']))
-        auth = check_pin(vcode, uuid)
-        if auth:
-            output_session_attributes["auth"] = auth
-            return delegate(output_session_attributes, intent_request['currentIntent']['slots'])
-        else:
-            if count < 2:
-                rand_uuid, one_time_code = get_one_time_code()
-                output_session_attributes['uuid'] = rand_uuid
-                phone_num = slots['Phone']
-                customerName = output_session_attributes['customer_name']
-                msg = 'Hi {}! This is your one time code: '.format(customerName) + one_time_code
-                result = send_pin(phone_num, msg)
-                output_session_attributes['count'] = count+1
-
-                return elicit_slot(
-                            output_session_attributes,
-                            'WaterLeak',
-                            slots,
-                            'vcode',
-                            {'contentType': 'PlainText', 'content': 'Sorry, your verification code is incorrect. Let us try again. We have just sent you another 6 digits verification code to your mobile. Do you mind providing the latest one back to me?'}
-                            )
-            else:
-                return close(output_session_attributes, 'Fulfilled', 'Sorry, your verification code is still incorrect, please contact customer support.')
-    # authenticated ==1 and we can delegate elicit slot to Lex
-    else:
-        return delegate(output_session_attributes, intent_request['currentIntent']['slots'])
+        structured_log.error('caller id lookup failed: %s', e.response['Error']['Message'])
+        return None
+    except deadline.EXCEEDED as e:
+        # ask for the account ID instead
+        deadline.exceeded(e)
+        return None
+    structured_log.bind(caller_id_matched=bool(item))
+    return item and item.get('user_id')
+
+def elicit_user_id(lex, prompts, state):
+    user_id = caller_id_user(lex, state)
+    if user_id:
+        lex.slots['UserId'] = str(user_id)
+        return start_verification(lex, prompts, state, code_prompt='caller_code_sent')
+    return lex_event.elicit_slot(lex, 'UserId', prompts['user_id'])
+
+def start_verification(lex, prompts, state, code_prompt='code_sent'):
+    customerinfo = get_user_details(lex.slots['UserId'])
+    #if not able to find user info with user_id provided
+    if not customerinfo:
+        return lex_event.elicit_slot(lex, 'UserId', prompts['unknown_user'])
+
+    email, phone_num, customerName = customerinfo
+    if not (phone_num and customerName):
+        return lex_event.close(lex, 'Fulfilled', prompts['lookup_failed'])
+
+    state['user_id'] = str(lex.slots['UserId'])
+    state['auth'] = None
+    state['customer_phone'] = phone_num
+    state['customer_name'] = customerName
+    lex.slots['Phone'] = phone_num
+    sent = send_code(state, lex.slots['UserId'], customerName, phone_num)
+    if not sent:
+        return lex_event.close(lex, 'Failed', prompts['rate_limited'])
+    state['count'] = 1
+    return lex_event.elicit_slot(lex, 'vcode', prompts['code_delayed' if sent == CODE_DELAYED else code_prompt])
+
+def verify_code(lex, prompts, state):
+    # count is number of OTP sent already
+    count = state.get('count', 0)
+    if otp.verify(lex.slots['vcode'], state.get('uuid'), lex.slots['UserId']):
+        state['auth'] = 1
+        if lex.intent_name in ON_VERIFIED:
+            ON_VERIFIED[lex.intent_name](lex)
+        return lex_event.delegate(lex)
+
+    if count >= MAX_CODES_SENT:
+        return lex_event.close(lex, 'Fulfilled', prompts['code_failed'])
+
+    sent = send_code(state, lex.slots['UserId'], state['customer_name'], state['customer_phone'])
+    if not sent:
+        return lex_event.close(lex, 'Failed', prompts['rate_limited'])
+    state['count'] = count + 1
+    return lex_event.elicit_slot(lex, 'vcode', prompts['code_delayed' if sent == CODE_DELAYED else 'code_retry'])
+
+def leak_alert(lex):
+    table_name = os.environ.get('LEAK_FLAG_TABLE_NAME')
+    if not table_name:
+        return
+    from boto3.dynamodb.conditions import Key
 
-def dispatch(intent_request):
+    try:
+        items = deadline.table(table_name, 'leak_lookup').query(
+            KeyConditionExpression=Key('user_id').eq(str(lex.slots['UserId']))
+        )['Items']
+    except ClientError as e:
+        structured_log.error('leak flag lookup failed: %s', e.response['Error']['Message'])
+        return
+    except deadline.EXCEEDED as e:
+        # the caller carries on without the alert
+        deadline.exceeded(e)
+        return
+    now = int(time.time())
+    utilities = LEAK_ALERT_UTILITIES.get(lex.intent_name, frozenset())
+    # TTL deletes expired flags some time after they expire
+    alerts = sorted(
+        '%s:%s' % (item['utility_type'], reason)
+        for item in items if item.get('expires_at', now) >= now and item['utility_type'] in utilities
+        for reason in item.get('reasons', [])
+    )
+    structured_log.bind(leak_flagged=bool(alerts))
+    if alerts:
+        lex.session_attributes[LEAK_ALERT_ATTRIBUTE] = ','.join(alerts)
+
+# Called on the turn the caller is verified, by intent.
+ON_VERIFIED = {
+    'WaterLeak': leak_alert,
+}
+
+def authenticated(lex, prompts, state):
+    # the caller is verified so Lex can elicit the remaining slots
+    return lex_event.delegate(lex)
+
+AUTH_FLOW = {
+    ELICIT_USER_ID: elicit_user_id,
+    SEND_CODE: start_verification,
+    VERIFY_CODE: verify_code,
+    AUTHENTICATED: authenticated,
+}
+
+def dispatch(lex):
     """
     Called when the user specifies an intent for this bot.
     """
-    logger.debug('dispatch userId={}, intentName={}'.format(intent_request['userId'], intent_request['currentIntent']['name']))
-
-    intent_name = intent_request['currentIntent']['name']
+    prompts = PROMPTS.get(lex.intent_name)
+    if prompts is None:
+        raise Exception('Intent with name ' + lex.intent_name + ' not supported')
 
-    # Dispatch to your bot's intent handlers
-    if intent_name == 'MeterReading':
-        return meter_reading(intent_request)
-    elif intent_name == 'WaterLeak':
-        return water_leak(intent_request)
-    raise Exception('Intent with name ' + intent_name + ' not supported')
+    state = session_codec.load(lex.session_attributes)
+    dialog_state = auth_state(lex.slots, state)
+    structured_log.bind(dialog_state=dialog_state)
+    try:
+        response = AUTH_FLOW[dialog_state](lex, prompts, state)
+    except deadline.EXCEEDED as e:
+        deadline.exceeded(e)
+        response = lex_event.close(lex, 'Failed', prompts['out_of_time'])
+    # the response holds lex.session_attributes itself, so the state written here goes back to Lex
+    session_codec.store(lex.session_attributes, state)
+    return response
 
+# What a warm-up builds ahead of the first real turn.
+WARM_UP = {
+    'clients': [('dynamodb', 'otp_write'), ('dynamodb', 'rate_limit'), (sms_queue.service_name(), 'sms')]
+        + ([('secretsmanager', 'otp_secret')] if otp.MODE == otp.HMAC else []),
+    'tables': [('USER_TABLE_NAME', 'user_lookup')],
+}
 
-def lambda_handler(event, context):
-    print(event)
-    logger.debug('event.bot.name={}'.format(event['bot']['name']))
-    return dispatch(event)
+warmup.on_init(**WARM_UP)
@@ -0,0 +1,15 @@
+# Which module handles each intent of the bot, for each Lex invocation source.
+#
+# fulfillment routes code hook turns with it and lex_bot_intent turns on the
+# code hooks from it, so it imports nothing: the bot's custom resource doesn't
+# need the handler stack to read it.
+
+DIALOG = 'DialogCodeHook'
+FULFILLMENT = 'FulfillmentCodeHook'
+
+INTENTS = {
+    'MeterReading': { DIALOG: 'identity_verification', FULFILLMENT: 'meter_reading' },
+    'ReadingHistory': { DIALOG: 'identity_verification', FULFILLMENT: 'meter_reading' },
+    'WaterLeak': { DIALOG: 'identity_verification' },
+    'BillingEnquiry': { DIALOG: 'identity_verification', FULFILLMENT: 'meter_reading' },
+}
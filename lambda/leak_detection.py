@@ -0,0 +1,201 @@
+import concurrent.futures
+import decimal
+import itertools
+import os
+import time
+
+import numpy as np
+
+import aws_clients
+import billing
+import structured_log
+
+# Nightly leak detection over MeterReadingTable.
+#
+# The readings of the last WINDOW_DAYS days for the utilities in UTILITY_TYPES
+# are scanned in SCAN_SEGMENTS segments (billing.scan_segment), SCAN_WORKERS at
+# a time. A scan segment is a share of the partition keys, so it holds every
+# reading of the meters in it, and each one is checked as soon as it has been
+# read: its readings are turned into consumption per interval (see
+# billing.compute_bills) and checked for two patterns, for every meter in the
+# segment at once on NumPy arrays:
+#
+#   spike           yesterday's consumption is more than SPIKE_Z standard
+#                   deviations above the mean of the BASELINE_DAYS days before,
+#                   and at least SPIKE_RATIO times that mean
+#   overnight_flow  something was used in every hour of NIGHT_HOURS for the
+#                   last NIGHTS nights, i.e. the flow never stopped. This needs
+#                   readings at least hourly, so meters read less often can
+#                   only be flagged for spikes.
+#
+# A segment's flags are written to LeakFlagTable (user_id, utility_type)
+# before its arrays are dropped, so memory holds a few segments rather than the
+# whole window. Flags expire after FLAG_TTL_DAYS. The WaterLeak intent looks the caller up
+# there, and anything sending outbound notifications can scan it.
+
+WINDOW_DAYS = int(os.environ.get('LEAK_WINDOW_DAYS', '28'))
+BASELINE_DAYS = int(os.environ.get('LEAK_BASELINE_DAYS', '14'))
+SPIKE_Z = float(os.environ.get('LEAK_SPIKE_Z', '4.0'))
+SPIKE_RATIO = float(os.environ.get('LEAK_SPIKE_RATIO', '3.0'))
+# Days with less consumption than this are never spikes, however flat the baseline.
+SPIKE_MIN_CONSUMPTION = float(os.environ.get('LEAK_SPIKE_MIN_CONSUMPTION', '1.0'))
+# Lower bound for the baseline's standard deviation, so a meter that used
+# exactly the same every day isn't flagged for the smallest change.
+STD_FLOOR = 0.5
+NIGHT_HOURS = range(1, 5)
+NIGHTS = int(os.environ.get('LEAK_NIGHTS', '3'))
+# a subset of meter_ingest.UTILITY_TYPES
+UTILITY_TYPES = os.environ.get('LEAK_UTILITY_TYPES', 'water,gas').split(',')
+FLAG_TTL_DAYS = 7
+SCAN_SEGMENTS = int(os.environ.get('LEAK_SCAN_SEGMENTS', '64'))
+SCAN_WORKERS = int(os.environ.get('LEAK_SCAN_WORKERS', '8'))
+
+SECONDS_PER_DAY = billing.SECONDS_PER_DAY
+
+def intervals(meters, timestamps, readings):
+    """
+    Consumption between consecutive readings of each meter: returns the meter,
+    end time and consumption of every interval.
+    """
+    order = np.lexsort((timestamps, meters))
+    meters, timestamps, readings = meters[order], timestamps[order], readings[order]
+    same_meter = meters[1:] == meters[:-1]
+    used = billing.register_used(readings[:-1][same_meter], readings[1:][same_meter])
+    return meters[1:][same_meter], timestamps[1:][same_meter], used
+
+def daily_consumption(meters, ends, used, meter_count, first_day, days):
+    """
+    A (meter, day) matrix of consumption, days counted from first_day.
+    """
+    day = (ends // SECONDS_PER_DAY).astype(np.int64) - first_day
+    keep = (day >= 0) & (day < days)
+    return np.bincount(
+        meters[keep] * days + day[keep], weights=used[keep], minlength=meter_count * days
+    ).reshape(meter_count, days)
+
+def rolling_baseline(daily, baseline_days=BASELINE_DAYS):
+    """
+    Mean and standard deviation of the baseline_days before each day, for
+    every day that has a full baseline (so the last len - baseline_days days).
+    """
+    padded = np.zeros((daily.shape[0], daily.shape[1] + 1))
+    np.cumsum(daily, axis=1, out=padded[:, 1:])
+    squares = np.zeros_like(padded)
+    np.cumsum(daily * daily, axis=1, out=squares[:, 1:])
+    sums = padded[:, baseline_days:-1] - padded[:, :-baseline_days - 1]
+    sum_squares = squares[:, baseline_days:-1] - squares[:, :-baseline_days - 1]
+    mean = sums / baseline_days
+    std = np.sqrt(np.maximum(sum_squares / baseline_days - mean * mean, 0.0))
+    return mean, std
+
+def overnight_flow_nights(meters, ends, used, meter_count, first_day, days):
+    """
+    A (meter, day) boolean matrix: True where something was used in every
+    hour of NIGHT_HOURS that night.
+    """
+    hour = ((ends % SECONDS_PER_DAY) // 3600).astype(np.int64)
+    day = (ends // SECONDS_PER_DAY).astype(np.int64) - first_day
+    keep = np.isin(hour, NIGHT_HOURS) & (used > 0) & (day >= 0) & (day < days)
+    meter_hours = np.unique((meters[keep] * days + day[keep]) * 24 + hour[keep])
+    hours_with_flow = np.bincount(meter_hours // 24, minlength=meter_count * days).reshape(meter_count, days)
+    return hours_with_flow == len(NIGHT_HOURS)
+
+def detect(user_ids, utilities, timestamps, readings, now=None):
+    """
+    Flags for every meter showing a spike or overnight flow, as dicts ready
+    for LeakFlagTable.
+    """
+    now = now or time.time()
+    # the window ends with today, so last night counts; yesterday is the last full day
+    today = int(now // SECONDS_PER_DAY)
+    days = WINDOW_DAYS + 1
+    first_day = today - WINDOW_DAYS
+
+    accounts, account_codes = np.unique(user_ids, return_inverse=True)
+    utility_types, utility_codes = np.unique(utilities, return_inverse=True)
+    meter_keys, meters = np.unique(account_codes * len(utility_types) + utility_codes, return_inverse=True)
+    meters = meters.astype(np.int64)
+    meter_ends, ends, used = intervals(meters, timestamps, readings)
+
+    daily = daily_consumption(meter_ends, ends, used, len(meter_keys), first_day, days)
+    mean, std = rolling_baseline(daily[:, :-1])
+    mean, std = mean[:, -1], std[:, -1]
+    yesterday = daily[:, -2]
+    z = (yesterday - mean) / np.maximum(std, STD_FLOOR)
+    spikes = (z > SPIKE_Z) & (yesterday >= SPIKE_RATIO * mean) & (yesterday >= SPIKE_MIN_CONSUMPTION)
+
+    nights = overnight_flow_nights(meter_ends, ends, used, len(meter_keys), first_day, days)
+    overnight = nights[:, -NIGHTS:].all(axis=1)
+
+    flags = []
+    detected_at = int(now)
+    for index in np.flatnonzero(spikes | overnight).tolist():
+        account, utility = divmod(int(meter_keys[index]), len(utility_types))
+        reasons = []
+        if spikes[index]:
+            reasons.append('spike')
+        if overnight[index]:
+            reasons.append('overnight_flow')
+        flags.append({
+            'user_id': str(accounts[account]),
+            'utility_type': str(utility_types[utility]),
+            'reasons': reasons,
+            'z_score': decimal.Decimal('%.2f' % z[index]),
+            'consumption': decimal.Decimal('%.3f' % yesterday[index]),
+            'detected_at': detected_at,
+            'expires_at': detected_at + FLAG_TTL_DAYS * SECONDS_PER_DAY,
+        })
+    return flags, len(meter_keys)
+
+def write_flags(table_name, flags):
+    with aws_clients.table(table_name).batch_writer() as batch:
+        for flag in flags:
+            batch.put_item(Item=flag)
+
+def scan_chunks(table_name, since, segments=SCAN_SEGMENTS, workers=SCAN_WORKERS):
+    """
+    The readings of each scan segment, as billing.scan_readings arrays, in the
+    order the segments finish. A segment is only started once an earlier one
+    has been handed out.
+    """
+    remaining = iter(range(segments))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        def start(segment):
+            return pool.submit(billing.scan_segment, table_name, segment, segments, UTILITY_TYPES, since)
+
+        pending = set(start(segment) for segment in itertools.islice(remaining, workers))
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pending.update(start(segment) for segment in itertools.islice(remaining, 1))
+                yield billing.reading_arrays(*future.result())
+
+def lambda_handler(event, context):
+    """
+    Nightly run over the whole customer base.
+    """
+    structured_log.start('leak_detection', context, sample_rate=1.0)
+    now = time.time()
+    since = (int(now // SECONDS_PER_DAY) - WINDOW_DAYS - 1) * SECONDS_PER_DAY
+
+    started = time.time()
+    readings = meters = flagged = 0
+    compute_s = 0.0
+    for user_ids, utilities, timestamps, values in scan_chunks(os.environ['METER_READING_TABLE_NAME'], since):
+        computing = time.time()
+        flags, chunk_meters = detect(user_ids, utilities, timestamps, values, now)
+        compute_s += time.time() - computing
+        write_flags(os.environ['LEAK_FLAG_TABLE_NAME'], flags)
+        readings += len(values)
+        meters += chunk_meters
+        flagged += len(flags)
+
+    structured_log.end(
+        readings=readings,
+        meters=meters,
+        flagged=flagged,
+        segments=SCAN_SEGMENTS,
+        run_ms=int((time.time() - started) * 1000),
+        compute_ms=int(compute_s * 1000)
+    )
+    return { 'Meters': meters, 'Flagged': flagged }
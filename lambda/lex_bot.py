@@ -1,22 +1,26 @@
-import boto3
 import os
 
-lex = boto3.client('lexv2-models')
+import aws_clients
+import structured_log
 
 def on_event(event, context):
-    print(event)
+    structured_log.start('lex_bot.on_event', context, sample_rate=1.0, request_type=event['RequestType'])
+    structured_log.debug('event', event=event)
     request_type = event['RequestType']
-    if request_type == 'Create': return on_create(event)
-    if request_type == 'Update': return on_update(event)
-    if request_type == 'Delete': return on_delete(event)
-    raise Exception("Invalid request type: %s" % request_type)
+    try:
+        if request_type == 'Create': return on_create(event)
+        if request_type == 'Update': return on_update(event)
+        if request_type == 'Delete': return on_delete(event)
+        raise Exception("Invalid request type: %s" % request_type)
+    finally:
+        structured_log.end()
 
 def on_create(event):
     props = event["ResourceProperties"]
-    print("create new resource with props %s" % props)
+    structured_log.info("create new resource with props %s", props)
     role_arn = os.environ['RoleArn']
     
-    lex_bot = lex.create_bot(
+    lex_bot = aws_clients.lex_models().create_bot(
         botName='DUEBot',
         description='Digital User Engagement Bot',
         roleArn=role_arn,
@@ -36,40 +40,46 @@ def on_create(event):
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
-    print("update resource %s with props %s" % (physical_id, props))
+    structured_log.info("update resource %s with props %s", physical_id, props)
     # ...
 
 def on_delete(event):
     physical_id = event["PhysicalResourceId"]
-    print("delete resource %s" % physical_id)
+    structured_log.info("delete resource %s", physical_id)
     
-    list_bots = lex.list_bots()
+    list_bots = aws_clients.lex_models().list_bots()
     for i in list_bots["botSummaries"]:
         if i['botName'] == 'DUEBot':
-            print("Deleting Lex Bot Id %s" % i['botId'])
-            lex_bot = lex.delete_bot(
+            structured_log.info("Deleting Lex Bot Id %s", i['botId'])
+            lex_bot = aws_clients.lex_models().delete_bot(
                 botId=i['botId']
             )
     
     return { 'PhysicalResourceId': physical_id }
 
 def is_complete(event, context):
-    physical_id = event["PhysicalResourceId"]
     request_type = event["RequestType"]
-    print("Event object %s" % event)
+    structured_log.start('lex_bot.is_complete', context, sample_rate=1.0, request_type=request_type)
+    structured_log.debug('event', event=event)
+    is_ready = None
+    try:
+        is_ready = ready(event)
+    finally:
+        structured_log.end(is_complete=is_ready)
+    return { 'IsComplete': is_ready }
+
+def ready(event):
+    request_type = event["RequestType"]
 
     if request_type == 'Create':    
-        list_bots = lex.list_bots()
+        list_bots = aws_clients.lex_models().list_bots()
+        is_ready = False
         for i in list_bots["botSummaries"]:
             if i['botName'] == 'DUEBot':
                 if  i['botStatus'] == "Available":
-                    return { 'IsComplete': True }
-                else:
-                    is_ready = False
-        return { 'IsComplete': False }
+                    is_ready = True
     if request_type == 'Update':
         is_ready = True
     if request_type == 'Delete':
         is_ready = True
-
-    return { 'IsComplete': is_ready }
\ No newline at end of file
+    return is_ready
\ No newline at end of file
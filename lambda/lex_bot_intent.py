@@ -1,32 +1,69 @@
-import boto3
 import os
 import time
 
-lex = boto3.client('lexv2-models')
+import aws_clients
+import intents
+import structured_log
+
+# Lex invokes the Fulfillment alias (see fulfillment.py) for an intent's code
+# hooks only where intents.INTENTS routes them. With the dialog code hook
+# on, the first turn of an intent still goes to Lambda (caller ID and the
+# intent's own account ID prompt), but after that only the capture of these
+# slots does: the rest are elicited by Lex on its own.
+CODE_HOOK_SLOTS = ['UserId', 'vcode']
+
+# Digit-only slot types, by slot: Lex matches the whole input against the
+# pattern and re-prompts for anything else itself, so a malformed account
+# number, code or reading never reaches the code hook. They extend
+# AMAZON.AlphaNumeric (the only built-in type a regex can constrain), which
+# also keeps the leading zeros AMAZON.Number would drop.
+PATTERN_SLOT_TYPES = {
+    'UserId': ('AccountNumber', '7 digit account number', '[0-9]{7}'),
+    'vcode': ('OneTimeCode', '6 digit one time verification code', '[0-9]{6}'),
+    'Reading': ('MeterReadingValue', '6 digit meter reading', '[0-9]{6}'),
+}
+
+# Times Lex asks again for a slot before giving up on it.
+MAX_RETRIES = 3
+
+# What Lex says on each retry, in order, after the slot's prompt. The last one
+# is repeated for any further retries.
+RETRY_PROMPTS = {
+    'UserId': ['Sorry, your account ID is 7 digits. What is your account ID?'],
+    'vcode': ['Sorry, the verification code is the 6 digits we just texted you. What is it?'],
+    'Reading': ['Sorry, the meter reading should be 6 digits, including any zeros. What is the meter reading?'],
+}
 
 def on_event(event, context):
-    print(event)
+    structured_log.start('lex_bot_intent.on_event', context, sample_rate=1.0, request_type=event['RequestType'])
+    structured_log.debug('event', event=event)
     request_type = event['RequestType']
-    if request_type == 'Create': return on_create(event)
-    if request_type == 'Update': return on_update(event)
-    if request_type == 'Delete': return on_delete(event)
-    raise Exception("Invalid request type: %s" % request_type)
+    try:
+        if request_type == 'Create': return on_create(event)
+        if request_type == 'Update': return on_update(event)
+        if request_type == 'Delete': return on_delete(event)
+        raise Exception("Invalid request type: %s" % request_type)
+    finally:
+        structured_log.end()
 
 def on_create(event):
     props = event["ResourceProperties"]
-    print("create new resource with props %s" % props)
+    structured_log.info("create new resource with props %s", props)
     bot_id = os.environ['BotId']
     locale_id = os.environ['LocaleId']
 
-    utility_slot_type = lex.create_slot_type(
+    utility_slot_type = aws_clients.lex_models().create_slot_type(
         slotTypeName='UtilityType',
-        description='Gas or Electricity utility type',
+        description='Gas, electricity or water utility type',
         slotTypeValues=[
             {
                 'sampleValue': { 'value': 'gas' },
             },
             {
                 'sampleValue': { 'value': 'electricity' },
+            },
+            {
+                'sampleValue': { 'value': 'water' },
             }
         ],
         valueSelectionSetting={
@@ -37,7 +74,12 @@ def on_create(event):
         localeId=locale_id
     )
 
-    meter_reading_intent = lex.create_intent(
+    slot_types = {
+        slot_name: pattern_slot_type(type_name, description, pattern, bot_id, locale_id)["slotTypeId"]
+        for slot_name, (type_name, description, pattern) in PATTERN_SLOT_TYPES.items()
+    }
+
+    meter_reading_intent = aws_clients.lex_models().create_intent(
         intentName='MeterReading',
         sampleUtterances=[
             { 'utterance': 'submit a meter reading' },
@@ -47,12 +89,13 @@ def on_create(event):
         ],
         botId=bot_id,
         botVersion='DRAFT',
-        localeId=locale_id
+        localeId=locale_id,
+        **code_hooks('MeterReading')
     )
 
     user_id_slot = slot(
         'UserId', 
-        'AMAZON.Number',
+        slot_types['UserId'],
         'What is your account ID?',
         meter_reading_intent["intentId"],
         bot_id,
@@ -70,7 +113,7 @@ def on_create(event):
 
     reading_slot = slot(
         'Reading', 
-        'AMAZON.PhoneNumber', 
+        slot_types['Reading'], 
         'What is the meter reading? This should be 6 digits, including any zeros. Ignore the number in red, plus any after a decimal point.', 
         meter_reading_intent["intentId"],
         bot_id,
@@ -79,7 +122,7 @@ def on_create(event):
 
     vcode_slot = slot(
         'vcode', 
-        'AMAZON.PhoneNumber', 
+        slot_types['vcode'], 
         'What is your one time verification number?', 
         meter_reading_intent["intentId"],
         bot_id,
@@ -89,22 +132,49 @@ def on_create(event):
     utility_slot = slot(
         'UtilityType', 
         utility_slot_type["slotTypeId"], 
-        'Is this for a Gas or Electricity reading?', 
+        'Is this for a gas, electricity or water reading?', 
         meter_reading_intent["intentId"],
         bot_id,
         locale_id
     )
 
-    build = lex.build_bot_locale(
+    reading_history_intent = aws_clients.lex_models().create_intent(
+        intentName='ReadingHistory',
+        sampleUtterances=[
+            { 'utterance': 'what were my last readings' },
+            { 'utterance': 'reading history' },
+            { 'utterance': 'tell me my previous meter readings' },
+        ],
+        botId=bot_id,
+        botVersion='DRAFT',
+        localeId=locale_id,
+        **code_hooks('ReadingHistory')
+    )
+
+    for slot_name, slot_type_id, message in [
+        ('UserId', slot_types['UserId'], 'What is your account ID?'),
+        ('Phone', 'AMAZON.PhoneNumber', 'Please enter in your phone number'),
+        ('vcode', slot_types['vcode'], 'What is your one time verification number?'),
+    ]:
+        slot(
+            slot_name,
+            slot_type_id,
+            message,
+            reading_history_intent["intentId"],
+            bot_id,
+            locale_id
+        )
+
+    build = aws_clients.lex_models().build_bot_locale(
         botId=bot_id,
         botVersion='DRAFT',
         localeId=locale_id
     )
 
-    version = lex.create_bot_version(
+    version = aws_clients.lex_models().create_bot_version(
         botId=bot_id,
         botVersionLocaleSpecification={
-            'en_GB': {
+            locale_id: {
                 'sourceBotVersion': 'DRAFT'
             }
         }
@@ -112,7 +182,7 @@ def on_create(event):
     time.sleep(3)
 
     while True:
-        check_bot_version = lex.describe_bot_version(
+        check_bot_version = aws_clients.lex_models().describe_bot_version(
             botId=bot_id,
             botVersion=version["botVersion"]
         )
@@ -120,10 +190,11 @@ def on_create(event):
             break
         time.sleep(1)
 
-    alias = lex.create_bot_alias(
+    alias = aws_clients.lex_models().create_bot_alias(
         botId=bot_id,
         botAliasName='PROD',
-        botVersion=version["botVersion"]
+        botVersion=version["botVersion"],
+        botAliasLocaleSettings=alias_locale_settings(locale_id, props['FulfillmentArn'])
     )
 
     return { 'PhysicalResourceId': 'LexBotAttr-DUE',
@@ -136,36 +207,116 @@ def on_create(event):
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
-    print("update resource %s with props %s" % (physical_id, props))
-    # ...
+    structured_log.info("update resource %s with props %s", physical_id, props)
+    bot_id = os.environ['BotId']
+    locale_id = os.environ['LocaleId']
+
+    # point the existing alias at the (new) Fulfillment alias
+    alias = next(
+        summary for summary in aws_clients.lex_models().list_bot_aliases(botId=bot_id)['botAliasSummaries']
+        if summary['botAliasName'] == 'PROD'
+    )
+    aws_clients.lex_models().update_bot_alias(
+        botId=bot_id,
+        botAliasId=alias['botAliasId'],
+        botAliasName='PROD',
+        botVersion=alias['botVersion'],
+        botAliasLocaleSettings=alias_locale_settings(locale_id, props['FulfillmentArn'])
+    )
+
+    return { 'PhysicalResourceId': physical_id,
+        'Data': {
+            'BotAlias': 'PROD',
+            'BotAliasId': alias['botAliasId']
+        }
+    }
 
 def on_delete(event):
     physical_id = event["PhysicalResourceId"]
-    print("delete resource %s" % physical_id)
+    structured_log.info("delete resource %s", physical_id)
     
     return { 'PhysicalResourceId': physical_id }
 
 def slot(slot_name, slot_type_id, message, intent_id, bot_id, locale_id):
-    return lex.create_slot(
+    return aws_clients.lex_models().create_slot(
         slotName=slot_name,
         slotTypeId=slot_type_id,
         valueElicitationSetting={
             'slotConstraint': 'Required',
             'promptSpecification': {
-                'messageGroups': [
-                    {
-                        'message': {
-                            'plainTextMessage': {
-                                'value': message
-                            }
-                        }
-                    }
-                ],
-                'maxRetries': 3
-            }
+                'messageGroups': [message_group(text) for text in prompts(slot_name, message)],
+                # the initial prompt, then RETRY_PROMPTS in turn
+                'messageSelectionStrategy': 'Ordered',
+                'maxRetries': MAX_RETRIES
+            },
+            'slotCaptureSetting': slot_capture_setting(slot_name)
         },
         botId=bot_id,
         botVersion='DRAFT',
         localeId=locale_id,        
         intentId=intent_id
     )
+
+def prompts(slot_name, message):
+    retries = RETRY_PROMPTS.get(slot_name)
+    if not retries:
+        return [message]
+    return [message] + [retries[min(i, len(retries) - 1)] for i in range(MAX_RETRIES)]
+
+def message_group(text):
+    return {
+        'message': {
+            'plainTextMessage': {
+                'value': text
+            }
+        }
+    }
+
+def pattern_slot_type(type_name, description, pattern, bot_id, locale_id):
+    return aws_clients.lex_models().create_slot_type(
+        slotTypeName=type_name,
+        description=description,
+        parentSlotTypeSignature='AMAZON.AlphaNumeric',
+        valueSelectionSetting={
+            'resolutionStrategy': 'OriginalValue',
+            'regexFilter': {
+                'pattern': pattern
+            }
+        },
+        botId=bot_id,
+        botVersion='DRAFT',
+        localeId=locale_id
+    )
+
+def slot_capture_setting(slot_name):
+    invoke = slot_name in CODE_HOOK_SLOTS
+    return {
+        'codeHook': {
+            'enableCodeHookInvocation': invoke,
+            'active': invoke,
+            'postCodeHookSpecification': {}
+        },
+        'elicitationCodeHook': {
+            'enableCodeHookInvocation': False
+        }
+    }
+
+def code_hooks(intent_name):
+    hooks = intents.INTENTS.get(intent_name, {})
+    return {
+        'dialogCodeHook': { 'enabled': intents.DIALOG in hooks },
+        'fulfillmentCodeHook': { 'enabled': intents.FULFILLMENT in hooks }
+    }
+
+def alias_locale_settings(locale_id, lambda_arn):
+    return {
+        locale_id: {
+            'enabled': True,
+            'codeHookSpecification': {
+                'lambdaCodeHook': {
+                    'lambdaARN': lambda_arn,
+                    'codeHookInterfaceVersion': '1.0'
+                }
+            }
+        }
+    }
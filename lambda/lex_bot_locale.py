@@ -1,23 +1,27 @@
-import boto3
 import os
 
-lex = boto3.client('lexv2-models')
+import aws_clients
+import structured_log
 
 def on_event(event, context):
-    print(event)
+    structured_log.start('lex_bot_locale.on_event', context, sample_rate=1.0, request_type=event['RequestType'])
+    structured_log.debug('event', event=event)
     request_type = event['RequestType']
-    if request_type == 'Create': return on_create(event)
-    if request_type == 'Update': return on_update(event)
-    if request_type == 'Delete': return on_delete(event)
-    raise Exception("Invalid request type: %s" % request_type)
+    try:
+        if request_type == 'Create': return on_create(event)
+        if request_type == 'Update': return on_update(event)
+        if request_type == 'Delete': return on_delete(event)
+        raise Exception("Invalid request type: %s" % request_type)
+    finally:
+        structured_log.end()
 
 def on_create(event):
     props = event["ResourceProperties"]
-    print("create new resource with props %s" % props)
+    structured_log.info("create new resource with props %s", props)
     bot_id = os.environ['BotId']
     locale_id = os.environ['LocaleId']
     
-    bot_locale = lex.create_bot_locale(
+    bot_locale = aws_clients.lex_models().create_bot_locale(
         botId=bot_id,
         botVersion='DRAFT', # The version of the bot to create the locale for. This can only be the draft version of the bot.
         localeId=locale_id, 
@@ -37,24 +41,33 @@ def on_create(event):
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
-    print("update resource %s with props %s" % (physical_id, props))
+    structured_log.info("update resource %s with props %s", physical_id, props)
     # ...
 
 def on_delete(event):
     physical_id = event["PhysicalResourceId"]
-    print("delete resource %s" % physical_id)
+    structured_log.info("delete resource %s", physical_id)
     
     return { 'PhysicalResourceId': physical_id }
 
 def is_complete(event, context):
-    physical_id = event["PhysicalResourceId"]
     request_type = event["RequestType"]
-    print("Event object %s" % event)
+    structured_log.start('lex_bot_locale.is_complete', context, sample_rate=1.0, request_type=request_type)
+    structured_log.debug('event', event=event)
+    is_ready = None
+    try:
+        is_ready = ready(event)
+    finally:
+        structured_log.end(is_complete=is_ready)
+    return { 'IsComplete': is_ready }
+
+def ready(event):
+    request_type = event["RequestType"]
     bot_id = os.environ['BotId']
     locale_id = os.environ['LocaleId']
 
     if request_type == 'Create':    
-        response = lex.describe_bot_locale(
+        response = aws_clients.lex_models().describe_bot_locale(
             botId=bot_id,
             botVersion='DRAFT',
             localeId=locale_id
@@ -69,8 +82,7 @@ def is_complete(event, context):
         is_ready = True
     if request_type == 'Delete':
         is_ready = True
-
-    return { 'IsComplete': is_ready }
+    return is_ready
 
 
 
@@ -0,0 +1,163 @@
+# Lex V2 code hook events and responses.
+#
+# parse() reads the event once per turn into a LexEvent, with slots flattened
+# to name -> interpreted value, and the response builders below turn it back
+# into a Lex response. The bot is a Lex V2 bot, so V2 is the native format;
+# events in the V1 shape (currentIntent/dialogAction) are still accepted, and
+# are answered in the V1 shape.
+#
+# https://docs.aws.amazon.com/lexv2/latest/dg/lambda-input-format.html
+# https://docs.aws.amazon.com/lexv2/latest/dg/lambda-response-format.html
+
+V1 = 1
+V2 = 2
+
+class LexEvent(object):
+    __slots__ = (
+        'version',
+        'intent_name',
+        'invocation_source',
+        'slots',
+        'session_attributes',
+        'request_attributes',
+        'session_id',
+        'input_transcript',
+        'confirmation_state',
+        'raw_slots',
+    )
+
+    def slot(self, name):
+        return self.slots.get(name)
+
+def _interpreted(slot):
+    if not slot:
+        return None
+    value = slot.get('value')
+    if not value:
+        return None
+    return value.get('interpretedValue') or value.get('originalValue')
+
+def parse(event):
+    lex = LexEvent()
+    if 'sessionState' in event:
+        session_state = event['sessionState']
+        intent = session_state['intent']
+        lex.version = V2
+        lex.intent_name = intent['name']
+        lex.invocation_source = event.get('invocationSource')
+        lex.raw_slots = intent.get('slots') or {}
+        lex.slots = {name: _interpreted(slot) for name, slot in lex.raw_slots.items()}
+        lex.session_attributes = session_state.get('sessionAttributes') or {}
+        lex.request_attributes = event.get('requestAttributes') or {}
+        lex.session_id = event.get('sessionId')
+        lex.input_transcript = event.get('inputTranscript')
+        lex.confirmation_state = intent.get('confirmationState')
+    else:
+        intent = event['currentIntent']
+        lex.version = V1
+        lex.intent_name = intent['name']
+        lex.invocation_source = event.get('invocationSource')
+        lex.raw_slots = intent.get('slots') or {}
+        lex.slots = dict(lex.raw_slots)
+        lex.session_attributes = event.get('sessionAttributes') or {}
+        lex.request_attributes = event.get('requestAttributes') or {}
+        lex.session_id = event.get('userId')
+        lex.input_transcript = event.get('inputTranscript')
+        lex.confirmation_state = intent.get('confirmationStatus')
+    return lex
+
+def _v2_slots(lex):
+    slots = {}
+    for name, value in lex.slots.items():
+        if value is None:
+            slots[name] = None
+        elif value == _interpreted(lex.raw_slots.get(name)):
+            slots[name] = lex.raw_slots[name]
+        else:
+            slots[name] = {
+                'shape': 'Scalar',
+                'value': {
+                    'originalValue': value,
+                    'interpretedValue': value,
+                    'resolvedValues': [value]
+                }
+            }
+    return slots
+
+def _v2_response(lex, dialog_action, intent_state, message=None):
+    response = {
+        'sessionState': {
+            'sessionAttributes': lex.session_attributes,
+            'dialogAction': dialog_action,
+            'intent': {
+                'name': lex.intent_name,
+                'slots': _v2_slots(lex),
+                'state': intent_state,
+                'confirmationState': lex.confirmation_state or 'None'
+            }
+        }
+    }
+    if message:
+        response['messages'] = [message]
+    return response
+
+def elicit_slot(lex, slot_to_elicit, message):
+    if lex.version == V1:
+        return {
+            'sessionAttributes': lex.session_attributes,
+            'dialogAction': {
+                'type': 'ElicitSlot',
+                'intentName': lex.intent_name,
+                'slots': lex.slots,
+                'slotToElicit': slot_to_elicit,
+                'message': message
+            }
+        }
+    return _v2_response(lex, { 'type': 'ElicitSlot', 'slotToElicit': slot_to_elicit }, 'InProgress', message)
+
+def confirm_intent(lex, message):
+    if lex.version == V1:
+        return {
+            'sessionAttributes': lex.session_attributes,
+            'dialogAction': {
+                'type': 'ConfirmIntent',
+                'intentName': lex.intent_name,
+                'slots': lex.slots,
+                'message': message
+            }
+        }
+    return _v2_response(lex, { 'type': 'ConfirmIntent' }, 'InProgress', message)
+
+def delegate(lex):
+    if lex.version == V1:
+        return {
+            'sessionAttributes': lex.session_attributes,
+            'dialogAction': {
+                'type': 'Delegate',
+                'slots': lex.slots
+            }
+        }
+    return _v2_response(lex, { 'type': 'Delegate' }, 'InProgress')
+
+def close(lex, fulfillment_state, message):
+    if lex.version == V1:
+        return {
+            'sessionAttributes': lex.session_attributes,
+            'dialogAction': {
+                'type': 'Close',
+                'fulfillmentState': fulfillment_state,
+                'message': message
+            }
+        }
+    return _v2_response(lex, { 'type': 'Close' }, fulfillment_state, message)
+
+def plain_text(content):
+    return {'contentType': 'PlainText', 'content': content}
+
+def dialog_action_type(response):
+    """
+    The dialog action of a response built above, in either format.
+    """
+    if 'sessionState' in response:
+        return response['sessionState']['dialogAction']['type']
+    return response['dialogAction']['type']
@@ -0,0 +1,273 @@
+import argparse
+import csv
+import io
+import os
+import queue
+import threading
+import time
+import zlib
+
+import aws_clients
+import structured_log
+
+# Nightly export of MeterReadingTable for the billing back office.
+#
+# The table is read with a parallel Scan: one worker thread per segment, each
+# paging through its own share of the table. Pages go through a bounded queue
+# to a single writer that turns them into gzipped CSV and uploads it to S3 as
+# a multipart upload, one part at a time, so memory use stays at roughly the
+# queue's worth of pages plus one part whatever the size of the table. The
+# upload is aborted if anything fails, so a half-written export never shows
+# up in the bucket.
+
+COLUMNS = ['user_id', 'timestamp', 'reading', 'utility_type']
+EXPORT_PREFIX = os.environ.get('EXPORT_PREFIX', 'exports/meter-readings/')
+# S3 parts have to be at least 5 MiB, except the last one
+PART_SIZE = int(os.environ.get('EXPORT_PART_SIZE', str(8 * 1024 * 1024)))
+PAGE_SIZE = 1000
+PROGRESS_SECONDS = 10.0
+
+_DONE = object()
+
+def row_of(item):
+    """
+    A CSV row from a low-level item: every column is a single S or N value, so
+    the value is written as DynamoDB returned it, without a round trip through
+    Decimal.
+    """
+    row = []
+    for column in COLUMNS:
+        value = item.get(column)
+        row.append(next(iter(value.values())) if value else '')
+    return row
+
+class MultipartUpload(object):
+    """
+    File-like sink that uploads whatever is written to it as the parts of one
+    S3 multipart upload.
+    """
+
+    def __init__(self, bucket, key, part_size=PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.parts = []
+        self.bytes_uploaded = 0
+        self._buffer = io.BytesIO()
+        self._upload_id = aws_clients.s3().create_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            ContentType='text/csv',
+            ContentEncoding='gzip'
+        )['UploadId']
+
+    def write(self, data):
+        self._buffer.write(data)
+        if self._buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        body = self._buffer.getvalue()
+        self._buffer = io.BytesIO()
+        number = len(self.parts) + 1
+        response = aws_clients.s3().upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=body
+        )
+        self.parts.append({ 'PartNumber': number, 'ETag': response['ETag'] })
+        self.bytes_uploaded += len(body)
+
+    def complete(self):
+        if self._buffer.tell() or not self.parts:
+            self._upload_part()
+        aws_clients.s3().complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={ 'Parts': self.parts }
+        )
+
+    def abort(self):
+        aws_clients.s3().abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+class GzipCsvWriter(object):
+    """
+    Streams CSV rows through gzip into a sink with a write(bytes) method.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.rows = 0
+        self._text = io.StringIO()
+        self._csv = csv.writer(self._text)
+        # wbits 16 + 15 writes a gzip header and trailer
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._csv.writerow(COLUMNS)
+
+    def write_rows(self, rows):
+        self._csv.writerows(rows)
+        self.rows += len(rows)
+        self._flush()
+
+    def _flush(self):
+        data = self._compressor.compress(self._text.getvalue().encode('utf-8'))
+        self._text.seek(0)
+        self._text.truncate()
+        if data:
+            self.sink.write(data)
+
+    def close(self):
+        self._flush()
+        self.sink.write(self._compressor.flush())
+
+class Export(object):
+
+    def __init__(self, table_name, segments=8, page_size=PAGE_SIZE, progress=None):
+        self.table_name = table_name
+        self.segments = segments
+        self.page_size = page_size
+        self.progress = progress or log_progress
+        self.scanned = [0] * segments
+        self.consumed_capacity = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def scan_segment(self, segment, pages):
+        args = {
+            'TableName': self.table_name,
+            'Segment': segment,
+            'TotalSegments': self.segments,
+            'Limit': self.page_size,
+            'ProjectionExpression': ', '.join('#c%d' % i for i in range(len(COLUMNS))),
+            'ExpressionAttributeNames': {'#c%d' % i: name for i, name in enumerate(COLUMNS)},
+        }
+        client = aws_clients.dynamodb()
+        while not self._stop.is_set():
+            response = client.scan(**args)
+            # blocks while the writer is behind, which is what bounds memory
+            pages.put([row_of(item) for item in response['Items']])
+            with self._lock:
+                self.scanned[segment] += len(response['Items'])
+                self.consumed_capacity += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0.0)
+            if 'LastEvaluatedKey' not in response:
+                return
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _worker(self, segment, pages, errors):
+        try:
+            self.scan_segment(segment, pages)
+        except Exception as e:
+            errors.append(e)
+            self._stop.set()
+        finally:
+            pages.put(_DONE)
+
+    def run(self, sink):
+        """
+        Scan the whole table into sink (see MultipartUpload) and return a report.
+        The caller completes or aborts the sink.
+        """
+        start = last_progress = time.time()
+        # a couple of pages per worker in flight at most
+        pages = queue.Queue(maxsize=self.segments * 2)
+        errors = []
+        workers = [
+            threading.Thread(target=self._worker, args=(segment, pages, errors), name='scan-%d' % segment, daemon=True)
+            for segment in range(self.segments)
+        ]
+        for worker in workers:
+            worker.start()
+
+        writer = GzipCsvWriter(sink)
+        running = self.segments
+        try:
+            while running:
+                page = pages.get()
+                if page is _DONE:
+                    running -= 1
+                    continue
+                writer.write_rows(page)
+                if time.time() - last_progress >= PROGRESS_SECONDS:
+                    last_progress = time.time()
+                    self.progress(self.report(writer, sink, start))
+        except BaseException:
+            self._stop.set()
+            # let the workers finish their current put and exit
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        if errors:
+            raise errors[0]
+        writer.close()
+        return self.report(writer, sink, start)
+
+    def report(self, writer, sink, start):
+        elapsed = time.time() - start
+        with self._lock:
+            scanned = sum(self.scanned)
+            segments_scanned = list(self.scanned)
+            capacity_units = self.consumed_capacity
+        return {
+            'rows_scanned': scanned,
+            'rows_written': writer.rows,
+            'segments': segments_scanned,
+            'bytes_uploaded': getattr(sink, 'bytes_uploaded', None),
+            'parts': len(getattr(sink, 'parts', [])),
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(scanned / elapsed, 1) if elapsed else None,
+            'capacity_units': round(capacity_units, 1),
+        }
+
+def log_progress(report):
+    structured_log.info('export progress', **report)
+
+def export_key(epoch=None):
+    return EXPORT_PREFIX + time.strftime('%Y-%m-%d', time.gmtime(epoch or time.time())) + '.csv.gz'
+
+def export_table(table_name, bucket, key, segments=8, progress=None, part_size=PART_SIZE):
+    upload = MultipartUpload(bucket, key, part_size)
+    try:
+        report = Export(table_name, segments=segments, progress=progress).run(upload)
+    except BaseException:
+        upload.abort()
+        raise
+    upload.complete()
+    report['bytes_uploaded'] = upload.bytes_uploaded
+    report['parts'] = len(upload.parts)
+    report['key'] = key
+    return report
+
+def lambda_handler(event, context):
+    """
+    Nightly export to exports/meter-readings/<yyyy-mm-dd>.csv.gz in the stack's bucket.
+    """
+    structured_log.start('meter_export', context, sample_rate=1.0)
+    report = export_table(
+        os.environ['METER_READING_TABLE_NAME'],
+        os.environ['EXPORT_BUCKET'],
+        export_key(),
+        segments=int(os.environ.get('EXPORT_SEGMENTS', '8'))
+    )
+    structured_log.end(**report)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Export MeterReadingTable to gzipped CSV in S3 with a parallel scan.')
+    parser.add_argument('--table', default=os.environ.get('METER_READING_TABLE_NAME'), required='METER_READING_TABLE_NAME' not in os.environ)
+    parser.add_argument('--bucket', default=os.environ.get('EXPORT_BUCKET'), required='EXPORT_BUCKET' not in os.environ)
+    parser.add_argument('--key', help='object key, defaults to %s<yyyy-mm-dd>.csv.gz' % EXPORT_PREFIX)
+    parser.add_argument('--segments', type=int, default=8, help='parallel scan segments, one worker thread each')
+    args = parser.parse_args()
+
+    structured_log.start('meter_export', sample_rate=0.0)
+    report = export_table(args.table, args.bucket, args.key or export_key(), segments=args.segments)
+    structured_log.info('export complete', **report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import base64
+import decimal
+import json
+import os
+
+import deadline
+
+# Reads MeterReadingTable back for one user, a page at a time.
+#
+# Readings are keyed by user_id with the timestamp as sort key, so a time range
+# is a single Query. iter_readings() is a generator over the result pages and
+# only ever holds one page in memory; query_page() returns one page plus a
+# cursor that can be handed back later to carry on from the same place.
+
+DEFAULT_PAGE_SIZE = 100
+
+def encode_cursor(last_evaluated_key):
+    if not last_evaluated_key:
+        return None
+    key = {k: str(v) if isinstance(v, decimal.Decimal) else v for k, v in last_evaluated_key.items()}
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    key['timestamp'] = decimal.Decimal(key['timestamp'])
+    return key
+
+def query_args(user_id, start=None, end=None, newest_first=True, page_size=DEFAULT_PAGE_SIZE, projection=None):
+    from boto3.dynamodb.conditions import Key
+
+    condition = Key('user_id').eq(str(user_id))
+    if start is not None and end is not None:
+        condition = condition & Key('timestamp').between(decimal.Decimal(str(start)), decimal.Decimal(str(end)))
+    elif start is not None:
+        condition = condition & Key('timestamp').gte(decimal.Decimal(str(start)))
+    elif end is not None:
+        condition = condition & Key('timestamp').lte(decimal.Decimal(str(end)))
+
+    args = {
+        'KeyConditionExpression': condition,
+        'ScanIndexForward': not newest_first,
+        'Limit': page_size
+    }
+    if projection:
+        # timestamp is a reserved word, so every projected name goes through a placeholder
+        names = {'#p%d' % i: name for i, name in enumerate(projection)}
+        args['ProjectionExpression'] = ', '.join(names)
+        args['ExpressionAttributeNames'] = names
+    return args
+
+def query_page(user_id, cursor=None, **kwargs):
+    """
+    Return (items, next_cursor) for one page. next_cursor is None on the last page.
+    """
+    args = query_args(user_id, **kwargs)
+    start_key = decode_cursor(cursor)
+    if start_key:
+        args['ExclusiveStartKey'] = start_key
+    response = deadline.table(os.environ['METER_READING_TABLE_NAME'], 'history').query(**args)
+    return response['Items'], encode_cursor(response.get('LastEvaluatedKey'))
+
+def iter_readings(user_id, cursor=None, **kwargs):
+    """
+    Yield readings for user_id, following LastEvaluatedKey until the range is exhausted.
+    Accepts the same keyword arguments as query_args.
+    """
+    while True:
+        items, cursor = query_page(user_id, cursor=cursor, **kwargs)
+        for item in items:
+            yield item
+        if not cursor:
+            return
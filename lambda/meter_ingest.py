@@ -0,0 +1,343 @@
+import argparse
+import codecs
+import csv
+import decimal
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+import aws_clients
+import structured_log
+
+# Bulk ingestion of smart-meter reads into MeterReadingTable.
+#
+# Files are CSV (with a header row) or newline-delimited JSON with the fields
+# user_id, timestamp, reading and utility_type. The file is streamed, each row
+# is validated and valid rows are written with BatchWriteItem from a pool of
+# worker threads. Unprocessed items are resent with exponential backoff.
+#
+# Progress is checkpointed as the number of rows that are known to be written,
+# so a run that crashes (or a Lambda that times out and is retried by S3) skips
+# straight to where it left off. Puts are idempotent on (user_id, timestamp), so
+# rows written after the last checkpoint are simply written again.
+#
+# Each batch also moves the latest-reading item of the meters in it (see
+# meter_reading.latest_key) on to their newest imported reading, so readings
+# given over the phone are checked against imported ones too. The update is
+# conditional on the imported reading being newer, so the item only ever moves
+# forward, whatever order the batches finish in.
+
+BATCH_SIZE = 25
+MAX_ATTEMPTS = 8
+# the utility types a reading can be for, here, in Lex's UtilityType slot and in leak detection
+UTILITY_TYPES = frozenset(['gas', 'electricity', 'water'])
+READING_PATTERN = re.compile(r'^\d{6}$')
+# 2100-01-01T00:00:00Z
+MAX_TIMESTAMP = 4102444800
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', 'meter-readings-checkpoints/')
+
+class InvalidRow(ValueError):
+    pass
+
+def parse_timestamp(value):
+    try:
+        timestamp = decimal.Decimal(str(value))
+    except decimal.InvalidOperation:
+        raise InvalidRow('timestamp must be epoch seconds: %r' % (value,))
+    # DynamoDB can't store NaN or Infinity, and anything else out of range is a bad export
+    if not timestamp.is_finite() or not 0 <= timestamp < MAX_TIMESTAMP:
+        raise InvalidRow('timestamp out of range: %r' % (value,))
+    return timestamp
+
+def validate(row):
+    """
+    Turn one input row into a MeterReadingTable item, in the same shape that
+    meter_reading.submit_reading writes.
+    """
+    user_id = str(row.get('user_id') or '').strip()
+    if not user_id:
+        raise InvalidRow('missing user_id')
+
+    reading = str(row.get('reading') or '').strip()
+    if not READING_PATTERN.match(reading):
+        raise InvalidRow('reading must be 6 digits: %r' % (reading,))
+
+    utility_type = str(row.get('utility_type') or '').strip().lower()
+    if utility_type not in UTILITY_TYPES:
+        raise InvalidRow('unknown utility_type: %r' % (utility_type,))
+
+    return {
+        'reading': reading,
+        'utility_type': utility_type,
+        'timestamp': parse_timestamp(row.get('timestamp')),
+        'user_id': user_id
+    }
+
+def read_rows(lines, file_format):
+    """
+    Yield (row_number, row dict) from an iterable of text lines.
+    """
+    if file_format == 'csv':
+        for number, row in enumerate(csv.DictReader(lines), 1):
+            yield number, row
+    else:
+        number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, {}
+
+def file_format_for(name):
+    return 'csv' if name.lower().endswith('.csv') else 'jsonl'
+
+class LocalCheckpoint(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['rows']
+        except (IOError, ValueError, KeyError):
+            return 0
+
+    def save(self, rows):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({ 'rows': rows }, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class S3Checkpoint(object):
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = CHECKPOINT_PREFIX + key + '.json'
+
+    def load(self):
+        try:
+            body = aws_clients.s3().get_object(Bucket=self.bucket, Key=self.key)['Body']
+            return json.loads(body.read())['rows']
+        except aws_clients.s3().exceptions.NoSuchKey:
+            return 0
+
+    def save(self, rows):
+        aws_clients.s3().put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps({ 'rows': rows }))
+
+    def clear(self):
+        aws_clients.s3().delete_object(Bucket=self.bucket, Key=self.key)
+
+class Ingestion(object):
+
+    def __init__(self, table_name, checkpoint, workers=8, checkpoint_every=5000, rollup_table_name=None):
+        self.table_name = table_name
+        self.rollup_table_name = rollup_table_name
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.checkpoint_every = checkpoint_every
+        self.written = 0
+        self.rejected = 0
+        self.retries = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        # row range of every batch still in flight, used to work out
+        # how far the checkpoint can safely move
+        self._in_flight = {}
+        self._max_done = 0
+        self._done_upto = 0
+        self._saved_upto = 0
+        # boto3 resources aren't thread safe, so the workers share a low-level
+        # client, with a connection each
+        from boto3.dynamodb.types import TypeSerializer
+        self._serializer = TypeSerializer()
+        self._client = aws_clients.client('dynamodb', pool_size=workers)
+
+    def write_batch(self, items):
+        requests = [
+            { 'PutRequest': { 'Item': {k: self._serializer.serialize(v) for k, v in item.items()} } }
+            for item in items
+        ]
+        for attempt in range(MAX_ATTEMPTS):
+            response = self._client.batch_write_item(RequestItems={ self.table_name: requests })
+            requests = response.get('UnprocessedItems', {}).get(self.table_name)
+            if not requests:
+                self.advance_latest(items)
+                return
+            with self._lock:
+                self.retries += 1
+            time.sleep(min(10.0, 0.05 * (2 ** attempt)) * random.uniform(0.5, 1.0))
+        raise RuntimeError('%d items still unprocessed after %d attempts' % (len(requests), MAX_ATTEMPTS))
+
+    def advance_latest(self, items):
+        """
+        Move the latest-reading item of each meter in a written batch on to its
+        newest reading in the batch, unless it already holds a newer one.
+        """
+        if not self.rollup_table_name:
+            return
+        newest = {}
+        for item in items:
+            meter = (item['user_id'], item['utility_type'])
+            if meter not in newest or item['timestamp'] > newest[meter]['timestamp']:
+                newest[meter] = item
+        for (user_id, utility_type), item in newest.items():
+            try:
+                self._client.update_item(
+                    TableName=self.rollup_table_name,
+                    Key={ 'user_id': { 'S': user_id }, 'period': { 'S': 'latest#' + utility_type } },
+                    # the submission belongs to the reading given over the phone
+                    UpdateExpression='SET #t = :t, reading = :r REMOVE submission',
+                    ConditionExpression='attribute_not_exists(#t) OR #t < :t',
+                    ExpressionAttributeNames={ '#t': 'timestamp' },
+                    ExpressionAttributeValues={
+                        ':t': { 'N': str(item['timestamp']) },
+                        ':r': { 'S': item['reading'] }
+                    }
+                )
+            except self._client.exceptions.ConditionalCheckFailedException:
+                pass
+
+    def _submit(self, pool, slots, batch_id, first_row, last_row, items):
+        slots.acquire()
+        with self._lock:
+            self._in_flight[batch_id] = (first_row, last_row)
+
+        def done(future):
+            slots.release()
+            if future.exception() is not None:
+                # failed batches stay in flight so the checkpoint never moves past them
+                return
+            with self._lock:
+                del self._in_flight[batch_id]
+                self.written += len(items)
+                self.batches += 1
+                self._max_done = max(self._max_done, last_row)
+                pending = [first for first, _ in self._in_flight.values()]
+                self._done_upto = (min(pending) - 1) if pending else self._max_done
+
+        future = pool.submit(self.write_batch, items)
+        future.add_done_callback(done)
+        return future
+
+    def _maybe_checkpoint(self, force=False):
+        with self._lock:
+            upto = self._done_upto
+        if upto > self._saved_upto and (force or upto - self._saved_upto >= self.checkpoint_every):
+            self.checkpoint.save(upto)
+            self._saved_upto = upto
+
+    def run(self, lines, file_format):
+        start = time.time()
+        skip = self.checkpoint.load()
+        self._max_done = self._done_upto = self._saved_upto = skip
+        if skip:
+            structured_log.info('resuming after row %d', skip)
+
+        # at most two batches queued per worker so memory stays flat
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        futures = []
+        batch, batch_keys, first_row = [], set(), None
+        batch_id = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for number, row in read_rows(lines, file_format):
+                if number <= skip:
+                    continue
+                try:
+                    item = validate(row)
+                except InvalidRow as e:
+                    self.rejected += 1
+                    structured_log.debug('rejected row %d: %s', number, e)
+                    continue
+
+                # BatchWriteItem refuses duplicate keys in one request
+                key = (item['user_id'], item['timestamp'])
+                if key in batch_keys:
+                    continue
+                if first_row is None:
+                    first_row = number
+                batch.append(item)
+                batch_keys.add(key)
+
+                if len(batch) == BATCH_SIZE:
+                    futures.append(self._submit(pool, slots, batch_id, first_row, number, batch))
+                    batch_id += 1
+                    batch, batch_keys, first_row = [], set(), None
+                    futures = [f for f in futures if not f.done() or f.exception()]
+                    self._raise_failures(futures)
+                    self._maybe_checkpoint()
+
+            if batch:
+                futures.append(self._submit(pool, slots, batch_id, first_row, number, batch))
+
+        self._raise_failures(futures)
+        self.checkpoint.clear()
+        elapsed = time.time() - start
+        report = {
+            'rows_written': self.written,
+            'rows_rejected': self.rejected,
+            'batches': self.batches,
+            'retries': self.retries,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(self.written / elapsed, 1) if elapsed else None
+        }
+        structured_log.info('ingestion complete', **report)
+        return report
+
+    def _raise_failures(self, futures):
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                self._maybe_checkpoint(force=True)
+                raise future.exception()
+
+def lambda_handler(event, context):
+    """
+    Triggered by uploads under meter-readings/ in the recordings bucket.
+    """
+    structured_log.start('meter_ingest', context, sample_rate=1.0)
+    reports = []
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        structured_log.bind(bucket=bucket, key=key)
+        body = aws_clients.s3().get_object(Bucket=bucket, Key=key)['Body']
+        lines = codecs.iterdecode(body.iter_lines(), 'utf-8')
+        ingestion = Ingestion(
+            os.environ['METER_READING_TABLE_NAME'],
+            S3Checkpoint(bucket, key),
+            workers=int(os.environ.get('INGEST_WORKERS', '8')),
+            rollup_table_name=os.environ.get('ROLLUP_TABLE_NAME')
+        )
+        reports.append(ingestion.run(lines, file_format_for(key)))
+    structured_log.end(files=len(reports))
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load smart-meter readings into MeterReadingTable.')
+    parser.add_argument('path', help='CSV or newline-delimited JSON file')
+    parser.add_argument('--table', default=os.environ.get('METER_READING_TABLE_NAME'), required='METER_READING_TABLE_NAME' not in os.environ)
+    parser.add_argument('--rollup-table', default=os.environ.get('ROLLUP_TABLE_NAME'), help='table of latest-reading items to move on, if any')
+    parser.add_argument('--format', choices=['csv', 'jsonl'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--checkpoint', help='checkpoint file, defaults to <path>.checkpoint')
+    args = parser.parse_args()
+
+    structured_log.start('meter_ingest', sample_rate=0.0)
+    ingestion = Ingestion(args.table, LocalCheckpoint(args.checkpoint or args.path + '.checkpoint'), workers=args.workers, rollup_table_name=args.rollup_table)
+    with open(args.path, newline='') as f:
+        ingestion.run(f, args.format or file_format_for(args.path))
+
+if __name__ == '__main__':
+    main()
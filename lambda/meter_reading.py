@@ -1,165 +1,278 @@
-import json
 import os
 import re
+import json
 import time
-import uuid
-import decimal
-from random import random
+import itertools
 
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
+import consumption_rollup
+import deadline
+import lex_event
+import session_codec
+import meter_history
+import sms_queue
+import structured_log
+import user_cache
+import warmup
+
+# Number of readings read back by the ReadingHistory intent.
+HISTORY_READINGS = 3
+
+# What the caller hears when a turn runs out of time, by intent.
+OUT_OF_TIME = {
+    'MeterReading': 'Sorry, we could not save your meter reading just now. Please try again in a few minutes.',
+}
+OUT_OF_TIME_DEFAULT = 'Sorry, our systems are taking longer than usual to respond. Please try again in a few minutes.'
+
+# What the caller hears if an intent reaches fulfillment without the caller
+# having been verified by identity_verification.
+NOT_VERIFIED = 'Sorry, we could not verify your identity. Please call again to try once more.'
+
+# Readings are the 6 digits on the meter's display.
+READING_PATTERN = re.compile(r'^\d{6}$')
+# The most a meter can plausibly advance in a day, by utility type, as JSON in
+# READING_MAX_DAILY_USE, and for any other type.
+MAX_DAILY_USE = json.loads(os.environ.get('READING_MAX_DAILY_USE') or '{}')
+MAX_DAILY_USE_DEFAULT = 1000
+
+# Why a reading is asked for again.
+READING_PROMPTS = {
+    'reading_format': 'Sorry, a meter reading is the 6 digits shown on your meter. What does your meter read?',
+    'reading_lower': 'That is lower than the last reading we have for your {utility_type} meter, which was {last}. Could you check your meter and tell me the reading again?',
+    'reading_implausible': 'That is a lot higher than we would expect since your last {utility_type} reading of {last}. Could you check your meter and tell me the reading again?',
+}
 
 class EmptyListError(Exception):
     pass
 
-def get_slots(intent_request):
-    return intent_request['currentIntent']['slots']
-
-def confirm_intent(session_attributes, intent_name, slots, message):
-    return {
-        'sessionAttributes': session_attributes,
-        'dialogAction': {
-            'type': 'ConfirmIntent',
-            'intentName': intent_name,
-            'slots': slots,
-            'message': message
-        }
-    }
-
-def close(session_attributes, fulfillment_state, message):
-    response = {
-        'sessionAttributes': session_attributes,
-        'dialogAction': {
-            'type': 'Close',
-            'fulfillmentState': fulfillment_state,
-            'message': message
-        }
-    }
-
-    return response
-
-def delegate(session_attributes, slots):
-    return {
-        'sessionAttributes': session_attributes,
-        'dialogAction': {
-            'type': 'Delegate',
-            'slots': slots
-        }
-    }
-
-def submit_reading(intent_request):
+def latest_key(user_id, utility_type):
+    """
+    The key of the latest-reading item kept for each user and utility type, next
+    to the consumption rollups.
+    """
+    return { 'user_id': { 'S': str(user_id) }, 'period': { 'S': 'latest#' + utility_type } }
+
+def get_latest(user_id, utility_type):
+    return deadline.client('dynamodb', 'latest_read').get_item(
+        TableName=os.environ['ROLLUP_TABLE_NAME'],
+        Key=latest_key(user_id, utility_type),
+        ConsistentRead=True
+    ).get('Item')
+
+def check_reading(reading, utility_type, latest, now):
+    """
+    None if reading can follow the latest-reading item (None for a first
+    reading), otherwise the READING_PROMPTS key saying why not.
+    """
+    if latest is None:
+        return None
+    last = int(latest['reading']['S'])
+    used = int(reading) - last
+    if used < 0:
+        if not consumption_rollup.rolled_over(last):
+            return 'reading_lower'
+        used += consumption_rollup.REGISTER_ROLLOVER
+    days = max((now - float(latest['timestamp']['N'])) / 86400.0, 1.0)
+    if used > MAX_DAILY_USE.get(utility_type, MAX_DAILY_USE_DEFAULT) * days:
+        return 'reading_implausible'
+    return None
+
+def save_reading(user_id, utility_type, reading, latest, submission, now):
+    """
+    Write the reading and move the latest-reading item on to it in one
+    transaction, which only goes through if the latest reading is still the one
+    the new reading was checked against.
+    """
+    timestamp = { 'N': '%.6f' % now }
+    pointer = { 'Put': {
+        'TableName': os.environ['ROLLUP_TABLE_NAME'],
+        'Item': dict(latest_key(user_id, utility_type),
+            timestamp=timestamp,
+            reading={ 'S': reading },
+            submission={ 'S': submission }
+        ),
+    } }
+    if latest is None:
+        pointer['Put']['ConditionExpression'] = 'attribute_not_exists(user_id)'
+    else:
+        pointer['Put']['ConditionExpression'] = '#t = :t'
+        pointer['Put']['ExpressionAttributeNames'] = { '#t': 'timestamp' }
+        pointer['Put']['ExpressionAttributeValues'] = { ':t': latest['timestamp'] }
+
+    deadline.client('dynamodb', 'reading_write').transact_write_items(TransactItems=[
+        { 'Put': {
+            'TableName': os.environ['METER_READING_TABLE_NAME'],
+            'Item': {
+                #'postcode': postcode,
+                'reading': { 'S': reading },
+                'utility_type': { 'S': utility_type },
+                'timestamp': timestamp,
+                'user_id': { 'S': str(user_id) }
+            },
+            'ConditionExpression': 'attribute_not_exists(user_id)'
+        } },
+        pointer,
+    ])
+
+def record_reading(lex, user_id, utility_type, reading):
+    """
+    Validate and save a reading. Returns (result, latest-reading item checked
+    against): result is None once the reading is saved, 'duplicate' if this
+    session has already saved the same reading (Lex retrying the code hook), or
+    the READING_PROMPTS key for a reading that was turned down.
+    """
+    if not READING_PATTERN.match(reading):
+        return 'reading_format', None
+    # the same reading twice in one session is one submission
+    submission = '%s#%s' % (lex.session_id, reading)
+    for attempt in range(2):
+        latest = get_latest(user_id, utility_type)
+        if latest is not None and latest.get('submission', {}).get('S') == submission:
+            return 'duplicate', latest
+        now = time.time()
+        problem = check_reading(reading, utility_type, latest, now)
+        if problem:
+            return problem, latest
+        client = deadline.client('dynamodb', 'reading_write')
+        try:
+            save_reading(user_id, utility_type, reading, latest, submission, now)
+            return None, latest
+        except client.exceptions.TransactionCanceledException:
+            if attempt:
+                raise
+            # another submission for the meter got in first, check against that one
+            structured_log.info('latest reading changed')
+
+def submit_reading(lex, state):
     """
     Performs dialog management and fulfillment for meter readings.
-    Beyond fulfillment, the implementation of this intent demonstrates the use of the elicitSlot dialog action
-    in slot validation and re-prompting.
+    Readings are checked against the caller's latest one and asked for again
+    with the elicitSlot dialog action if they don't follow on from it.
     """
 
-    slots = intent_request['currentIntent']['slots']
+    slots = lex.slots
     #postcode = get_slots(intent_request)["Postcode"]
-    reading = slots["Reading"]
+    # Lex only fills the slot with 6 digits (the MeterReadingValue slot type);
+    # record_reading checks READING_PATTERN again in case anything else gets through
+    reading = (slots["Reading"] or '').strip()
     utility_type = slots["UtilityType"]
     user_id = slots["UserId"]
     vcode = slots["vcode"]
-    customerPhone = slots["Phone"]
-
-    session_attributes = intent_request['sessionAttributes'] if intent_request['sessionAttributes'] is not None else {}
-
-    meter_reading = json.dumps(slots, indent=4, cls=DecimalEncoder)
 
-    session_attributes['MeterReading'] = meter_reading
+    # the number the one time code went to, not whatever is in the Phone slot
+    customerPhone = state.get('customer_phone')
+    state['meter_reading'] = slots
+    session_codec.store(lex.session_attributes, state)
 
-    ddb_users = boto3.resource('dynamodb')
     #ID verification section - user_id and vcode
-    user_table = ddb_users.Table(os.environ['USER_TABLE_NAME'])
     try:
-        response = user_table.query(
-            ExpressionAttributeValues={
-                ':user_id': user_id
-            },
-            IndexName = 'user_id-index',
-            KeyConditionExpression='user_id = :user_id',
-        )
-        print(response)
+        item = user_cache.get_user(user_id)
     except ClientError as e:
-        print(e.response['Error']['Message'])
+        structured_log.error('user lookup failed: %s', e.response['Error']['Message'])
     else:
-        items = response['Items']
-        if not items:
+        if not item:
             raise EmptyListError
         else:
-            # print("Found user")
-            # print(items)
-            if str(vcode) == str(items[0]["vcode"]):
-                print("YES")
-            else:
-                print("NO")
+            structured_log.debug('vcode checked', matched=str(vcode) == str(item["vcode"]))
 
     # insert values into the DB.
-    ddb_meter = boto3.resource('dynamodb')
-    meter_table = ddb_meter.Table(os.environ['METER_READING_TABLE_NAME'])
-
-    meter_table.put_item(
-        Item = {
-            #'postcode': postcode,
-            'reading': reading,
-            'utility_type': utility_type,
-            'timestamp': decimal.Decimal(time.time()),
-            'user_id': user_id
-        }
-    )
+    result, latest = record_reading(lex, user_id, utility_type, reading)
+    structured_log.bind(reading_check=result or 'saved')
+    if result in READING_PROMPTS:
+        lex.slots['Reading'] = None
+        return lex_event.elicit_slot(lex, 'Reading', lex_event.plain_text(READING_PROMPTS[result].format(
+            utility_type=utility_type,
+            last=latest['reading']['S'] if latest else ''
+        )))
+
     #Jing: Send sms confirmation through SNS
     msg = "Thank you for submitting your {} meter reading. We have updated our records, with a reading of {}. ".format(utility_type, reading)
-    snsClient = boto3.client('sns')
-    snsClient.publish(
-        PhoneNumber = customerPhone,
-        Message = msg
-    )
+    # a duplicate was confirmed the first time round
+    if result != 'duplicate' and customerPhone:
+        try:
+            sms_queue.send(customerPhone, msg)
+        except deadline.EXCEEDED as e:
+            # the reading is saved, only the confirmation text is late
+            deadline.exceeded(e)
 
-    return close(session_attributes,
+    return lex_event.close(lex,
                  'Fulfilled',
-                 {'contentType': 'PlainText',
-                  'content': "Thank you for submitting your {} meter reading. "
+                 lex_event.plain_text("Thank you for submitting your {} meter reading. "
                   "We have updated our records, "
-                  "with a reading of {}. ".format(utility_type, reading)})
+                  "with a reading of {}. ".format(utility_type, reading)))
 
-def billing_enquiry(intent_request):
-    bill = round(random()*100,2)
+def billing_enquiry(lex):
+    # NumPy takes a while to import, so only turns that need a bill pay for it
+    import billing
 
-    return close(intent_request['sessionAttributes'],
+    bill = billing.account_bill(lex.slots['UserId'])
+
+    return lex_event.close(lex,
                  'Fulfilled',
-                 {'contentType': 'PlainText',
-                  'content': 'Your current energy bill is £{}.'.format(bill)})
+                 lex_event.plain_text('Your current energy bill is £{:.2f}.'.format(bill)))
 
-def dispatch(intent_request):
+def reading_history(lex):
     """
-    Called when the user specifies an intent for this bot.
+    Reads back the caller's most recent meter readings, newest first.
     """
-    print(intent_request)
-    intent_name = intent_request['currentIntent']['name']
+    user_id = lex.slots['UserId']
+    readings = list(itertools.islice(
+        meter_history.iter_readings(
+            user_id,
+            newest_first=True,
+            page_size=HISTORY_READINGS,
+            projection=['timestamp', 'reading', 'utility_type']
+        ),
+        HISTORY_READINGS
+    ))
+
+    if not readings:
+        content = 'We do not have any meter readings on record for your account yet.'
+    else:
+        content = 'Your last {} meter readings were: {}.'.format(len(readings), '; '.join(
+            '{} {} on {}'.format(r['utility_type'], r['reading'], time.strftime('%d %B %Y', time.gmtime(int(r['timestamp']))))
+            for r in readings
+        ))
+
+    return lex_event.close(lex, 'Fulfilled', lex_event.plain_text(content))
+
+def fulfil(lex, state):
+    intent_name = lex.intent_name
 
     # Dispatch to your bot's intent handlers
     if intent_name == 'MeterReading':
-        return submit_reading(intent_request)
+        return submit_reading(lex, state)
     elif intent_name == 'BillingEnquiry':
-        return billing_enquiry(intent_request)
+        return billing_enquiry(lex)
+    elif intent_name == 'ReadingHistory':
+        return reading_history(lex)
 
     raise Exception('Intent with name ' + intent_name + ' not supported')
 
-def lambda_handler(event, context):
+def dispatch(lex):
     """
-    Route the incoming request based on intent.
-    The JSON body of the request is provided in the event slot.
+    Called when the user specifies an intent for this bot. Every intent here
+    acts on the UserId slot, so only once identity_verification has verified
+    the caller: Lex only invokes the dialog code hook for some slots, so
+    nothing else guarantees that it has, or that UserId is still the account
+    that was verified.
     """
+    state = session_codec.load(lex.session_attributes)
+    if not state.get('auth') or state.get('user_id') != str(lex.slots['UserId']):
+        structured_log.bind(not_verified=True)
+        return lex_event.close(lex, 'Failed', lex_event.plain_text(NOT_VERIFIED))
+    try:
+        return fulfil(lex, state)
+    except deadline.EXCEEDED as e:
+        deadline.exceeded(e)
+        return lex_event.close(lex, 'Failed', lex_event.plain_text(OUT_OF_TIME.get(lex.intent_name, OUT_OF_TIME_DEFAULT)))
 
-    return dispatch(event)
+# What a warm-up builds ahead of the first real turn, NumPy included.
+WARM_UP = {
+    'clients': [('dynamodb', 'reading_write'), ('dynamodb', 'latest_read'), (sms_queue.service_name(), 'sms')],
+    'tables': [('METER_READING_TABLE_NAME', 'history'), ('USER_TABLE_NAME', 'user_lookup')],
+    'modules': ['billing', 'boto3.dynamodb.conditions'],
+}
 
+warmup.on_init(**WARM_UP)
@@ -0,0 +1,128 @@
+import hashlib
+import hmac
+import os
+import secrets
+import struct
+import time
+import uuid
+
+import deadline
+import structured_log
+
+# One time codes for identity verification.
+#
+# OTP_MODE=hmac (the default) derives the code TOTP style from an HMAC of a
+# server secret, a random nonce kept in the conversation state, the account the
+# code is for and the STEP_SECONDS time step it was issued in. Issuing a code
+# makes no AWS call and checking one is pure CPU with a constant-time
+# comparison. A code is accepted in the step it was issued in and the one
+# after, and only once: a successful check writes the nonce to OtpTable on the
+# condition that it isn't there yet. The account is part of the HMAC so a
+# nonce and code from one caller's conversation are no good in another's.
+#
+# OTP_MODE=table is the original scheme: a random code stored in OtpTable
+# under the nonce, and read back to check it.
+#
+# The secret is OTP_SECRET, or else read once per container from the Secrets
+# Manager secret OTP_SECRET_ARN.
+
+HMAC = 'hmac'
+TABLE = 'table'
+
+MODE = os.environ.get('OTP_MODE', HMAC)
+DIGITS = 6
+STEP_SECONDS = int(os.environ.get('OTP_STEP_SECONDS', '60'))
+# How long a table-backed code is valid for.
+TABLE_CODE_SECONDS = 60
+
+_secret = {}
+
+def secret():
+    if 'value' not in _secret:
+        value = os.environ.get('OTP_SECRET')
+        if not value:
+            value = deadline.client('secretsmanager', 'otp_secret').get_secret_value(
+                SecretId=os.environ['OTP_SECRET_ARN']
+            )['SecretString']
+        _secret['value'] = value.encode('utf-8')
+    return _secret['value']
+
+def derive(nonce, user_id, step):
+    """
+    The code for a nonce, account and time step: HOTP's dynamic truncation
+    (RFC 4226) of an HMAC-SHA256.
+    """
+    message = ('%s|%s|%d' % (nonce, user_id, step)).encode('utf-8')
+    digest = hmac.new(secret(), message, hashlib.sha256).digest()
+    offset = digest[-1] & 0x0f
+    value = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7fffffff
+    return str(value % 10 ** DIGITS).zfill(DIGITS)
+
+def issue(user_id, now=None):
+    """
+    A new (nonce, code) pair for user_id. The nonce goes in the conversation
+    state, the code to the caller.
+    """
+    nonce = str(uuid.uuid4())
+    now = int(now or time.time())
+    if MODE == TABLE:
+        code = str(secrets.randbelow(10 ** DIGITS)).zfill(DIGITS)
+        deadline.client('dynamodb', 'otp_write').put_item(
+            TableName=os.environ['OTP_TABLE_NAME'],
+            Item={
+                'uuid': {'S': nonce},
+                'pin': {'S': code},
+                'timeStamp': {'N': str(now)}
+            }
+        )
+        return nonce, code
+    return nonce, derive(nonce, user_id, now // STEP_SECONDS)
+
+def verify(code, nonce, user_id, now=None):
+    if not code or not nonce:
+        return False
+    now = int(now or time.time())
+    if MODE == TABLE:
+        return verify_stored(str(code), nonce, now)
+    step = now // STEP_SECONDS
+    # compare against both steps whatever the first gives, so the time taken doesn't depend on the code
+    matches = [hmac.compare_digest(str(code), derive(nonce, user_id, s)) for s in (step, step - 1)]
+    if not any(matches):
+        return False
+    return mark_used(nonce, now)
+
+def verify_stored(code, nonce, now):
+    result = deadline.client('dynamodb', 'otp_read').get_item(
+        TableName=os.environ['OTP_TABLE_NAME'],
+        Key={'uuid': {'S': nonce}}
+    )
+    item = result.get('Item')
+    if not item:
+        return False
+    if now - int(item['timeStamp']['N']) >= TABLE_CODE_SECONDS:
+        structured_log.info("one time code expired")
+        return False
+    return hmac.compare_digest(code, item['pin']['S'])
+
+def mark_used(nonce, now):
+    """
+    Record a nonce whose code was just accepted. False if it already was, i.e.
+    the code is being replayed. The record expires once the code would have
+    anyway.
+    """
+    client = deadline.client('dynamodb', 'otp_write')
+    try:
+        client.put_item(
+            TableName=os.environ['OTP_TABLE_NAME'],
+            Item={
+                'uuid': {'S': 'used#' + nonce},
+                'timeStamp': {'N': str(now)},
+                'expires': {'N': str(now + 2 * STEP_SECONDS)}
+            },
+            ConditionExpression='attribute_not_exists(#u)',
+            ExpressionAttributeNames={'#u': 'uuid'}
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        structured_log.info("one time code replayed")
+        return False
+    return True
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+
+import deadline
+import structured_log
+
+# Limits how many one time codes are sent per phone number and per user_id.
+#
+# Counts are kept per fixed window in RateLimitTable, one item per key and
+# window, and expire through the table's TTL. Checking and incrementing both
+# counters is a single TransactWriteItems call, so an OTP send costs at most one
+# extra DynamoDB round trip. The container also remembers keys it has seen
+# reach their limit, and refuses those without calling DynamoDB at all until
+# the window rolls over.
+
+WINDOW_SECONDS = int(os.environ.get('OTP_LIMIT_WINDOW_SECONDS', '3600'))
+PHONE_LIMIT = int(os.environ.get('OTP_LIMIT_PER_PHONE', '5'))
+USER_LIMIT = int(os.environ.get('OTP_LIMIT_PER_USER', '5'))
+
+_lock = threading.Lock()
+# key -> window start, for keys known to be over their limit
+_exhausted = {}
+
+def window_start(now):
+    return int(now) - int(now) % WINDOW_SECONDS
+
+def _is_exhausted(key, window):
+    with _lock:
+        return _exhausted.get(key) == window
+
+def _mark_exhausted(key, window):
+    with _lock:
+        # drop keys from earlier windows so the dict stays small
+        for stale in [k for k, w in _exhausted.items() if w != window]:
+            del _exhausted[stale]
+        _exhausted[key] = window
+
+def _increment(key, window, limit):
+    return {
+        'Update': {
+            'TableName': os.environ['RATE_LIMIT_TABLE_NAME'],
+            'Key': { 'key': { 'S': '%s#%d' % (key, window) } },
+            'UpdateExpression': 'ADD #n :one SET #e = if_not_exists(#e, :expires)',
+            'ConditionExpression': 'attribute_not_exists(#n) OR #n < :limit',
+            'ExpressionAttributeNames': { '#n': 'count', '#e': 'expires' },
+            'ExpressionAttributeValues': {
+                ':one': { 'N': '1' },
+                ':limit': { 'N': str(limit) },
+                ':expires': { 'N': str(window + 2 * WINDOW_SECONDS) },
+            }
+        }
+    }
+
+def allow_otp(phone_number, user_id, now=None):
+    """
+    Count one OTP send against both the phone number and the user_id.
+    Returns False, without counting anything, if either is over its limit.
+    """
+    window = window_start(now or time.time())
+    limits = [
+        ('phone#%s' % phone_number, PHONE_LIMIT),
+        ('user#%s' % user_id, USER_LIMIT),
+    ]
+    for key, _ in limits:
+        if _is_exhausted(key, window):
+            structured_log.info('otp rate limited', limited_by=key.split('#')[0], cached=True)
+            return False
+
+    client = deadline.client('dynamodb', 'rate_limit')
+    try:
+        client.transact_write_items(
+            TransactItems=[_increment(key, window, limit) for key, limit in limits]
+        )
+    except client.exceptions.TransactionCanceledException as e:
+        reasons = e.response.get('CancellationReasons', [])
+        limited = [key for (key, _), reason in zip(limits, reasons) if reason.get('Code') == 'ConditionalCheckFailed']
+        if not limited:
+            raise
+        for key in limited:
+            _mark_exhausted(key, window)
+        structured_log.info('otp rate limited', limited_by=','.join(key.split('#')[0] for key in limited), cached=False)
+        return False
+    return True
@@ -0,0 +1,74 @@
+import base64
+import decimal
+import json
+import os
+import zlib
+
+# Conversation state carried in Lex session attributes.
+#
+# Lex sends every session attribute back and forth on every turn, so all the
+# state the code hooks keep lives under a single attribute, encoded as compact
+# JSON with short keys and a version field. Anything longer than
+# SESSION_COMPRESS_THRESHOLD bytes is deflated and base64 encoded.
+# load() decodes it once at the start of a turn, store() writes it back.
+
+ATTRIBUTE = 'conv'
+VERSION = 1
+
+COMPRESS_THRESHOLD = int(os.environ.get('SESSION_COMPRESS_THRESHOLD', '512'))
+
+SHORT_KEYS = {
+    'uuid': 'u',
+    'customer_phone': 'p',
+    'customer_name': 'n',
+    'count': 'c',
+    'auth': 'a',
+    'meter_reading': 'm',
+    'caller_id_checked': 'i',
+    'user_id': 'w',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+PLAIN = 'j'
+DEFLATED = 'z'
+
+def _default(o):
+    if isinstance(o, decimal.Decimal):
+        return int(o) if o % 1 == 0 else float(o)
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+def encode(state):
+    packed = {SHORT_KEYS.get(k, k): v for k, v in state.items() if v is not None}
+    packed['v'] = VERSION
+    text = json.dumps(packed, separators=(',', ':'), default=_default)
+    if len(text) > COMPRESS_THRESHOLD:
+        return DEFLATED + base64.b64encode(zlib.compress(text.encode('utf-8'), 9)).decode('ascii')
+    return PLAIN + text
+
+def decode(text):
+    """
+    Decode a value written by encode(). Anything unreadable, or written by a
+    different version, decodes to an empty state.
+    """
+    if not text:
+        return {}
+    try:
+        if text[0] == DEFLATED:
+            text = zlib.decompress(base64.b64decode(text[1:])).decode('utf-8')
+        elif text[0] == PLAIN:
+            text = text[1:]
+        else:
+            return {}
+        packed = json.loads(text)
+    except (ValueError, zlib.error):
+        return {}
+    if packed.pop('v', None) != VERSION:
+        return {}
+    return {LONG_KEYS.get(k, k): v for k, v in packed.items()}
+
+def load(session_attributes):
+    return decode((session_attributes or {}).get(ATTRIBUTE))
+
+def store(session_attributes, state):
+    session_attributes[ATTRIBUTE] = encode(state)
+    return session_attributes
@@ -0,0 +1,80 @@
+import json
+import os
+from collections import deque
+
+import aws_clients
+import deadline
+
+# Outbound SMS from the Lex code hooks.
+# With SMS_DELIVERY=async the code hook only enqueues the message and returns;
+# sms_sender.lambda_handler drains the queue in batches and owns retries and
+# dead-lettering. With SMS_DELIVERY=sync (or no queue configured) the message
+# is published to SNS inline, as before.
+
+class SqsQueue(object):
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+
+    def put(self, job):
+        return deadline.client('sqs', 'sms').send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(job, separators=(',', ':'))
+        )
+
+class InMemoryQueue(object):
+    """
+    Local stand-in for SqsQueue. drain() returns the jobs in the shape of an SQS
+    event so they can be fed straight into sms_sender.lambda_handler.
+    """
+
+    def __init__(self):
+        self.jobs = deque()
+
+    def put(self, job):
+        self.jobs.append(job)
+        return { 'MessageId': str(len(self.jobs)) }
+
+    def drain(self):
+        records = []
+        while self.jobs:
+            job = self.jobs.popleft()
+            records.append({
+                'messageId': str(len(records)),
+                'body': json.dumps(job, separators=(',', ':'))
+            })
+        return { 'Records': records }
+
+_queue = None
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        _queue = SqsQueue(os.environ['SMS_QUEUE_URL'])
+    return _queue
+
+def set_queue(queue):
+    global _queue
+    _queue = queue
+
+def is_async():
+    if _queue is not None:
+        return True
+    return os.environ.get('SMS_DELIVERY', 'sync') == 'async' and 'SMS_QUEUE_URL' in os.environ
+
+def service_name():
+    """
+    The AWS service send() goes through.
+    """
+    return 'sqs' if is_async() else 'sns'
+
+def publish(phone_number, message):
+    return aws_clients.sns().publish(PhoneNumber=phone_number, Message=message)
+
+def send(phone_number, message):
+    """
+    Send an SMS, either fire and forget through the queue or inline through SNS.
+    """
+    if is_async():
+        return get_queue().put({ 'phone': phone_number, 'message': message })
+    return deadline.client('sns', 'sms').publish(PhoneNumber=phone_number, Message=message)
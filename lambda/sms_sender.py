@@ -0,0 +1,25 @@
+import json
+
+from botocore.exceptions import ClientError
+
+import sms_queue
+import structured_log
+
+def lambda_handler(event, context):
+    """
+    Batch consumer for the SMS queue. Messages that fail to publish are reported
+    back as batch item failures so only they are retried, and end up on the
+    dead-letter queue once the queue's receive count is exhausted.
+    """
+    structured_log.start('sms_sender', context, batch_size=len(event['Records']))
+    failures = []
+    for record in event['Records']:
+        try:
+            job = json.loads(record['body'])
+            sms_queue.publish(job['phone'], job['message'])
+        except (ClientError, KeyError, ValueError) as e:
+            structured_log.error("failed to send message %s: %s", record['messageId'], e)
+            failures.append({ 'itemIdentifier': record['messageId'] })
+
+    structured_log.end(failed=len(failures))
+    return { 'batchItemFailures': failures }
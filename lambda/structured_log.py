@@ -0,0 +1,125 @@
+import json
+import os
+import random
+import sys
+import time
+
+import aws_metrics
+
+# Structured JSON logging for the Lambda handlers.
+#
+# Every invocation gets one summary record (handler, request id, elapsed_ms and
+# whatever fields the handler added). Debug records, which is where full event
+# payloads go, are only written for a sampled share of invocations, set with
+# LOG_SAMPLE_RATE (0.0 - 1.0), or for all of them with LOG_LEVEL=DEBUG.
+# Arguments are only formatted when a record is actually written, and any
+# field that is callable is evaluated at that point too. Known PII fields are
+# redacted wherever they appear in a record. LOG_LEVEL=NONE turns logging off.
+# The summary record also carries the invocation's AWS call totals, which are
+# written out as CloudWatch metrics as well (see aws_metrics).
+
+REDACTED = '***'
+
+PII_FIELDS = frozenset([
+    'phone',
+    'Phone',
+    'PhoneNumber',
+    'Message',
+    'customer_phone',
+    'customer_name',
+    'firstName',
+    'lastName',
+    'email',
+    'vcode',
+    'pin',
+    'uuid',
+    'inputTranscript',
+    # Lex V2: the caller's raw utterance for each interpretation, and as said for each slot
+    'transcription',
+    'originalValue',
+    'MeterReading',
+    'conv',
+    'CallerNumber',
+])
+
+SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+DEBUG = LOG_LEVEL == 'DEBUG'
+ENABLED = LOG_LEVEL != 'NONE'
+
+_invocation = {
+    'handler': None,
+    'start': time.time(),
+    'sampled': False,
+    'fields': {},
+}
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: (REDACTED if k in PII_FIELDS and v else redact(v)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+def _resolve(value):
+    return value() if callable(value) else value
+
+def _write(level, message, args, fields):
+    if not ENABLED:
+        return
+    record = {
+        'level': level,
+        'handler': _invocation['handler'],
+    }
+    record.update(_invocation['fields'])
+    if message is not None:
+        record['msg'] = message % tuple(_resolve(a) for a in args) if args else message
+    for key, value in fields.items():
+        record[key] = _resolve(value)
+    sys.stdout.write(json.dumps(redact(record), default=str, separators=(',', ':')) + '\n')
+
+def start(handler, context=None, sample_rate=None, **fields):
+    """
+    Begin a new invocation. Call at the top of a handler, before anything is logged.
+    """
+    rate = SAMPLE_RATE if sample_rate is None else sample_rate
+    _invocation['handler'] = handler
+    _invocation['start'] = time.time()
+    _invocation['sampled'] = DEBUG or random.random() < rate
+    _invocation['fields'] = dict(fields)
+    aws_metrics.reset()
+    if context is not None:
+        _invocation['fields']['request_id'] = getattr(context, 'aws_request_id', None)
+
+def bind(**fields):
+    """
+    Add fields to every record written for the rest of this invocation.
+    """
+    _invocation['fields'].update(fields)
+
+def sampled():
+    return _invocation['sampled']
+
+def elapsed_ms():
+    return int((time.time() - _invocation['start']) * 1000)
+
+def debug(message, *args, **fields):
+    if _invocation['sampled']:
+        _write('DEBUG', message, args, fields)
+
+def info(message, *args, **fields):
+    _write('INFO', message, args, fields)
+
+def error(message, *args, **fields):
+    _write('ERROR', message, args, fields)
+
+def end(**fields):
+    """
+    Write the summary record and the AWS call metrics for this invocation.
+    """
+    summary = aws_metrics.totals()
+    summary.update(fields)
+    summary['elapsed_ms'] = elapsed_ms()
+    _write('INFO', None, (), summary)
+    if ENABLED:
+        aws_metrics.emit(_invocation['handler'])
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import deadline
+
+# Customer profiles looked up by user_id, cached in the container.
+# A single caller conversation hits the user_id-index GSI several times for the
+# same profile, so keep the result around for a short while. Unknown IDs are
+# cached too (for a shorter time) so repeated bad input does not turn into
+# repeated queries. Profiles can also be looked up by phone number, which is
+# UserTable's partition key, with a GetItem instead of a GSI query; a profile
+# found that way is cached under its user_id as well.
+
+_MISSING = object()
+
+# The profile attributes the code hooks read. The user_id-index GSI projects
+# the same set (see LexStack), so profiles look the same whichever way they
+# were found.
+ATTRIBUTES = ['user_id', 'PhoneNumber', 'firstName', 'email', 'vcode']
+PROJECTION = {
+    'ProjectionExpression': ', '.join('#a%d' % i for i in range(len(ATTRIBUTES))),
+    'ExpressionAttributeNames': {'#a%d' % i: name for i, name in enumerate(ATTRIBUTES)},
+}
+
+class TTLCache(object):
+    """
+    Bounded LRU cache where every entry expires after a time to live.
+    """
+
+    def __init__(self, max_size, ttl, negative_ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=_MISSING):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data)
+        }
+
+profiles = TTLCache(
+    max_size=int(os.environ.get('USER_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('USER_CACHE_TTL', '300')),
+    negative_ttl=float(os.environ.get('USER_CACHE_NEGATIVE_TTL', '30'))
+)
+
+def get_user(user_id):
+    """
+    Return the UserTable item for user_id, or None if there is no such user.
+    ClientErrors are raised to the caller and are never cached.
+    """
+    user_id = str(user_id)
+    item = profiles.get(user_id)
+    if item is not _MISSING:
+        return item
+
+    response = deadline.table(os.environ['USER_TABLE_NAME'], 'user_lookup').query(
+        ExpressionAttributeValues={
+            ':user_id': user_id
+        },
+        IndexName = 'user_id-index',
+        KeyConditionExpression='user_id = :user_id',
+        **PROJECTION
+    )
+    items = response['Items']
+    item = items[0] if items else None
+    profiles.put(user_id, item)
+    return item
+
+def get_user_by_phone(phone_number):
+    """
+    Return the UserTable item for a phone number, e.g. the caller's number
+    passed on by Connect, or None if no customer has that number.
+    """
+    key = 'phone#%s' % phone_number
+    item = profiles.get(key)
+    if item is not _MISSING:
+        return item
+
+    response = deadline.table(os.environ['USER_TABLE_NAME'], 'user_lookup').get_item(
+        Key={'PhoneNumber': phone_number},
+        **PROJECTION
+    )
+    item = response.get('Item')
+    profiles.put(key, item)
+    if item and item.get('user_id'):
+        profiles.put(str(item['user_id']), item)
+    return item
+
+def invalidate(user_id=None):
+    profiles.invalidate(None if user_id is None else str(user_id))
+
+def stats():
+    return profiles.stats()
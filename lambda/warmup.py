@@ -0,0 +1,51 @@
+import importlib
+import os
+import time
+
+import aws_clients
+import deadline
+
+# Warm-up pings for the handlers that take live traffic.
+#
+# A scheduled EventBridge rule invokes them with {"warmup": true}. The handler
+# answers it by building the clients and Table objects a real invocation would
+# use and importing the modules it otherwise imports lazily, then returns
+# without calling AWS or doing any business logic. Clients and lazy imports
+# are deferred to first use to keep on-demand cold starts short, so
+# environments started for provisioned concurrency warm themselves the same
+# way during init instead (see on_init).
+
+PING = 'warmup'
+
+def is_ping(event):
+    return isinstance(event, dict) and bool(event.get(PING))
+
+def warm(clients=(), tables=(), modules=()):
+    """
+    clients are (service name, call) pairs and tables (name of the environment
+    variable holding the table name, call) pairs, where call names the
+    timeouts in deadline.CALLS the handler uses them with. modules are the
+    names of lazily imported modules.
+    """
+    start = time.time()
+    for module_name in modules:
+        importlib.import_module(module_name)
+    for service_name, call in clients:
+        aws_clients.client(service_name, deadline.CALLS[call])
+    for table_env, call in tables:
+        aws_clients.table(os.environ[table_env], deadline.CALLS[call])
+    return { PING: True, 'elapsed_ms': int((time.time() - start) * 1000) }
+
+def provisioned():
+    """
+    True in execution environments Lambda starts ahead of time for provisioned
+    concurrency, where init isn't on a caller's critical path.
+    """
+    return os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'provisioned-concurrency'
+
+def on_init(**targets):
+    """
+    Warm up while the module is imported, but only for provisioned concurrency.
+    """
+    if provisioned():
+        warm(**targets)
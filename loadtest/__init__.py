@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The harnesses run the Lambda modules in-process, as Lambda would with the
+# lambda/ directory as the code root.
+LAMBDA_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda')
+if LAMBDA_ROOT not in sys.path:
+    sys.path.insert(0, LAMBDA_ROOT)
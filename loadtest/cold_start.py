@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold-start benchmark for the modules under lambda/.
+#
+# Every sample runs in a fresh interpreter and measures, for one handler
+# module:
+#   import_ms      importing the module (what Lambda does during init)
+#   first_call_ms  the first invocation, against the local stubs
+#   clients_ms     building the real boto3 clients that invocation needs
+# cold_ms is the sum, i.e. roughly what the first caller waits on top of the
+# Lambda runtime's own start-up. Custom-resource, ingestion and billing handlers
+# only make real AWS calls, so for those only the import and the clients they
+# need are measured.
+#
+#   python -m loadtest.cold_start --runs 5
+#
+# --save-baseline records the results in --baseline (cold_start_baseline.json
+# next to this file by default). Later runs compare against it when it exists
+# and exit with status 1 if a module's cold_ms went up by more than
+# --max-regression percent, and by more than NOISE_MS. So record the baseline
+# from the tree before a change, on the same machine, then run again after it.
+#
+#   python -m loadtest.cold_start --runs 5 --save-baseline
+#   python -m loadtest.cold_start --runs 5
+
+from loadtest import LAMBDA_ROOT
+from loadtest.replay import TABLE_NAMES, v2_slots
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_baseline.json')
+# cold_ms changes smaller than this are run-to-run noise
+NOISE_MS = 10.0
+
+def code_hook_event(intent, slots, source='DialogCodeHook'):
+    return {
+        'sessionId': 'cold-start',
+        'bot': { 'name': 'DUEBot', 'localeId': 'en_GB' },
+        'invocationSource': source,
+        'inputTranscript': '',
+        'sessionState': {
+            'intent': { 'name': intent, 'slots': v2_slots(slots), 'state': 'InProgress', 'confirmationState': 'None' },
+            'sessionAttributes': {}
+        }
+    }
+
+SLOTS = { 'UserId': None, 'vcode': None, 'Phone': None, 'Reading': None, 'UtilityType': None }
+
+# module -> (handler, first event, services used by that event)
+TARGETS = {
+    # the first turn of a call: the router plus the identity verification module it loads
+    'fulfillment': ('lambda_handler', code_hook_event('MeterReading', SLOTS), []),
+    # the handler modules fulfillment loads, imported on their own
+    'identity_verification': (None, None, ['dynamodb', 'sqs']),
+    'meter_reading': (None, None, ['dynamodb', 'sns']),
+    'sms_sender': ('lambda_handler', {
+        'Records': [{ 'messageId': '1', 'body': '{"phone":"+447700000000","message":"hi"}' }]
+    }, ['sns']),
+    'meter_ingest': (None, None, ['s3']),
+    'billing': (None, None, ['s3']),
+    'meter_export': (None, None, ['dynamodb', 's3']),
+    'connect_create2': (None, None, ['connect']),
+    'connect_attributes': (None, None, ['connect']),
+    'connect_associate_bot': (None, None, ['connect']),
+    'lex_bot': (None, None, ['lexv2-models']),
+    'lex_bot_locale': (None, None, ['lexv2-models']),
+    'lex_bot_intent': (None, None, ['lexv2-models']),
+}
+
+def child(module_name):
+    """
+    Runs in the fresh interpreter and prints one JSON sample.
+    """
+    import importlib
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    import_ms = (time.perf_counter() - start) * 1000.0
+
+    handler_name, event, services = TARGETS[module_name]
+    first_call_ms = 0.0
+    import aws_clients
+    if handler_name:
+        from loadtest import stubs
+        from loadtest.replay import Context
+
+        s = stubs.Stubs(stubs.Latency(), TABLE_NAMES)
+        s.install()
+        s.add_user('1000000', '+447700000000', 'Customer')
+
+        start = time.perf_counter()
+        getattr(module, handler_name)(event, Context())
+        first_call_ms = (time.perf_counter() - start) * 1000.0
+
+    # What the stubs stood in for: building the real clients, boto3 import included if still pending.
+    start = time.perf_counter()
+    for service in services:
+        aws_clients.session().client(service, config=aws_clients.config())
+    if 'dynamodb' in services:
+        aws_clients.session().resource('dynamodb', config=aws_clients.config())
+    clients_ms = (time.perf_counter() - start) * 1000.0
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'first_call_ms': first_call_ms,
+        'clients_ms': clients_ms,
+    }))
+
+def sample(module_name):
+    env = dict(os.environ)
+    env.update(TABLE_NAMES)
+    env.update({
+        'AWS_DEFAULT_REGION': 'eu-west-2',
+        'AWS_ACCESS_KEY_ID': 'cold-start',
+        'AWS_SECRET_ACCESS_KEY': 'cold-start',
+        'LOG_LEVEL': 'NONE',
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    root = os.path.dirname(LAMBDA_ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'loadtest.cold_start', '--child', module_name],
+        cwd=root, env=env
+    )
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def compare(results, baseline, max_regression):
+    """
+    Adds each module's baseline cold_ms and whether it regressed to its
+    result. Returns the modules that regressed.
+    """
+    regressed = []
+    for module_name, result in results.items():
+        before = baseline.get(module_name, {}).get('cold_ms')
+        result['baseline_cold_ms'] = before
+        result['regressed'] = before is not None and (
+            result['cold_ms'] - before > max(NOISE_MS, before * max_regression / 100.0))
+        if result['regressed']:
+            regressed.append(module_name)
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time and first-invocation latency of the Lambda modules.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module, the median is reported')
+    parser.add_argument('--module', action='append', help='only benchmark these modules')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE, help='results to compare against, if the file exists')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline instead of comparing')
+    parser.add_argument('--max-regression', type=float, default=20.0, help='percent cold_ms may grow over the baseline')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child)
+
+    results = {}
+    for module_name in args.module or TARGETS:
+        samples = [sample(module_name) for _ in range(args.runs)]
+        result = {key: round(statistics.median(s[key] for s in samples), 1) for key in samples[0]}
+        result['cold_ms'] = round(result['import_ms'] + result['first_call_ms'] + result['clients_ms'], 1)
+        results[module_name] = result
+
+    regressed = []
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.max_regression)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-24s %10s %14s %11s %9s %12s' % ('module', 'import ms', 'first call ms', 'clients ms', 'cold ms', 'baseline ms'))
+        for module_name, r in results.items():
+            before = r.get('baseline_cold_ms')
+            print('%-24s %10.1f %14.1f %11.1f %9.1f %12s%s' % (
+                module_name, r['import_ms'], r['first_call_ms'], r['clients_ms'], r['cold_ms'],
+                '-' if before is None else '%.1f' % before, '  REGRESSED' if r.get('regressed') else ''))
+    if regressed:
+        print('cold start regressed over %s: %s' % (args.baseline, ', '.join(regressed)), file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
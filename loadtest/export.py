@@ -0,0 +1,75 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import resource
+import tempfile
+
+# Runs the meter reading export (lambda/meter_export.py) against a stubbed
+# MeterReadingTable filled with synthetic readings, writing the export to a
+# local directory instead of S3, and checks every row made it into the file.
+#
+#   python -m loadtest.export --rows 200000 --segments 8 --latency-ms 5
+
+from loadtest import stubs
+from loadtest.replay import TABLE_NAMES
+
+def fill_table(dynamodb, table_name, rows, users):
+    items = dynamodb.tables.setdefault(table_name, {})
+    timestamp = 1600000000
+    for i in range(rows):
+        user_id = str(1000000 + i % users)
+        timestamp += random.randint(1, 60)
+        items[(user_id, timestamp)] = {
+            'user_id': { 'S': user_id },
+            'timestamp': { 'N': str(timestamp) },
+            'reading': { 'S': '%06d' % random.randint(0, 999999) },
+            'utility_type': { 'S': random.choice(['gas', 'electricity']) },
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a stubbed MeterReadingTable with the parallel-scan exporter.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--part-size-mb', type=float, default=5.0)
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='stub latency per AWS call')
+    parser.add_argument('--jitter-ms', type=float, default=2.0)
+    parser.add_argument('--out', default=tempfile.gettempdir(), help='directory the stubbed bucket is written to')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+    import aws_clients
+    import meter_export
+    import structured_log
+
+    latency = stubs.Latency(args.latency_ms, args.jitter_ms)
+    table_name = TABLE_NAMES['METER_READING_TABLE_NAME']
+    dynamodb = stubs.StubDynamoDBClient(latency, { table_name: 'user_id' })
+    fill_table(dynamodb, table_name, args.rows, args.users)
+    s3 = stubs.StubS3(latency, args.out)
+    aws_clients.set_client('dynamodb', dynamodb)
+    aws_clients.set_client('s3', s3)
+
+    structured_log.start('meter_export', sample_rate=0.0)
+    key = meter_export.export_key()
+    report = meter_export.export_table(
+        table_name, 'export', key,
+        segments=args.segments,
+        progress=lambda r: print('progress %d rows, %d parts' % (r['rows_scanned'], r['parts'])),
+        part_size=int(args.part_size_mb * 1024 * 1024)
+    )
+
+    path = s3.path('export', key)
+    with gzip.open(path, 'rt') as f:
+        lines = sum(1 for _ in f) - 1
+    report['file'] = path
+    report['rows_in_file'] = lines
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    print(json.dumps(report, indent=2))
+    if lines != args.rows:
+        raise SystemExit('expected %d rows in the export, found %d' % (args.rows, lines))
+
+if __name__ == '__main__':
+    main()
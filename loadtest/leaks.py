@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# Times the leak detection (lambda/leak_detection.py) on synthetic hourly
+# readings and checks it finds the leaks planted in them, without AWS: the
+# readings are generated straight into the arrays the table scan would return.
+#
+#   python -m loadtest.leaks --meters 50000 --leaks 0.01
+
+SECONDS_PER_HOUR = 3600
+
+def synthetic_readings(meters, days, now, leak_share, seed=1):
+    """
+    Hourly water readings for every meter over the last days days, with a
+    share of meters given a continuous overnight flow for the last few nights
+    and another share a spike yesterday. Returns the arrays detect() takes
+    plus the sets of user ids planted with each.
+    """
+    rng = np.random.default_rng(seed)
+    today = int(now // 86400) * 86400
+    hours = np.arange(today - days * 86400, today + 6 * SECONDS_PER_HOUR, SECONDS_PER_HOUR)
+    hour_of_day = (hours % 86400) // SECONDS_PER_HOUR
+
+    # daytime use in bursts, nothing overnight
+    active = (hour_of_day >= 6) & (hour_of_day <= 23)
+    usage = rng.poisson(0.6, size=(meters, len(hours))) * active
+
+    leaking = rng.choice(meters, int(meters * leak_share), replace=False)
+    recent = hours >= today - 4 * 86400
+    usage[np.ix_(leaking, np.flatnonzero(recent))] += 1
+
+    spiking = np.setdiff1d(rng.choice(meters, int(meters * leak_share), replace=False), leaking)
+    yesterday = (hours >= today - 86400) & (hours < today)
+    usage[np.ix_(spiking, np.flatnonzero(yesterday))] += 20
+
+    readings = (np.cumsum(usage, axis=1) + rng.integers(0, 999999, size=(meters, 1))) % 1000000
+    user_ids = np.repeat(np.array([str(1000000 + i) for i in range(meters)]), len(hours))
+    utilities = np.full(user_ids.shape, 'water')
+    timestamps = np.tile(hours.astype(np.float64), meters) + 1.0
+    return (user_ids, utilities, timestamps, readings.ravel().astype(np.float64),
+            set(user_ids[leaking * len(hours)]), set(user_ids[spiking * len(hours)]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run leak detection over synthetic readings.')
+    parser.add_argument('--meters', type=int, default=20000)
+    parser.add_argument('--leaks', type=float, default=0.01, help='share of meters given each kind of leak')
+    args = parser.parse_args()
+
+    os.environ.setdefault('LOG_LEVEL', 'NONE')
+    import leak_detection
+
+    now = time.time()
+    generated = time.time()
+    user_ids, utilities, timestamps, readings, leaking, spiking = synthetic_readings(
+        args.meters, leak_detection.WINDOW_DAYS + 1, now, args.leaks)
+    generated = time.time() - generated
+
+    started = time.time()
+    flags, meters = leak_detection.detect(user_ids, utilities, timestamps, readings, now)
+    elapsed = time.time() - started
+
+    overnight = set(f['user_id'] for f in flags if 'overnight_flow' in f['reasons'])
+    spikes = set(f['user_id'] for f in flags if 'spike' in f['reasons'])
+    print(json.dumps({
+        'readings': len(readings),
+        'meters': meters,
+        'generate_seconds': round(generated, 2),
+        'detect_seconds': round(elapsed, 2),
+        'readings_per_second': int(len(readings) / elapsed),
+        'overnight_flow': { 'planted': len(leaking), 'found': len(overnight & leaking), 'false': len(overnight - leaking) },
+        'spike': { 'planted': len(spiking), 'found': len(spikes & spiking), 'false': len(spikes - spiking - leaking) },
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
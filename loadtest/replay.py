@@ -0,0 +1,243 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Replays Lex conversations against the code hooks in-process, with DynamoDB,
+# SNS and SQS replaced by local stubs, and reports per-turn latency, AWS calls
+# per turn and throughput.
+#
+#   python -m loadtest.replay --conversations 2000 --concurrency 32 --latency-ms 8 --jitter-ms 4
+#
+# A conversation file lists the turns in order. Each turn names the handler
+# module, the intent and the slots the caller fills in on that turn; slots
+# carry over from the previous turn's response like they do in Lex. Slot values
+# can use {user_id}, {phone}, {reading} and {otp}, the last code texted to the
+# caller. Session attributes the contact flow would set, such as the caller's
+# number, go under sessionAttributes and can use the same placeholders.
+
+TABLE_NAMES = {
+    'USER_TABLE_NAME': 'UserTable',
+    'OTP_TABLE_NAME': 'OtpTable',
+    'METER_READING_TABLE_NAME': 'MeterReadingTable',
+    'RATE_LIMIT_TABLE_NAME': 'RateLimitTable',
+    'ROLLUP_TABLE_NAME': 'ConsumptionRollupTable',
+}
+
+DEFAULT_CONVERSATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversations', 'meter_reading.json')
+
+OTP_PATTERN = re.compile(r'(\d{6})\s*$')
+
+class Context(object):
+    """
+    Enough of the Lambda context object for the handlers.
+    """
+
+    def __init__(self, timeout_ms=3000):
+        self.aws_request_id = str(uuid.uuid4())
+        self.function_name = 'replay'
+        self.deadline = time.time() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+def configure_environment():
+    for name, value in TABLE_NAMES.items():
+        os.environ.setdefault(name, value)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+    os.environ.setdefault('LOG_LEVEL', 'NONE')
+    # every conversation sends codes, so keep the rate limiter out of the way
+    os.environ.setdefault('OTP_LIMIT_PER_PHONE', '1000000')
+    os.environ.setdefault('OTP_LIMIT_PER_USER', '1000000')
+    # the secret one time codes are derived from (OTP_MODE=hmac)
+    os.environ.setdefault('OTP_SECRET', 'replay')
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def v2_slots(slots):
+    return {
+        name: None if value is None else {
+            'shape': 'Scalar',
+            'value': { 'originalValue': value, 'interpretedValue': value, 'resolvedValues': [value] }
+        }
+        for name, value in slots.items()
+    }
+
+def flat_slots(slots):
+    return {
+        name: None if not slot else slot['value'].get('interpretedValue')
+        for name, slot in slots.items()
+    }
+
+def build_event(turn, slots, session_attributes, caller):
+    """
+    A Lex V2 code hook event for one turn.
+    """
+    return {
+        'messageVersion': '1.0',
+        'sessionId': caller['session_id'],
+        'bot': { 'name': 'DUEBot', 'localeId': 'en_GB' },
+        'invocationSource': turn.get('invocationSource', 'DialogCodeHook'),
+        'inputMode': 'Speech',
+        'inputTranscript': '',
+        'sessionState': {
+            'intent': {
+                'name': turn['intent'],
+                'slots': v2_slots(slots),
+                'state': 'InProgress',
+                'confirmationState': 'None'
+            },
+            'sessionAttributes': session_attributes
+        }
+    }
+
+def fill(value, caller, stubs):
+    if not isinstance(value, str):
+        return value
+    if '{otp}' in value:
+        message = stubs.sns.outbox.get(caller['phone'], '')
+        match = OTP_PATTERN.search(message)
+        value = value.replace('{otp}', match.group(1) if match else '')
+    return value.format(**caller) if '{' in value else value
+
+class Replay(object):
+
+    def __init__(self, conversation, stubs, stub_module):
+        self.conversation = conversation
+        self.stubs = stubs
+        self.stub_module = stub_module
+        self.handlers = {}
+        for turn in conversation['turns']:
+            if turn['handler'] not in self.handlers:
+                self.handlers[turn['handler']] = importlib.import_module(turn['handler']).lambda_handler
+
+    def run_conversation(self, caller):
+        results = []
+        slots = dict(self.conversation['slots'])
+        session_attributes = {
+            name: fill(value, caller, self.stubs)
+            for name, value in self.conversation.get('sessionAttributes', {}).items()
+        }
+        for turn in self.conversation['turns']:
+            for name, value in turn['slots'].items():
+                slots[name] = fill(value, caller, self.stubs)
+            event = build_event(turn, slots, session_attributes, caller)
+
+            self.stub_module.reset_calls()
+            start = time.perf_counter()
+            error = None
+            try:
+                response = self.handlers[turn['handler']](event, Context())
+            except Exception as e:
+                response, error = None, repr(e)
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            calls = self.stub_module.reset_calls()
+            results.append((turn['name'], elapsed_ms, calls, error))
+
+            if response is None:
+                break
+            session_state = response['sessionState']
+            session_attributes = session_state.get('sessionAttributes') or {}
+            slots = flat_slots(session_state['intent'].get('slots') or v2_slots(slots))
+        return results
+
+def report(results, elapsed_s, conversations):
+    by_turn = defaultdict(list)
+    calls_by_turn = defaultdict(Counter)
+    errors = Counter()
+    for conversation in results:
+        for name, elapsed_ms, calls, error in conversation:
+            by_turn[name].append(elapsed_ms)
+            calls_by_turn[name].update(calls)
+            if error:
+                errors[(name, error)] += 1
+
+    turns = sum(len(values) for values in by_turn.values())
+    summary = {
+        'conversations': conversations,
+        'turns': turns,
+        'seconds': round(elapsed_s, 3),
+        'conversations_per_second': round(conversations / elapsed_s, 1),
+        'turns_per_second': round(turns / elapsed_s, 1),
+        'per_turn': {},
+        'errors': {'%s: %s' % key: count for key, count in errors.items()},
+    }
+    for name, values in by_turn.items():
+        values.sort()
+        summary['per_turn'][name] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 50), 2),
+            'p95_ms': round(percentile(values, 95), 2),
+            'p99_ms': round(percentile(values, 99), 2),
+            'aws_calls_per_turn': {op: round(n / float(len(values)), 2) for op, n in sorted(calls_by_turn[name].items())},
+        }
+    return summary
+
+def print_report(summary):
+    print('%d conversations, %d turns in %.2fs (%.1f conversations/s, %.1f turns/s)' % (
+        summary['conversations'], summary['turns'], summary['seconds'],
+        summary['conversations_per_second'], summary['turns_per_second']))
+    print('%-12s %8s %9s %9s %9s  %s' % ('turn', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'aws calls/turn'))
+    for name, stats in summary['per_turn'].items():
+        calls = ', '.join('%s=%s' % item for item in stats['aws_calls_per_turn'].items())
+        print('%-12s %8d %9.2f %9.2f %9.2f  %s' % (name, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], calls))
+    for error, count in summary['errors'].items():
+        print('error x%d %s' % (count, error))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Lex conversations against the code hooks with stubbed AWS services.')
+    parser.add_argument('--conversation', default=DEFAULT_CONVERSATION, help='conversation file (JSON)')
+    parser.add_argument('--conversations', type=int, default=500, help='number of conversations to replay')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=1000, help='number of synthetic customers')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='stub latency per AWS call')
+    parser.add_argument('--jitter-ms', type=float, default=2.0, help='random extra latency per AWS call')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    configure_environment()
+    from loadtest import stubs as stub_module
+
+    stubs = stub_module.Stubs(stub_module.Latency(args.latency_ms, args.jitter_ms), TABLE_NAMES)
+    stubs.install()
+    callers = []
+    for i in range(args.users):
+        caller = {
+            'user_id': str(1000000 + i),
+            'phone': '+447700%06d' % i,
+        }
+        stubs.add_user(caller['user_id'], caller['phone'], 'Customer%d' % i)
+        callers.append(caller)
+
+    with open(args.conversation) as f:
+        conversation = json.load(f)
+    replay = Replay(conversation, stubs, stub_module)
+
+    def run(i):
+        # readings go up each time a caller comes round again, as they would on a real meter
+        reading = '%06d' % (100000 + 100 * (i // len(callers)) + random.randint(0, 99))
+        caller = dict(callers[i % len(callers)], session_id=str(uuid.uuid4()), reading=reading)
+        return replay.run_conversation(caller)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(run, range(args.conversations)))
+    summary = report(results, time.perf_counter() - start, args.conversations)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import aws_clients
+
+# In-memory stand-ins for the AWS services the code hooks call, installed into
+# aws_clients so the handlers run unchanged. Every call sleeps for the
+# configured latency and is counted per thread, so a harness can report AWS
+# calls per dialog turn.
+
+_calls = threading.local()
+
+def reset_calls():
+    """
+    Return the calls made on this thread since the last reset, by service.operation.
+    """
+    counts = getattr(_calls, 'counts', None) or Counter()
+    _calls.counts = Counter()
+    return counts
+
+class Latency(object):
+
+    def __init__(self, base_ms=0.0, jitter_ms=0.0):
+        self.base_ms = base_ms
+        self.jitter_ms = jitter_ms
+
+    def wait(self):
+        delay = self.base_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+class Stub(object):
+    service_name = None
+
+    def __init__(self, latency):
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        counts = getattr(_calls, 'counts', None)
+        if counts is None:
+            counts = _calls.counts = Counter()
+        counts['%s.%s' % (self.service_name, operation)] += 1
+        self.latency.wait()
+
+class _Exceptions(object):
+    # The stubs never raise these; they only need to exist for except clauses.
+    # Not ClientError subclasses so the stubs don't pull in botocore.
+
+    class ConditionalCheckFailedException(Exception):
+        pass
+
+    class TransactionCanceledException(Exception):
+        pass
+
+class StubDynamoDBClient(Stub):
+    """
+    Low-level DynamoDB client holding items in their attribute-value form.
+    key_names maps a table name to its partition key attribute, or to a
+    (partition key, sort key) pair.
+    """
+    service_name = 'dynamodb'
+    exceptions = _Exceptions
+
+    def __init__(self, latency, key_names):
+        super(StubDynamoDBClient, self).__init__(latency)
+        self.key_names = key_names
+        self.tables = {}
+
+    def _key(self, table_name, key):
+        attribute = self.key_names[table_name]
+        if isinstance(attribute, tuple):
+            return tuple(list(key[name].values())[0] for name in attribute)
+        return list(key[attribute].values())[0]
+
+    def put_item(self, TableName, Item, **kwargs):
+        self._call('PutItem')
+        with self._lock:
+            self.tables.setdefault(TableName, {})[self._key(TableName, Item)] = Item
+        return { 'ResponseMetadata': { 'HTTPStatusCode': 200 } }
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call('GetItem')
+        response = { 'ResponseMetadata': { 'HTTPStatusCode': 200 } }
+        item = self.tables.get(TableName, {}).get(self._key(TableName, Key))
+        if item is not None:
+            response['Item'] = item
+        return response
+
+    def update_item(self, TableName, Key, **kwargs):
+        self._call('UpdateItem')
+        return { 'ResponseMetadata': { 'HTTPStatusCode': 200 } }
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        """
+        Stores the Puts into tables it knows the keys of; conditions and
+        updates are not evaluated.
+        """
+        self._call('TransactWriteItems')
+        with self._lock:
+            for item in TransactItems:
+                put = item.get('Put')
+                if put and put['TableName'] in self.key_names:
+                    self.tables.setdefault(put['TableName'], {})[self._key(put['TableName'], put['Item'])] = put['Item']
+        return { 'ResponseMetadata': { 'HTTPStatusCode': 200 } }
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, Limit=None, ExclusiveStartKey=None, **kwargs):
+        """
+        Pages through one segment of a table. Items are split between segments
+        by a hash of their key, like DynamoDB does.
+        """
+        self._call('Scan')
+        with self._lock:
+            keys = sorted(key for key in self.tables.get(TableName, {}) if hash(key) % TotalSegments == Segment)
+            if ExclusiveStartKey is not None:
+                keys = keys[keys.index(ExclusiveStartKey['_stub_key']) + 1:]
+            page = keys[:Limit] if Limit else keys
+            items = [self.tables[TableName][key] for key in page]
+        response = { 'Items': items, 'Count': len(items), 'ConsumedCapacity': { 'TableName': TableName, 'CapacityUnits': len(items) / 8.0 } }
+        if Limit and len(keys) > Limit:
+            response['LastEvaluatedKey'] = { '_stub_key': page[-1] }
+        return response
+
+def _key_values(condition, expression_values=None):
+    """
+    Pull attribute name/value pairs out of a key condition, either a boto3
+    condition such as Key('user_id').eq('1') & Key('timestamp').gte(5), or an
+    expression string such as 'user_id = :user_id' plus its attribute values.
+    """
+    if isinstance(condition, str):
+        values = {}
+        for name, placeholder in re.findall(r'(\w+)\s*=\s*(:\w+)', condition):
+            values[name] = expression_values[placeholder]
+        return values
+
+    values = {}
+    expression = condition.get_expression()
+    for value in expression['values']:
+        if hasattr(value, 'get_expression'):
+            values.update(_key_values(value))
+        elif hasattr(value, 'name'):
+            name = value.name
+        else:
+            values.setdefault(name, value)
+    return values
+
+class StubTable(Stub):
+    """
+    Resource-level Table holding plain Python items, keyed on partition key
+    plus optional sort key.
+    """
+    service_name = 'dynamodb'
+
+    def __init__(self, latency, name, partition_key, sort_key=None):
+        super(StubTable, self).__init__(latency)
+        self.name = name
+        self.partition_key = partition_key
+        self.sort_key = sort_key
+        self.items = {}
+
+    def _key(self, item):
+        return (item[self.partition_key], item.get(self.sort_key) if self.sort_key else None)
+
+    def put_item(self, Item, **kwargs):
+        self._call('PutItem')
+        with self._lock:
+            self.items[self._key(Item)] = dict(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        self._call('GetItem')
+        item = self.items.get(self._key(Key))
+        return { 'Item': item } if item is not None else {}
+
+    def query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None,
+              ExpressionAttributeValues=None, **kwargs):
+        self._call('Query')
+        (name, value), = [(k, v) for k, v in _key_values(KeyConditionExpression, ExpressionAttributeValues).items()
+                          if IndexName or k == self.partition_key][:1]
+        items = [item for item in self.items.values() if item.get(name) == value]
+        if self.sort_key:
+            items.sort(key=lambda item: item[self.sort_key], reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = [self._key(item) for item in items].index(self._key(ExclusiveStartKey)) + 1
+            items = items[start:]
+        response = { 'Items': items[:Limit] if Limit else items }
+        if Limit and len(items) > Limit:
+            response['LastEvaluatedKey'] = {k: items[Limit - 1][k] for k in (self.partition_key, self.sort_key) if k}
+        return response
+
+    def scan(self, **kwargs):
+        self._call('Scan')
+        return { 'Items': list(self.items.values()) }
+
+class StubDynamoDBResource(object):
+
+    def __init__(self, tables):
+        self.tables = {table.name: table for table in tables}
+
+    def Table(self, name):
+        return self.tables[name]
+
+class StubSNS(Stub):
+    service_name = 'sns'
+
+    def __init__(self, latency):
+        super(StubSNS, self).__init__(latency)
+        self.outbox = {}
+
+    def publish(self, PhoneNumber, Message, **kwargs):
+        self._call('Publish')
+        with self._lock:
+            self.outbox[PhoneNumber] = Message
+        return { 'MessageId': str(len(self.outbox)) }
+
+class StubSQS(Stub):
+    service_name = 'sqs'
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._call('SendMessage')
+        return { 'MessageId': '1' }
+
+class StubS3(Stub):
+    """
+    Multipart uploads only, written out to local files under root as they complete.
+    """
+    service_name = 's3'
+
+    def __init__(self, latency, root):
+        super(StubS3, self).__init__(latency)
+        self.root = root
+        self.uploads = {}
+
+    def path(self, Bucket, Key):
+        return os.path.join(self.root, Bucket, Key)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('CreateMultipartUpload')
+        with self._lock:
+            upload_id = str(len(self.uploads) + 1)
+            self.uploads[upload_id] = {}
+        return { 'UploadId': upload_id }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call('UploadPart')
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return { 'ETag': '"%s-%d"' % (UploadId, PartNumber) }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._call('CompleteMultipartUpload')
+        with self._lock:
+            parts = self.uploads.pop(UploadId)
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for part in MultipartUpload['Parts']:
+                f.write(parts[part['PartNumber']])
+        return { 'Key': Key }
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call('AbortMultipartUpload')
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+class Stubs(object):
+    """
+    One set of stubs for the tables and services the code hooks use, named as
+    in the environment the handlers read.
+    """
+
+    def __init__(self, latency, table_names):
+        self.table_names = table_names
+        self.users = StubTable(latency, table_names['USER_TABLE_NAME'], 'PhoneNumber')
+        self.readings = StubTable(latency, table_names['METER_READING_TABLE_NAME'], 'user_id', 'timestamp')
+        self.dynamodb = StubDynamoDBClient(latency, {
+            table_names['OTP_TABLE_NAME']: 'uuid',
+            table_names['RATE_LIMIT_TABLE_NAME']: 'key',
+            table_names['ROLLUP_TABLE_NAME']: ('user_id', 'period'),
+        })
+        self.sns = StubSNS(latency)
+        self.sqs = StubSQS(latency)
+
+    def install(self):
+        aws_clients.set_client('dynamodb', self.dynamodb)
+        aws_clients.set_client('sns', self.sns)
+        aws_clients.set_client('sqs', self.sqs)
+        aws_clients.set_resource('dynamodb', StubDynamoDBResource([self.users, self.readings]))
+
+    def add_user(self, user_id, phone_number, first_name):
+        self.users.items[(phone_number, None)] = {
+            'PhoneNumber': phone_number,
+            'user_id': user_id,
+            'firstName': first_name,
+            'vcode': '000000',
+        }
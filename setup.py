@@ -21,8 +21,15 @@ setuptools.setup(
     install_requires=[
         "aws-cdk.core",
         "aws-cdk.aws_lambda",
+        "aws-cdk.aws_applicationautoscaling",
         "aws-cdk.aws_dynamodb",
         "aws-cdk.aws_iam",
+        "aws-cdk.aws_events",
+        "aws-cdk.aws_events_targets",
+        "aws-cdk.aws_sqs",
+        "aws-cdk.aws_lambda_event_sources",
+        "aws-cdk.aws_s3_notifications",
+        "aws-cdk.aws_secretsmanager",
         "aws-cdk.custom_resources",
         "crhelper",
     ],
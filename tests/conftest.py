@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The Lambda modules import each other flat, as they do with lambda/ as the code root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda'))
+os.environ.setdefault('LOG_LEVEL', 'NONE')
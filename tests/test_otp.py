@@ -0,0 +1,110 @@
+import pytest
+
+import aws_clients
+import otp
+
+USER = '1000001'
+ISSUED = 1700000000 - 1700000000 % 60 + 30
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+class FakeDynamoDB(object):
+    """
+    put_item and get_item on one table keyed by uuid, with the
+    attribute_not_exists condition otp.mark_used relies on.
+    """
+
+    class exceptions(object):
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+        key = Item['uuid']['S']
+        if ConditionExpression and key in self.items:
+            raise ConditionalCheckFailedException()
+        self.items[key] = Item
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.items.get(Key['uuid']['S'])
+        return { 'Item': item } if item else {}
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    fake = FakeDynamoDB()
+    monkeypatch.setenv('OTP_TABLE_NAME', 'OtpTable')
+    monkeypatch.setitem(otp._secret, 'value', b'test secret')
+    monkeypatch.setitem(aws_clients._overrides, 'dynamodb', fake)
+    return fake
+
+@pytest.fixture
+def hmac_mode(monkeypatch, dynamodb):
+    monkeypatch.setattr(otp, 'MODE', otp.HMAC)
+    return dynamodb
+
+@pytest.fixture
+def table_mode(monkeypatch, dynamodb):
+    monkeypatch.setattr(otp, 'MODE', otp.TABLE)
+    return dynamodb
+
+def test_hmac_issue_makes_no_call(hmac_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    assert len(code) == otp.DIGITS and code.isdigit()
+    assert hmac_mode.items == {}
+
+@pytest.mark.parametrize('offset, accepted', [
+    (0, True),
+    # the rest of the step it was issued in, and the whole next one
+    (29, True),
+    (30, True),
+    (89, True),
+    # two steps on
+    (90, False),
+    # before it was issued
+    (-31, False),
+])
+def test_hmac_step_boundaries(hmac_mode, offset, accepted):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    assert otp.verify(code, nonce, USER, now=ISSUED + offset) is accepted
+
+def test_hmac_rejects_other_account(hmac_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    assert not otp.verify(code, nonce, '1000002', now=ISSUED)
+
+def test_hmac_rejects_other_nonce(hmac_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    other_nonce, _ = otp.issue(USER, now=ISSUED)
+    assert not otp.verify(code, other_nonce, USER, now=ISSUED)
+
+def test_hmac_rejects_wrong_code(hmac_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    wrong = str((int(code) + 1) % 10 ** otp.DIGITS).zfill(otp.DIGITS)
+    assert not otp.verify(wrong, nonce, USER, now=ISSUED)
+    assert hmac_mode.items == {}
+
+def test_hmac_rejects_replay(hmac_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    assert otp.verify(code, nonce, USER, now=ISSUED)
+    assert list(hmac_mode.items) == ['used#' + nonce]
+    assert not otp.verify(code, nonce, USER, now=ISSUED + 1)
+
+def test_hmac_rejects_missing_values(hmac_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    assert not otp.verify(None, nonce, USER, now=ISSUED)
+    assert not otp.verify(code, None, USER, now=ISSUED)
+
+def test_table_mode_stores_and_checks(table_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    assert len(code) == otp.DIGITS and code.isdigit()
+    assert table_mode.items[nonce]['pin']['S'] == code
+    assert otp.verify(code, nonce, USER, now=ISSUED + otp.TABLE_CODE_SECONDS - 1)
+
+def test_table_mode_rejects_expired_and_wrong(table_mode):
+    nonce, code = otp.issue(USER, now=ISSUED)
+    wrong = str((int(code) + 1) % 10 ** otp.DIGITS).zfill(otp.DIGITS)
+    assert not otp.verify(wrong, nonce, USER, now=ISSUED)
+    assert not otp.verify(code, nonce, USER, now=ISSUED + otp.TABLE_CODE_SECONDS)
+    assert not otp.verify(code, 'unknown', USER, now=ISSUED)